@@ -0,0 +1,501 @@
+# Benchmarks for terraform-migrate-sample.py.
+#
+# Usage:
+# python terraform-migrate-benchmark.py parser [--files N] [--lines N] [--repeat N]
+# python terraform-migrate-benchmark.py startup [--repeat N] [--app PATH]
+# python terraform-migrate-benchmark.py e2e [--samples N] [--files M] [--file-bytes N] [--jobs N] [--latency S] [--error-rate R] [--invalid-rate R] [--endpoints N] [--failing-endpoints N] [--small-endpoints N] [--stream]
+# python terraform-migrate-benchmark.py serve [--samples N] [--files M] [--file-bytes N] [--latency S]
+
+import sys
+import os
+import re
+import time
+import argparse
+import importlib.util
+import subprocess
+import tempfile
+import statistics
+import json
+import io
+import random
+import threading
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# resource is only available on Unix.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+APP_SCRIPT_FILE_NAME            = 'terraform-migrate-sample.py'
+MOCK_API_KEY                    = 'mock'
+MOCK_RETRY_AFTER_MS             = 100
+MOCK_STREAM_BATCH_EVENTS        = 64
+MOCK_CONTEXT_WINDOW_TOKENS      = 32768
+MOCK_SMALL_CONTEXT_WINDOW_TOKENS = 16384
+MOCK_SMALL_ENGINE               = 'mock-small'
+MOCK_SMALL_COST_PER_1K_TOKENS   = 0.002
+MOCK_CHARACTERS_PER_TOKEN       = 4
+MOCK_COMPLETION_FILE_NAMES      = ['main.tf', 'variables.tf', 'outputs.tf', 'providers.tf']
+SERVE_START_TIMEOUT_SECONDS     = 30
+
+def get_app_script_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), APP_SCRIPT_FILE_NAME)
+
+def load_app():
+    # The app script's name isn't a valid module name, so load it from its path. It's registered
+    # as a module so that its functions can be sent to the validation worker processes.
+    spec = importlib.util.spec_from_file_location("terraform_migrate_sample", get_app_script_path())
+    app = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = app
+    spec.loader.exec_module(app)
+    return app
+
+def get_synthetic_completion(file_count, line_count):
+    # Build a completion in the same format the model returns.
+    completion = ["Here is the migrated sample:\n"]
+
+    for i in range(file_count):
+        file_name = f"file{i:05}.tf"
+        completion.append(f"###{file_name}###\n")
+        for j in range(line_count):
+            completion.append(f'resource "azurerm_resource_group" "rg{j}" {{ name = "rg-{i}-{j}" }}\n')
+        completion.append(f"{file_name}:end\n")
+
+    return ''.join(completion)
+
+def legacy_parse_completion_files(completion):
+    # The per-file regex scans previously used by write_new_sample, kept for comparison.
+    sample_files = []
+
+    for file_name in re.findall(r'###(.*)###', completion):
+        beg_m = re.search('###'+ file_name + '###', completion)
+        end_m = re.search(file_name + ':end', completion)
+        sample_files.append((file_name, completion[(beg_m.span())[1]:(end_m.span())[0]].strip()))
+
+    return sample_files
+
+def time_function(function, argument, repeat):
+    # Returns the best time (in seconds) of several runs.
+    best_time = None
+
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function(argument)
+        elapsed_time = time.perf_counter() - start_time
+
+        if best_time is None or elapsed_time < best_time:
+            best_time = elapsed_time
+
+    return best_time
+
+def benchmark_parser(args):
+    app = load_app()
+
+    completion = get_synthetic_completion(args.files, args.lines)
+    print(f"Synthetic completion: {args.files} files x {args.lines} lines ({len(completion):,} characters)")
+
+    if legacy_parse_completion_files(completion) != app.parse_completion_files(completion):
+        raise ValueError("The legacy and single-pass parsers returned different files.")
+
+    legacy_time = time_function(legacy_parse_completion_files, completion, args.repeat)
+    single_pass_time = time_function(app.parse_completion_files, completion, args.repeat)
+
+    print(f"Legacy regex parser:    {legacy_time * 1000:10.2f} ms")
+    print(f"Single-pass parser:     {single_pass_time * 1000:10.2f} ms")
+    print(f"Speedup:                {legacy_time / single_pass_time:10.2f}x")
+
+def time_command(command, repeat):
+    # Returns the wall times (in seconds) of several runs of the command.
+    elapsed_times = []
+
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        elapsed_times.append(time.perf_counter() - start_time)
+
+        if result.returncode != 0:
+            raise ValueError(f"Command failed ({' '.join(command)}). {result.stderr.strip()}")
+
+    return elapsed_times
+
+def get_imported_heavy_modules():
+    # Returns the Azure OpenAI modules that are imported just by loading the app.
+    heavy_modules = ['openai', 'azure.identity', 'azure.core', 'keyboard', 'requests', 'tiktoken']
+    code = ("import sys, importlib.util;"
+            f"spec = importlib.util.spec_from_file_location('app', {get_app_script_path()!r});"
+            "spec.loader.exec_module(importlib.util.module_from_spec(spec));"
+            f"print(','.join(m for m in {heavy_modules!r} if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+
+    if result.returncode != 0:
+        raise ValueError(f"Failed to load the app. {result.stderr.strip()}")
+
+    return [module for module in result.stdout.strip().split(',') if module]
+
+def benchmark_startup(args):
+    # The app can be the script or the frozen (PyInstaller) binary.
+    if args.app:
+        app_command = [args.app]
+    else:
+        app_command = [sys.executable, get_app_script_path()]
+
+    with tempfile.TemporaryDirectory() as empty_dir:
+        commands = {"Help (-h)":                    app_command + ["-h"],
+                    "Plan only (empty directory)":  app_command + ["-s", empty_dir, "--plan-only"]}
+
+        for (name, command) in commands.items():
+            elapsed_times = time_command(command, args.repeat)
+            print(f"{name + ':':32}median {statistics.median(elapsed_times) * 1000:8.1f} ms, min {min(elapsed_times) * 1000:8.1f} ms")
+
+    if not args.app:
+        imported_modules = get_imported_heavy_modules()
+        print(f"Heavy modules imported at load: {', '.join(imported_modules) if imported_modules else 'none'}")
+
+def create_synthetic_samples(root_dir, sample_count, file_count, file_bytes):
+    # Create sample_count sample directories, each with file_count Terraform files of about file_bytes bytes.
+    for i in range(sample_count):
+        sample_dir = os.path.join(root_dir, f"group{i % 10}", f"sample{i:05}")
+        os.makedirs(sample_dir)
+
+        for j in range(file_count):
+            blocks = []
+            size = 0
+            k = 0
+            while size < file_bytes:
+                block = f'resource "azurerm_resource_group" "rg{j}_{k}" {{\n  name     = "rg-{i}-{j}-{k}"\n  location = "westus"\n}}\n\n'
+                blocks.append(block)
+                size += len(block)
+                k += 1
+
+            with open(os.path.join(sample_dir, f"file{j}.tf"), "w", encoding="utf-8") as f:
+                f.write(''.join(blocks))
+
+    return root_dir
+
+def get_mock_completion(sample_source, invalid = False):
+    # Returns a completion in the format the model is prompted to return:
+    # the sample's source in main.tf plus small stand-ins for the other files.
+    # An invalid completion's main.tf is missing its last closing brace.
+    completion = []
+
+    for file_name in MOCK_COMPLETION_FILE_NAMES:
+        contents = sample_source.strip() if file_name == 'main.tf' else f"# {file_name}"
+        if invalid and file_name == 'main.tf':
+            contents = contents[:contents.rfind('}')]
+        completion.append(f"###{file_name}###\n{contents}\n{file_name}:end\n")
+
+    return ''.join(completion)
+
+def get_mock_packed_completion(packed_source, begin_marker, end_marker):
+    # Returns a completion for a packed prompt: each sample's completion between the sample's markers.
+    begin_pattern = re.escape(begin_marker).replace(re.escape('{}'), r'(\d+)')
+    end_pattern = re.escape(end_marker).replace(re.escape('{}'), r'\1')
+
+    completion = []
+    for (number, sample_source) in re.findall(f"^{begin_pattern}$(.*?)^{end_pattern}$", packed_source, re.MULTILINE | re.DOTALL):
+        completion.append(f"{begin_marker.format(number)}\n{get_mock_completion(sample_source)}{end_marker.format(number)}\n")
+
+    return ''.join(completion)
+
+class MockChatCompletionsHandler(BaseHTTPRequestHandler):
+    # A local stand-in for the Azure OpenAI chat completions API.
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+        with self.server.lock:
+            self.server.request_count += 1
+
+        time.sleep(self.server.latency)
+
+        if random.random() < self.server.error_rate:
+            with self.server.lock:
+                self.server.error_count += 1
+            self.send_json(self.server.error_status, 
+                           {"error": {"message": "Mock error.", "type": "mock_error", "code": str(self.server.error_status)}}, 
+                           {"retry-after-ms": str(MOCK_RETRY_AFTER_MS)})
+            return
+
+        # Like the model, leave out the problems listed when regenerating a sample that failed validation.
+        sample_source = request["messages"][-1]["content"].split(self.server.feedback_prefix)[0]
+        (begin_marker, end_marker) = self.server.packed_markers
+        if begin_marker.format(1) in sample_source:
+            completion = get_mock_packed_completion(sample_source, begin_marker, end_marker)
+        else:
+            with self.server.lock:
+                invalid = random.random() < self.server.invalid_rate
+                self.server.invalid_count += invalid
+            completion = get_mock_completion(sample_source, invalid)
+        prompt_tokens = sum(len(message["content"]) // MOCK_CHARACTERS_PER_TOKEN for message in request["messages"])
+
+        # Like the service, reject prompts that don't fit in the context window and cut off completions that don't.
+        if prompt_tokens > self.server.context_window:
+            self.send_json(400, {"error": {"message": f"This model's maximum context length is {self.server.context_window} tokens.", 
+                                           "type": "invalid_request_error", "code": "context_length_exceeded"}})
+            return
+
+        completion = completion[:(self.server.context_window - prompt_tokens) * MOCK_CHARACTERS_PER_TOKEN]
+        completion_tokens = len(completion) // MOCK_CHARACTERS_PER_TOKEN
+
+        if request.get("stream"):
+            self.send_stream(completion)
+        else:
+            self.send_json(200, {"id": "mock",
+                                 "object": "chat.completion",
+                                 "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": completion}}],
+                                 "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}})
+
+    def send_json(self, status, body, headers = {}):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, completion):
+        # Send the completion as server-sent events, about one token (4 characters) per event.
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        # Events are written in batches, the way a real connection coalesces them, so that the
+        # benchmark measures the client rather than one socket write per token.
+        events = []
+        for i in range(0, len(completion), 4):
+            chunk = {"id": "mock", "object": "chat.completion.chunk", 
+                     "choices": [{"index": 0, "finish_reason": None, "delta": {"content": completion[i:i+4]}}]}
+            events.append(f"data: {json.dumps(chunk)}\n\n")
+
+            if len(events) == MOCK_STREAM_BATCH_EVENTS:
+                self.wfile.write("".join(events).encode("utf-8"))
+                events = []
+
+        events.append("data: [DONE]\n\n")
+        self.wfile.write("".join(events).encode("utf-8"))
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+def start_mock_server(latency, error_rate, error_status, packed_markers, invalid_rate = 0.0, feedback_prefix = None, context_window = MOCK_CONTEXT_WINDOW_TOKENS):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockChatCompletionsHandler)
+    server.daemon_threads   = True
+    server.latency          = latency
+    server.error_rate       = error_rate
+    server.error_status     = error_status
+    server.packed_markers   = packed_markers
+    server.invalid_rate     = invalid_rate
+    server.feedback_prefix  = feedback_prefix
+    server.context_window   = context_window
+    server.lock             = threading.Lock()
+    server.request_count    = 0
+    server.error_count      = 0
+    server.invalid_count    = 0
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def get_percentile(values, percentile):
+    # Nearest-rank percentile.
+    ordered_values = sorted(values)
+    return ordered_values[max(0, int(round(percentile / 100 * len(ordered_values) + 0.5)) - 1)]
+
+def benchmark_end_to_end(args):
+    app = load_app()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        sample_root = create_synthetic_samples(os.path.join(work_dir, "samples"), args.samples, args.files, args.file_bytes)
+
+        # The first --failing-endpoints endpoints always fail and the last --small-endpoints
+        # endpoints are a cheaper model with a smaller context window.
+        servers = []
+        endpoints = []
+        for i in range(args.endpoints):
+            failing = i < args.failing_endpoints
+            small = i >= args.endpoints - args.small_endpoints
+            context_window = MOCK_SMALL_CONTEXT_WINDOW_TOKENS if small else MOCK_CONTEXT_WINDOW_TOKENS
+
+            server = start_mock_server(args.latency, 1.0 if failing else args.error_rate, 503 if failing else args.error_status, 
+                                       (app.PACKED_SAMPLE_BEGIN_MARKER, app.PACKED_SAMPLE_END_MARKER), 
+                                       args.invalid_rate, "\n\n" + app.VALIDATION_FEEDBACK.split('{}')[0], context_window)
+            servers.append(server)
+
+            endpoint = {"name": f"mock{i + 1}", "api_base": f"http://127.0.0.1:{server.server_port}/", "context_window": context_window}
+            if small:
+                endpoint.update({"engine": MOCK_SMALL_ENGINE, "prompt_cost_per_1k_tokens": MOCK_SMALL_COST_PER_1K_TOKENS, "completion_cost_per_1k_tokens": MOCK_SMALL_COST_PER_1K_TOKENS})
+            else:
+                endpoint["engine"] = app.OPENAI_ENGINE
+            endpoints.append(endpoint)
+
+        # Run the whole pipeline (discovery through writing) against the mock server(s).
+        os.environ[app.OPENAI_API_KEY_VARIABLE] = MOCK_API_KEY
+        sys.argv = [APP_SCRIPT_FILE_NAME, 
+                    "-s", sample_root, "-r", "-y", "--no-cache",
+                    "-j", str(args.jobs),
+                    "-o", os.path.join(work_dir, "outputs")]
+        if 1 == len(endpoints):
+            sys.argv += ["--api-base", endpoints[0]["api_base"]]
+        else:
+            endpoints_file_name = os.path.join(work_dir, "endpoints.json")
+            with open(endpoints_file_name, "w", encoding="utf-8") as f:
+                json.dump({"endpoints": endpoints}, f)
+            sys.argv += ["--endpoints", endpoints_file_name]
+        if args.stream:
+            sys.argv.append("--stream")
+        if args.pack:
+            sys.argv += ["--pack", str(args.pack)]
+        if args.chunk:
+            sys.argv.append("--chunk")
+        if not args.validate:
+            sys.argv.append("--no-validate")
+
+        app_output = io.StringIO()
+        start_time = time.perf_counter()
+        with redirect_stdout(app_output):
+            app.main()
+        wall_time = time.perf_counter() - start_time
+
+        for server in servers:
+            server.shutdown()
+
+    migrated_samples = [metrics for metrics in app.run_metrics if metrics["status"] == app.SampleStatus.MIGRATED.value]
+    if not migrated_samples:
+        raise ValueError(f"No samples were migrated.\n{app_output.getvalue()[-2000:]}")
+
+    latencies = [metrics["total_time"] for metrics in migrated_samples]
+
+    print(f"Samples:                {args.samples} x {args.files} files x {args.file_bytes:,} bytes, {args.jobs} job(s), {args.latency * 1000:.0f} ms latency, {args.error_rate:.0%} errors{', streamed' if args.stream else ''}{f', packed by {args.pack}' if args.pack else ''}{', chunked' if args.chunk else ''}")
+    print(f"Migrated:               {len(migrated_samples)} of {args.samples} ({sum(server.request_count for server in servers)} requests, {sum(server.error_count for server in servers)} errors injected)")
+    if not args.validate:
+        print("Validation:             skipped")
+    else:
+        print(f"Validation:             {len([metrics for metrics in migrated_samples if metrics['validation'] == 'passed'])} passed, {len([metrics for metrics in migrated_samples if metrics['validation'] == 'failed'])} failed ({sum(server.invalid_count for server in servers)} invalid completions injected, {sum(metrics['regenerations'] for metrics in migrated_samples)} regenerations)")
+    print(f"Tokens:                 {sum(metrics['prompt_tokens'] for metrics in migrated_samples):,} prompt + {sum(metrics['completion_tokens'] for metrics in migrated_samples):,} completion, estimated cost ${sum(metrics['estimated_cost'] for metrics in migrated_samples):.2f}")
+    if 1 < len(servers):
+        print("Endpoints:              " + ", ".join(f"{endpoint['name']} ({endpoint['engine']}) {server.request_count} requests" for (endpoint, server) in zip(endpoints, servers)))
+    print(f"Throughput:             {len(migrated_samples) / wall_time:10.2f} samples/sec ({wall_time:.2f} s)")
+    print(f"Sample latency:         p50 {get_percentile(latencies, 50) * 1000:8.1f} ms, p99 {get_percentile(latencies, 99) * 1000:8.1f} ms")
+
+    if resource:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_memory = peak_memory / 1024 if sys.platform != "darwin" else peak_memory / (1024 * 1024)
+        print(f"Peak memory (RSS):      {peak_memory:10.1f} MB")
+
+def wait_for_serve_info(serve_info_path, server_process):
+    # The server writes its info file once it's ready for jobs.
+    deadline = time.perf_counter() + SERVE_START_TIMEOUT_SECONDS
+
+    while not os.path.exists(serve_info_path):
+        if server_process.poll() is not None:
+            raise ValueError(f"The server exited. {server_process.stderr.read().strip()}")
+        if time.perf_counter() > deadline:
+            raise ValueError("The server didn't start.")
+        time.sleep(0.05)
+
+def benchmark_serve(args):
+    # Migrates each sample with its own invocation, first cold and then submitted to a warm server.
+    app = load_app()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        sample_root = create_synthetic_samples(os.path.join(work_dir, "samples"), args.samples, args.files, args.file_bytes)
+        sample_dirs = sorted(os.path.join(group_dir.path, sample_dir.name) 
+                             for group_dir in os.scandir(sample_root) for sample_dir in os.scandir(group_dir.path))
+
+        server = start_mock_server(args.latency, 0.0, 429, (app.PACKED_SAMPLE_BEGIN_MARKER, app.PACKED_SAMPLE_END_MARKER))
+        api_base = f"http://127.0.0.1:{server.server_port}/"
+
+        # The server info file is written to the home directory, so give the runs their own.
+        home_dir = os.path.join(work_dir, "home")
+        os.makedirs(home_dir)
+        env = dict(os.environ, HOME=home_dir, USERPROFILE=home_dir)
+        env[app.OPENAI_API_KEY_VARIABLE] = MOCK_API_KEY
+
+        app_command = [sys.executable, get_app_script_path()]
+        job_args = ["-y", "--no-cache", "-o", os.path.join(work_dir, "outputs")]
+
+        cold_times = []
+        for sample_dir in sample_dirs:
+            start_time = time.perf_counter()
+            subprocess.run(app_command + ["-s", sample_dir, "--api-base", api_base] + job_args, env=env, stdout=subprocess.DEVNULL, check=True)
+            cold_times.append(time.perf_counter() - start_time)
+
+        server_process = subprocess.Popen(app_command + ["--serve", "--api-base", api_base], env=env, 
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        try:
+            wait_for_serve_info(os.path.join(home_dir, app.TOKEN_CACHE_DIRECTORY_NAME, app.SERVE_INFO_FILE_NAME), server_process)
+
+            submit_times = []
+            for sample_dir in sample_dirs:
+                start_time = time.perf_counter()
+                subprocess.run(app_command + ["-s", sample_dir, "--submit"] + job_args, env=env, stdout=subprocess.DEVNULL, check=True)
+                submit_times.append(time.perf_counter() - start_time)
+        finally:
+            server_process.terminate()
+            server_process.wait()
+            server.shutdown()
+
+    print(f"Samples:                {args.samples} x {args.files} files x {args.file_bytes:,} bytes, {args.latency * 1000:.0f} ms latency, one invocation each")
+    print(f"Cold invocation:        median {statistics.median(cold_times) * 1000:8.1f} ms, total {sum(cold_times):.2f} s")
+    print(f"Submitted to server:    median {statistics.median(submit_times) * 1000:8.1f} ms, total {sum(submit_times):.2f} s")
+    print(f"Speedup:                {sum(cold_times) / sum(submit_times):10.2f}x")
+
+def parse_args():
+    argParser = argparse.ArgumentParser()
+    subparsers = argParser.add_subparsers(dest="benchmark", required=True)
+
+    parser_args = subparsers.add_parser("parser", help="Compares the completion parser against the legacy regex scans.")
+    parser_args.add_argument("--files", type=int, default=500, help="Number of files in the synthetic completion.")
+    parser_args.add_argument("--lines", type=int, default=200, help="Number of lines per file.")
+    parser_args.add_argument("--repeat", type=int, default=5, help="Number of timed runs (the best is reported).")
+    parser_args.set_defaults(function=benchmark_parser)
+
+    startup_args = subparsers.add_parser("startup", help="Measures startup time for commands that don't call Azure OpenAI.")
+    startup_args.add_argument("--repeat", type=int, default=10, help="Number of timed runs.")
+    startup_args.add_argument("--app", help="Path of the frozen (PyInstaller) binary to measure instead of the script.")
+    startup_args.set_defaults(function=benchmark_startup)
+
+    e2e_args = subparsers.add_parser("e2e", help="Runs the whole pipeline on synthetic samples against a local stand-in for Azure OpenAI.")
+    e2e_args.add_argument("--samples", type=int, default=200, help="Number of synthetic sample directories.")
+    e2e_args.add_argument("--files", type=int, default=4, help="Number of Terraform files per sample.")
+    e2e_args.add_argument("--file-bytes", type=int, default=4096, help="Approximate size of each Terraform file.")
+    e2e_args.add_argument("--jobs", type=int, default=8, help="Number of samples to migrate concurrently.")
+    e2e_args.add_argument("--latency", type=float, default=0.2, help="Mock server latency per request (in seconds).")
+    e2e_args.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail (0-1).")
+    e2e_args.add_argument("--error-status", type=int, default=429, help="HTTP status of failed requests.")
+    e2e_args.add_argument("--invalid-rate", type=float, default=0.0, help="Fraction of (unpacked) completions with a syntax error (0-1).")
+    e2e_args.add_argument("--endpoints", type=int, default=1, help="Number of mock endpoints to route the requests across.")
+    e2e_args.add_argument("--failing-endpoints", type=int, default=0, help="Number of the endpoints that always fail (503).")
+    e2e_args.add_argument("--small-endpoints", type=int, default=0, help=f"Number of the endpoints that are a cheaper model with a {MOCK_SMALL_CONTEXT_WINDOW_TOKENS}-token context window.")
+    e2e_args.add_argument("--stream", action="store_true", help="Stream the completions.")
+    e2e_args.add_argument("--pack", type=int, default=0, help="Number of small samples to pack into a single request.")
+    e2e_args.add_argument("--chunk", action="store_true", help="Migrate samples that don't fit in the context window in chunks.")
+    e2e_args.add_argument("--no-validate", dest="validate", action="store_false", help="Don't validate the migrated samples (validation parses every file with python-hcl2 and is CPU-bound).")
+    e2e_args.set_defaults(function=benchmark_end_to_end)
+
+    serve_args = subparsers.add_parser("serve", help="Compares one cold invocation per sample against submitting each sample to a warm server.")
+    serve_args.add_argument("--samples", type=int, default=10, help="Number of synthetic sample directories.")
+    serve_args.add_argument("--files", type=int, default=4, help="Number of Terraform files per sample.")
+    serve_args.add_argument("--file-bytes", type=int, default=4096, help="Approximate size of each Terraform file.")
+    serve_args.add_argument("--latency", type=float, default=0.2, help="Mock server latency per request (in seconds).")
+    serve_args.set_defaults(function=benchmark_serve)
+
+    return argParser.parse_args()
+
+def main():
+    args = parse_args()
+
+    try:
+        args.function(args)
+    except ValueError as error:
+        print(f"Benchmark failed. {error}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
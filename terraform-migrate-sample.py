@@ -1,10 +1,10 @@
 # Build instructions:
-# pyinstaller --onefile --add-data ./prompt-inputs:./prompt-inputs migrate-terraform-sample.py
+# python terraform-migrate-sample.py --build-prompt-bundle
+# pyinstaller --onefile --add-data ./prompt-inputs/prompt-inputs.bundle.json:./prompt-inputs terraform-migrate-sample.py
 
 import sys
 import os
 from pathlib import Path
-import keyboard
 import time
 import re
 import argparse
@@ -12,34 +12,157 @@ from colorama import Fore, Back, Style
 import json
 from enum import Enum
 import shutil
-import requests
-import azure.core.exceptions
-import openai
-from azure.identity import AzureCliCredential
+import stat
+import hashlib
+import gzip
+import tempfile
+import fnmatch
+import random
+import email.utils
+import csv
+from contextlib import contextmanager
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import pickle
+import secrets
+import hmac
+
+# The Azure OpenAI modules (openai, azure.identity, azure.core, requests) are
+# slow to import, so they're imported by import_azure_openai_modules() only
+# when a command actually calls Azure OpenAI. Likewise, keyboard is imported
+# by read_key(), the optional tiktoken module by get_token_encoding(), the
+# optional hcl2 module by get_hcl_syntax_errors(), and the HTTP server and
+# client modules by serve() and submit_job().
+openai                          = None
+azure                           = None
+requests                        = None
+AzureCliCredential              = None
 
 # Azure OpenAI settings
 OPENAI_API_BASE                 = 'https://openai-content-selfserv.openai.azure.com/'
 OPENAI_VERSION                  = '2023-07-01-preview' # This may change in the future.
 OPENAI_API_TYPE                 = 'azure_ad'
 OPENAI_ENGINE                   = 'gpt-4-32k-moreExpensivePerToken'
+OPENAI_API_KEY_VARIABLE         = 'AZURE_OPENAI_API_KEY' # If set, used instead of signing in with the Azure CLI.
+OPENAI_API_TYPE_KEY             = 'azure'
+OPENAI_TOKEN_SCOPE              = 'https://cognitiveservices.azure.com/.default'
+OPENAI_TOKEN_ENCODING           = 'cl100k_base' # Tokenizer used by the GPT-4 models.
+OPENAI_CONTEXT_WINDOW_TOKENS    = 32768 # Prompt and completion tokens, gpt-4-32k.
 
 # App constants
 PROMPT_INPUT_FILE_NAME          = 'prompt-inputs/prompt-inputs.json'
-DEBUG_PROMPT_FILE_NAME          = 'prompt.json'
-DEBUG_COMPLETION_FILE_NAME      = 'completion.txt'
+PROMPT_BUNDLE_FILE_NAME         = 'prompt-inputs/prompt-inputs.bundle.json'
+PROMPT_BUNDLE_VERSION           = 1
+DEBUG_ARTIFACT_FILE_NAME        = 'debug.json'
+DEBUG_ARTIFACT_VERSION          = 1
+DEBUG_BLOB_DIRECTORY_NAME       = '.blobs'
+DEBUG_BLOB_FILE_EXTENSION       = '.gz'
 MAX_SAMPLES_TO_PRINT            = 5
 OUTPUT_DIRECTORY_NAME           = 'outputs'
 TEMP_DIRECTORY_NAME             = 'temp'
+CACHE_DIRECTORY_NAME            = 'cache'
+CACHE_FILE_EXTENSION            = '.completion'
+MAX_CACHE_SIZE_BYTES            = 100 * 1024 * 1024
 TEST_RECORD_FILE_NAME           = 'TestRecord.md'
+DEFAULT_SOURCE_GLOBS            = ['*.tf', '*.tfvars', 'README*']
+DEFAULT_MAX_SOURCE_FILE_BYTES   = 256 * 1024
+BINARY_CHECK_BYTES              = 8192
+HCL_TOKEN_PATTERN               = re.compile(r'"(?:\\.|[^"\\])*"?|#|//|/\*|<<-?[A-Za-z_][\w-]*|[{}\[\]()]|[^\s"#/<{}\[\]()]+|[/<]') # Strings, comments, heredocs, brackets and other code.
+CHUNK_TOKEN_MARGIN              = 1024 # Room for the chat format and the variance of the completion size.
+CHUNK_MIN_TOKENS                = 1024 # With less room for its blocks, a sample would be split into a chunk per block.
+CHUNK_CONTEXT_BLOCK_TYPES       = ['terraform', 'provider'] # Sent with every chunk.
+CHUNK_DEPENDENCY_BLOCK_TYPES    = ['variable', 'locals'] # Sent with the chunks that use them.
+DEBUG_CHUNK_ARTIFACT_FILE_NAME  = 'debug.chunk{}.json'
+EXPECTED_SAMPLE_FILES           = ['main.tf', 'variables.tf', 'outputs.tf', 'providers.tf']
+VALIDATED_FILE_EXTENSIONS       = ('.tf', '.tfvars')
+DEFAULT_VALIDATION_RETRIES      = 1
+VALIDATION_FEEDBACK             = ("Attempt {} at migrating this sample had the following problems. Migrate the sample again, "
+                                   "returning every file in the same format and fixing these problems:")
+STREAM_PROGRESS_INTERVAL        = 250
+RUN_MANIFEST_FILE_NAME          = 'manifest.json'
+RUN_MANIFEST_VERSION            = 1
+RUN_MANIFEST_SAVE_SECONDS       = 2 # Sample state changes are saved at most this often (and at the end of the run).
+SHARD_FILE_NAME                 = 'shard.json' # The samples assigned to a --shard run, next to its manifest.
+SHARD_PATTERN                   = re.compile(r'^(\d+)/(\d+)$')
+DEFAULT_JOBS                    = 1
+MAX_REQUEST_ATTEMPTS            = 6
+INITIAL_BACKOFF_SECONDS         = 2
+MAX_BACKOFF_SECONDS             = 60
+RATE_WINDOW_SECONDS             = 60
+ENDPOINT_COOLDOWN_SECONDS       = 30 # A failing endpoint is skipped for this long, doubling with each consecutive failure.
+MAX_ENDPOINT_COOLDOWN_SECONDS   = 300
+PROMPT_COST_PER_1K_TOKENS       = 0.06 # USD, gpt-4-32k. See the pricing article in confirm_plan().
+COMPLETION_COST_PER_1K_TOKENS   = 0.12 # USD, gpt-4-32k.
+RUN_REPORT_FILE_NAME_PREFIX     = 'run-report-'
+RUN_REPORT_STAGES               = ['source', 'rate_wait', 'network', 'parse', 'write']
+FILE_OUTCOMES                   = ['added', 'changed', 'unchanged', 'removed']
+TOKEN_CACHE_DIRECTORY_NAME      = '.terraform-migrate-sample'
+TOKEN_CACHE_FILE_NAME           = 'token.json'
+TOKEN_REFRESH_MARGIN_SECONDS    = 5 * 60
+SERVE_INFO_FILE_NAME            = 'serve.json' # The address and access token of the running server, next to the token cache.
+SERVE_HOST                      = '127.0.0.1'
+SERVE_JOBS_PATH                 = '/jobs'
+DEFAULT_IGNORE_GLOBS            = ['.git', '.terraform', '.terragrunt-cache']
+DEFAULT_MAX_EXAMPLES            = 3
+DEFAULT_EXAMPLE_TOKEN_BUDGET    = 16000
+CHARACTERS_PER_TOKEN            = 4 # Estimate used when tiktoken isn't available.
+TOKENS_PER_MESSAGE              = 3 # Chat format overhead of each prompt message.
+TOKENS_PER_REPLY                = 3 # Chat format overhead of priming the reply.
+ESTIMATED_REQUEST_SECONDS       = 5 # Time to first token, used to estimate the run's wall time.
+ESTIMATED_COMPLETION_TOKENS_PER_SECOND = 20
+PACK_SAMPLE_MAX_TOKENS          = 1000 # Only samples up to this size are packed.
+PACK_MAX_TOKENS                 = 6000 # Maximum size of the samples packed into a single request.
+PACKED_SAMPLE_BEGIN_MARKER      = '=== sample {} ==='
+PACKED_SAMPLE_END_MARKER        = '=== end of sample {} ==='
+PACKED_PROMPT_INSTRUCTIONS      = ("The following are {} separate samples. Each sample begins with a '=== sample N ===' line "
+                                   "and ends with a '=== end of sample N ===' line. Migrate each sample separately as above "
+                                   "and write each migrated sample between the same lines.")
 
 # App globals
 sample_root_path                = ''
 directories_to_process          = []
+discovery_complete              = False
+discovery_time                  = 0.0
 sample_inputs_source            = []
 sample_outputs_source           = []
+sample_inputs_names             = []
+sample_inputs_features          = []
+sample_examples_token_counts    = []
+max_examples                    = DEFAULT_MAX_EXAMPLES
+example_token_budget            = DEFAULT_EXAMPLE_TOKEN_BUDGET
+concurrent_jobs                 = DEFAULT_JOBS
+source_include_globs            = DEFAULT_SOURCE_GLOBS
+max_source_file_bytes           = DEFAULT_MAX_SOURCE_FILE_BYTES
+sample_estimates                = {}
+shard_info                      = None # Set when migrating a single shard.
+token_encoding                  = None # False if tiktoken isn't available.
+token_encoding_lock             = threading.Lock()
 debug_mode                      = False
 output_path                     = ''
 temp_path                       = ''
+cache_path                      = ''
+cache_enabled                   = True
+streaming_enabled               = False
+chunking_enabled                = False
+cache_lock                      = threading.Lock()
+run_manifest                    = {}
+run_manifest_lock               = threading.Lock()
+run_manifest_save_lock          = threading.Lock()
+run_manifest_dirty              = False # The manifest has changes that haven't been saved.
+run_manifest_save_time          = 0.0
+prefetched_completions          = {}
+prefetch_lock                   = threading.Lock()
+endpoint_router                 = None
+token_provider                  = None
+metrics_context                 = threading.local()
+run_metrics                     = []
+run_metrics_lock                = threading.Lock()
+print_lock                      = threading.Lock()
+message_sink                    = None # Set while a server runs a job.
+new_file_mode                   = 0o644
 
 class AppMode(Enum):
     PROCESS_ALL_SAMPLES_WITHOUT_INTERRUPTION    = 1
@@ -47,6 +170,11 @@ class AppMode(Enum):
 
 app_mode = AppMode.CONFIRM_CONTINUE_AFTER_EACH_SAMPLE
 
+class SampleStatus(str, Enum):
+    IN_PROGRESS = 'in_progress'
+    MIGRATED    = 'migrated'
+    FAILED      = 'failed'
+
 class PrintDisposition(Enum):
     SUCCESS = 1
     WARNING = 2
@@ -55,6 +183,359 @@ class PrintDisposition(Enum):
     DEBUG   = 5
     STATUS  = 6
 
+class RateController:
+    # Client-side rate control for the Azure OpenAI deployment. Each request
+    # waits for a slot within the concurrency limit and the requests-per-minute
+    # and tokens-per-minute quotas. The concurrency limit grows by one after
+    # each limit's worth of successful requests and halves whenever a request
+    # is throttled (AIMD), so a batch settles at the throughput the quota allows.
+
+    def __init__(self, max_concurrency, requests_per_minute = None, tokens_per_minute = None):
+        self.condition              = threading.Condition()
+        self.max_concurrency        = max_concurrency
+        self.concurrency_limit      = float(max_concurrency)
+        self.requests_per_minute    = requests_per_minute
+        self.tokens_per_minute      = tokens_per_minute
+        self.in_flight              = 0
+        self.paused_until           = 0.0
+
+        # Each entry is [send_time, tokens] for a request sent within the last RATE_WINDOW_SECONDS.
+        self.window                 = deque()
+        self.window_tokens          = 0
+
+    def prune_window(self, now):
+        while self.window and now - self.window[0][0] >= RATE_WINDOW_SECONDS:
+            self.window_tokens -= self.window.popleft()[1]
+
+    def get_wait_time(self, tokens, now):
+        # Returns how long the request must wait for the quotas (0 or less if it can be sent now).
+        wait_time = self.paused_until - now
+
+        if self.window:
+            window_reset_time = self.window[0][0] + RATE_WINDOW_SECONDS - now
+
+            if self.requests_per_minute and len(self.window) >= self.requests_per_minute:
+                wait_time = max(wait_time, window_reset_time)
+
+            # A request larger than the whole quota is sent once the window is empty.
+            if self.tokens_per_minute and self.window_tokens + tokens > self.tokens_per_minute:
+                wait_time = max(wait_time, window_reset_time)
+
+        return wait_time
+
+    def get_available_fraction(self, tokens):
+        # Returns the smallest fraction of the concurrency limit and quotas that's left after
+        # sending a request of this size now, or 0 if the request would have to wait.
+        with self.condition:
+            now = time.monotonic()
+            self.prune_window(now)
+
+            if self.in_flight >= int(self.concurrency_limit) or self.get_wait_time(tokens, now) > 0:
+                return 0.0
+
+            fractions = [1 - self.in_flight / self.concurrency_limit]
+            if self.requests_per_minute:
+                fractions.append(1 - len(self.window) / self.requests_per_minute)
+            if self.tokens_per_minute:
+                fractions.append(1 - (self.window_tokens + tokens) / self.tokens_per_minute)
+
+            return max(0.0, min(fractions))
+
+    def get_estimated_wait_time(self, tokens):
+        with self.condition:
+            now = time.monotonic()
+            self.prune_window(now)
+            return max(0.0, self.get_wait_time(tokens, now))
+
+    def acquire(self, tokens):
+        # Blocks until the request can be sent and returns its window entry.
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.prune_window(now)
+
+                if self.in_flight >= int(self.concurrency_limit):
+                    self.condition.wait()
+                    continue
+
+                wait_time = self.get_wait_time(tokens, now)
+                if wait_time <= 0:
+                    break
+
+                self.condition.wait(wait_time)
+
+            self.in_flight += 1
+
+            entry = [now, tokens]
+            self.window.append(entry)
+            self.window_tokens += tokens
+
+            return entry
+
+    def release(self, entry, succeeded, actual_tokens = None, throttled = False, retry_after = None):
+        with self.condition:
+            now = time.monotonic()
+            self.prune_window(now)
+
+            self.in_flight -= 1
+
+            # Replace the estimate with the actual usage if the request is still in the window.
+            if actual_tokens is not None and now - entry[0] < RATE_WINDOW_SECONDS:
+                self.window_tokens += actual_tokens - entry[1]
+                entry[1] = actual_tokens
+
+            if throttled:
+                self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+                print_message(f"Throttled by Azure OpenAI. Concurrency limit: {int(self.concurrency_limit)}", PrintDisposition.DEBUG)
+            elif succeeded:
+                self.concurrency_limit = min(float(self.max_concurrency), self.concurrency_limit + 1 / self.concurrency_limit)
+
+            self.condition.notify_all()
+
+class AccessTokenProvider:
+    # Provides the Azure AD access token for Azure OpenAI. The token is cached
+    # on disk (readable only by the current user) so that later runs don't
+    # have to call the Azure CLI, and it's refreshed in the background shortly
+    # before it expires so that long runs never send an expired token.
+
+    def __init__(self, cache_file_name):
+        self.lock               = threading.Lock()
+        self.refresh_lock       = threading.Lock() # Held while calling the Azure CLI, so that only one thread calls it.
+        self.cache_file_name    = cache_file_name
+        self.token              = None
+        self.expires_on         = 0
+        self.refreshing         = False
+
+    def get_token(self):
+        with self.lock:
+            remaining_time = self.expires_on - time.time()
+
+            if self.token and remaining_time > TOKEN_REFRESH_MARGIN_SECONDS:
+                return self.token
+
+            # The token expires soon, so refresh it without holding up the current request.
+            if self.token and remaining_time > 0:
+                if not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(target=self.refresh_token_in_background, daemon=True).start()
+                return self.token
+
+        # There is no usable token, so wait for a new one. Once this thread has the refresh lock,
+        # another thread may already have refreshed the token.
+        with self.refresh_lock:
+            with self.lock:
+                if self.token and self.expires_on - time.time() > 0:
+                    return self.token
+
+            self.refresh_token()
+
+        with self.lock:
+            return self.token
+
+    def load_cached_token(self):
+        # Returns True if the cached token can be used.
+        try:
+            with open(self.cache_file_name, encoding="utf-8") as f:
+                cached_token = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as error:
+            print_message(f"Ignoring unreadable token cache ({self.cache_file_name}). {error}", PrintDisposition.DEBUG)
+            return False
+
+        if (cached_token.get("scope") != OPENAI_TOKEN_SCOPE
+        or cached_token.get("expires_on", 0) - time.time() <= TOKEN_REFRESH_MARGIN_SECONDS):
+            return False
+
+        with self.lock:
+            self.token      = cached_token["token"]
+            self.expires_on = cached_token["expires_on"]
+
+        print_message(f"Using cached access token (expires {time.strftime('%H:%M:%S', time.localtime(self.expires_on))}).", PrintDisposition.DEBUG)
+        return True
+
+    def save_cached_token(self, token, expires_on):
+        try:
+            cache_dir = os.path.dirname(self.cache_file_name)
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+            # The file is readable and writable only by the current user.
+            write_file_atomically(self.cache_file_name, json.dumps({"scope": OPENAI_TOKEN_SCOPE, "token": token, "expires_on": expires_on}))
+        except OSError as error:
+            print_message(f"Failed to cache access token: {error}", PrintDisposition.WARNING)
+
+    def refresh_token(self):
+        print_message("Getting access token from the Azure CLI...", PrintDisposition.DEBUG)
+
+        try:
+            credential = AzureCliCredential()
+
+            # If AzureCliCredential.get_token() fails, it prints its own error message.
+            # So, set color to RED just in case before the call.
+            print(Fore.RED, end='')
+            access_token = credential.get_token(OPENAI_TOKEN_SCOPE)
+            print(Style.RESET_ALL, end='', flush=True)
+        except azure.identity.CredentialUnavailableError as error:
+            # Don't send any text in the exception as AzureCliCredential.get_token() 
+            # has already printed its own error message.
+            raise ValueError(f"") from error
+        except azure.core.exceptions.ClientAuthenticationError as error:
+            # Don't send any text in the exception as AzureCliCredential.get_token() 
+            # has already printed its own error message.
+            raise ValueError(f"") from error
+
+        with self.lock:
+            self.token      = access_token.token
+            self.expires_on = access_token.expires_on
+
+        self.save_cached_token(access_token.token, access_token.expires_on)
+
+    def refresh_token_in_background(self):
+        try:
+            with self.refresh_lock:
+                # A request that had no usable token may have refreshed it already.
+                with self.lock:
+                    if self.expires_on - time.time() > TOKEN_REFRESH_MARGIN_SECONDS:
+                        return
+
+                self.refresh_token()
+        except Exception as error:
+            # Keep using the current token; the next request tries again.
+            print_message(f"Failed to refresh access token. {error}", PrintDisposition.WARNING)
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+class ApiKeyProvider:
+    # Provides a fixed API key in place of an access token.
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+
+    def get_token(self):
+        return self.api_key
+
+class Endpoint:
+    # An Azure OpenAI deployment that requests can be routed to. Each endpoint has
+    # its own model, quotas (rate controller), credentials and health.
+
+    def __init__(self, name, api_base, engine, api_version, context_window, 
+                 prompt_cost_per_1k_tokens, completion_cost_per_1k_tokens, weight, rate_controller, api_key_variable = None):
+        self.name                           = name
+        self.api_base                       = api_base
+        self.engine                         = engine
+        self.api_version                    = api_version
+        self.context_window                 = context_window
+        self.prompt_cost_per_1k_tokens      = prompt_cost_per_1k_tokens
+        self.completion_cost_per_1k_tokens  = completion_cost_per_1k_tokens
+        self.weight                         = weight
+        self.rate_controller                = rate_controller
+        self.api_key_variable               = api_key_variable
+        self.api_type                       = OPENAI_API_TYPE
+        self.token_provider                 = None # Set by init_azure_openai().
+        self.failure_count                  = 0 # Consecutive failures.
+        self.unhealthy_until                = 0.0
+        self.usage                          = {"requests": 0, "failures": 0, "prompt_tokens": 0, "completion_tokens": 0, "estimated_cost": 0.0}
+
+    def get_cost(self, prompt_tokens, completion_tokens):
+        return (prompt_tokens * self.prompt_cost_per_1k_tokens + completion_tokens * self.completion_cost_per_1k_tokens) / 1000
+
+    def get_request_settings(self):
+        # The settings passed to each openai.ChatCompletion.create() call.
+        return {"engine": self.engine,
+                "api_base": self.api_base,
+                "api_version": self.api_version,
+                "api_type": self.api_type,
+                "api_key": self.token_provider.get_token()}
+
+class EndpointRouter:
+    # Routes each request to the cheapest model whose context window fits the request.
+    # Within that tier, requests are spread across the endpoints by weight and remaining
+    # quota, and an endpoint that fails is skipped (for an exponentially growing cooldown)
+    # while any other endpoint can take the request.
+
+    def __init__(self, endpoints):
+        self.lock               = threading.Lock()
+        self.endpoints          = endpoints
+        self.max_context_window = max(endpoint.context_window for endpoint in endpoints)
+
+    def get_engines(self):
+        # Identifies the models that completions can come from (such as for the completion cache).
+        return ','.join(sorted(set(endpoint.engine for endpoint in self.endpoints)))
+
+    def get_fitting_endpoints(self, tokens, min_context_window = 0):
+        return [endpoint for endpoint in self.endpoints if endpoint.context_window >= max(tokens, min_context_window)]
+
+    def get_tier_endpoint(self, prompt_tokens, completion_tokens):
+        # Returns the (cheapest) endpoint that a request of this size is routed to when every endpoint is healthy.
+        endpoints = self.get_fitting_endpoints(prompt_tokens + completion_tokens)
+        if not endpoints:
+            return max(self.endpoints, key=lambda endpoint: endpoint.context_window)
+
+        return min(endpoints, key=lambda endpoint: endpoint.get_cost(prompt_tokens, completion_tokens))
+
+    def select(self, prompt_tokens, completion_tokens, min_context_window = 0):
+        tokens = prompt_tokens + completion_tokens
+
+        with self.lock:
+            endpoints = self.get_fitting_endpoints(tokens, min_context_window)
+            if not endpoints:
+                raise ValueError(f"The request ({tokens} tokens) doesn't fit in the context window of any endpoint (at most {self.max_context_window} tokens).")
+
+            # If every endpoint that fits is unhealthy, try the one that failed longest ago.
+            now = time.monotonic()
+            endpoints = ([endpoint for endpoint in endpoints if endpoint.unhealthy_until <= now] 
+                         or [min(endpoints, key=lambda endpoint: endpoint.unhealthy_until)])
+
+            min_cost = min(endpoint.get_cost(prompt_tokens, completion_tokens) for endpoint in endpoints)
+            endpoints = [endpoint for endpoint in endpoints if endpoint.get_cost(prompt_tokens, completion_tokens) == min_cost]
+
+            weights = [endpoint.weight * endpoint.rate_controller.get_available_fraction(tokens) for endpoint in endpoints]
+            if sum(weights) > 0:
+                return random.choices(endpoints, weights)[0]
+
+            # Every endpoint in the tier is at its limits, so wait for the one that frees up first.
+            return min(endpoints, key=lambda endpoint: endpoint.rate_controller.get_estimated_wait_time(tokens))
+
+    def has_alternative(self, failed_endpoint, tokens, min_context_window = 0):
+        # Returns True if a healthy endpoint other than failed_endpoint can take the request.
+        with self.lock:
+            now = time.monotonic()
+            return any(endpoint is not failed_endpoint and endpoint.unhealthy_until <= now 
+                       for endpoint in self.get_fitting_endpoints(tokens, min_context_window))
+
+    def record_success(self, endpoint):
+        with self.lock:
+            endpoint.usage["requests"] += 1
+            endpoint.failure_count = 0
+            endpoint.unhealthy_until = 0.0
+
+    def record_failure(self, endpoint, unhealthy):
+        with self.lock:
+            endpoint.usage["requests"] += 1
+            endpoint.usage["failures"] += 1
+
+            if unhealthy:
+                endpoint.failure_count += 1
+                cooldown = min(MAX_ENDPOINT_COOLDOWN_SECONDS, ENDPOINT_COOLDOWN_SECONDS * 2 ** (endpoint.failure_count - 1))
+                endpoint.unhealthy_until = time.monotonic() + cooldown
+
+        if unhealthy and 1 < len(self.endpoints):
+            print_message(f"Endpoint '{endpoint.name}' failed. Skipping it for {cooldown} seconds.", PrintDisposition.WARNING)
+
+    def reset_usage(self):
+        with self.lock:
+            for endpoint in self.endpoints:
+                endpoint.usage = {name: 0 for name in endpoint.usage}
+
+    def record_usage(self, endpoint, prompt_tokens, completion_tokens):
+        with self.lock:
+            endpoint.usage["prompt_tokens"] += prompt_tokens
+            endpoint.usage["completion_tokens"] += completion_tokens
+            endpoint.usage["estimated_cost"] += endpoint.get_cost(prompt_tokens, completion_tokens)
+
 def print_message(text = '', disp = PrintDisposition.STATUS, override_indent = False):
 
     if disp == PrintDisposition.DEBUG and not debug_mode:
@@ -76,94 +557,859 @@ def print_message(text = '', disp = PrintDisposition.STATUS, override_indent = F
     else: # disp == PrintDisposition.STATUS
         color = Fore.WHITE
 
-    print(color + text + Style.RESET_ALL, flush=True)
+    # Samples can be migrated concurrently, so serialize output to avoid interleaved lines.
+    with print_lock:
+        # A server sends the messages of the job it's running to the job's client.
+        if message_sink is not None:
+            message_sink(text, disp)
+            return
+
+        print(color + text + Style.RESET_ALL, flush=True)
 
-def write_file(file_name, contents):
+def write_file_atomically(file_name, data, mode = None):
+    # Writes the data (bytes, or text that's written as UTF-8) to a temp file and renames it over the file,
+    # so that a reader never sees a partial file and an interrupted run never leaves one. mkstemp creates
+    # the file readable and writable only by the current user, unless mode is specified.
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+
+    (fd, temp_file_name) = tempfile.mkstemp(dir=os.path.dirname(file_name), prefix=f".{os.path.basename(file_name)}.", suffix=".tmp")
     try:
-        with open(file_name, "w") as f:
-            f.write(contents)
-    except OSError as error:
-        print_message(f"Failed to write file: {error}", PrintDisposition.ERROR)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(temp_file_name, mode)
+        os.replace(temp_file_name, file_name)
+    except BaseException:
+        try:
+            os.remove(temp_file_name)
+        except OSError:
+            pass
+        raise
 
 def write_dictionary_to_file(file_name, dictionary):
+    # Raises OSError if the file can't be written. The file gets the usual permissions (like the sample files).
+    write_file_atomically(file_name, json.dumps(dictionary, indent=4), new_file_mode)
+
+def get_debug_blob_path(blob_hash):
+    return os.path.join(temp_path, DEBUG_BLOB_DIRECTORY_NAME, blob_hash + DEBUG_BLOB_FILE_EXTENSION)
+
+def write_debug_blob(contents):
+    # Debug artifacts are stored as compressed blobs named by the hash of their contents,
+    # so the few-shot examples shared by every prompt are stored once. Returns the hash.
+    data = contents.encode("utf-8")
+    blob_hash = hashlib.sha256(data).hexdigest()
+    blob_path = get_debug_blob_path(blob_hash)
+
+    # An existing blob is touched so that collect_debug_blobs() knows it's still in use.
     try:
-        with open(file_name, "w") as f:
-            f.write(json.dumps(dictionary, indent=4))
+        os.utime(blob_path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        # A concurrent writer of the same blob never sees a partial blob.
+        write_file_atomically(blob_path, gzip.compress(data, mtime=0))
+
+    return blob_hash
+
+def is_debug_artifact_file(file_name):
+    return file_name == DEBUG_ARTIFACT_FILE_NAME or fnmatch.fnmatch(file_name, DEBUG_CHUNK_ARTIFACT_FILE_NAME.format('*'))
+
+def collect_debug_blobs(start_time):
+    # Deletes the blobs that no debug artifact refers to anymore (such as those of regenerated samples).
+    # Blobs written or reused since start_time are kept, in case another run is about to refer to them.
+    blob_path = os.path.join(temp_path, DEBUG_BLOB_DIRECTORY_NAME)
+    if not os.path.isdir(blob_path):
+        return
+
+    referenced_blobs = set()
+
+    for (dir_path, dir_names, file_names) in os.walk(temp_path):
+        if dir_path == temp_path and DEBUG_BLOB_DIRECTORY_NAME in dir_names:
+            dir_names.remove(DEBUG_BLOB_DIRECTORY_NAME)
+
+        for file_name in filter(is_debug_artifact_file, file_names):
+            try:
+                with open(os.path.join(dir_path, file_name), encoding="utf-8") as f:
+                    artifact = json.load(f)
+                referenced_blobs.update(message["content"] for message in artifact["messages"])
+                if "completion" in artifact:
+                    referenced_blobs.add(artifact["completion"])
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                # Without all of the references, any blob might still be in use.
+                print_message(f"Not collecting debug blobs, because a debug artifact can't be read ({os.path.join(dir_path, file_name)}). {error}", PrintDisposition.WARNING)
+                return
+
+    deleted_count = 0
+
+    with os.scandir(blob_path) as entries:
+        for entry in entries:
+            blob_hash = entry.name[:-len(DEBUG_BLOB_FILE_EXTENSION)]
+            try:
+                if (entry.name.endswith(DEBUG_BLOB_FILE_EXTENSION) and blob_hash not in referenced_blobs 
+                and entry.stat().st_mtime < start_time):
+                    os.remove(entry.path)
+                    deleted_count += 1
+            except OSError as error:
+                print_message(f"Failed to delete debug blob: {error}", PrintDisposition.WARNING)
+
+    print_message(f"Deleted {deleted_count} unreferenced debug blob(s).", PrintDisposition.DEBUG)
+
+def read_debug_blob(blob_hash):
+    try:
+        with open(get_debug_blob_path(blob_hash), "rb") as f:
+            return gzip.decompress(f.read()).decode("utf-8")
+    except (OSError, EOFError) as error:
+        raise ValueError(f"Failed to read debug blob '{blob_hash}'. {error}") from error
+
+def write_debug_artifact(sample_dir, messages, completion = None, artifact_file_name = DEBUG_ARTIFACT_FILE_NAME):
+    # Write the sample's prompt (and completion, once it's available) as references to blobs.
+    artifact_file_name = os.path.join(get_normalized_path(sample_dir, temp_path), artifact_file_name)
+    print_message(f"Writing debug artifact: {artifact_file_name}...", PrintDisposition.DEBUG)
+
+    try:
+        artifact = {"version": DEBUG_ARTIFACT_VERSION,
+                    "messages": [{"role": message["role"], "content": write_debug_blob(message["content"])} for message in messages]}
+        if completion is not None:
+            artifact["completion"] = write_debug_blob(completion)
+
+        os.makedirs(os.path.dirname(artifact_file_name), exist_ok=True)
+        write_dictionary_to_file(artifact_file_name, artifact)
     except OSError as error:
-        print_message(f"Failed to write file: {error}", PrintDisposition.ERROR)
+        raise ValueError(f"Failed to write debug artifact. {error}") from error
 
-def generate_new_sample(sample_dir):
-    print_message(f"\nGenerating new sample...", PrintDisposition.DEBUG, override_indent=True)
+def show_debug_prompt(args):
+    # Print the exact prompt (in the format that's sent to Azure OpenAI) recorded for a sample by a --debug run.
+    global sample_root_path, temp_path
+    sample_root_path = os.path.abspath(args.sample_directory)
+    temp_path = os.path.join(get_application_path(), TEMP_DIRECTORY_NAME)
 
-    completion = ''
+    sample_temp_path = get_normalized_path(os.path.abspath(args.show_prompt), temp_path)
+
+    # A sample that was migrated in chunks has a prompt for each chunk.
+    if args.show_prompt_chunk is None:
+        artifact_file_name = os.path.join(sample_temp_path, DEBUG_ARTIFACT_FILE_NAME)
+        chunk_count = len([file_name for file_name in os.listdir(sample_temp_path) if is_debug_artifact_file(file_name) and file_name != DEBUG_ARTIFACT_FILE_NAME]) if os.path.isdir(sample_temp_path) else 0
+        if chunk_count and not os.path.exists(artifact_file_name):
+            raise ValueError(f"'{args.show_prompt}' was migrated in {chunk_count} chunks. Use --show-prompt-chunk N (1 to {chunk_count}) to print a chunk's prompt.")
+    else:
+        artifact_file_name = os.path.join(sample_temp_path, DEBUG_CHUNK_ARTIFACT_FILE_NAME.format(args.show_prompt_chunk))
 
     try:
-        messages = []
+        with open(artifact_file_name, encoding="utf-8") as f:
+            artifact = json.load(f)
+    except (OSError, ValueError) as error:
+        raise ValueError(f"Failed to read the debug artifact for '{args.show_prompt}' (was it migrated with --debug?). {error}") from error
 
-        # for every item in sample_inputs_source...
-        for i in range(len(sample_inputs_source)):
-            messages.append({"role": "user", "content": sample_inputs_source[i]})
-            messages.append({"role": "assistant", "content": sample_outputs_source[i]})
+    if artifact.get("version") != DEBUG_ARTIFACT_VERSION:
+        raise ValueError(f"Unsupported debug artifact version: {artifact.get('version')}")
 
-        sample_source = get_terraform_source_code(sample_dir, include_file_names=False)
-        messages.append({"role": "user", "content": sample_source})
+    messages = [{"role": message["role"], "content": read_debug_blob(message["content"])} for message in artifact["messages"]]
 
-        if debug_mode: # Write the prompt to a file.
-            curr_sample_temp_path = get_normalized_path(sample_dir, temp_path)
-            curr_sample_temp_path = os.path.join(curr_sample_temp_path, DEBUG_PROMPT_FILE_NAME)
-            print_message(f"Prompt file path: {curr_sample_temp_path}", PrintDisposition.DEBUG)
+    # Print without color so that the output can be redirected to a file.
+    print(json.dumps(messages, indent=4))
 
-            try:
-                print_message(f"Creating directory path: {curr_sample_temp_path}", PrintDisposition.DEBUG)
-                os.makedirs(os.path.dirname(curr_sample_temp_path),exist_ok=True)
+def get_completion_cache_key(messages):
+    # The key covers everything that determines the completion: the exact
+    # messages (few-shot pairs + sample source), the engine, and the API version.
+    key_source = json.dumps({"engine": endpoint_router.get_engines(), 
+                             "version": OPENAI_VERSION, 
+                             "messages": messages}, 
+                            sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
 
-                print_message(f"Writing Azure OpenAI prompt to: {curr_sample_temp_path}...", PrintDisposition.DEBUG)
-                write_dictionary_to_file(curr_sample_temp_path, messages)
-            except OSError as error:
-                raise ValueError(f"Failed to create temp directory. {error}") from error
+def get_cached_completion(messages):
+    if not cache_enabled:
+        return None
 
-        special_chars = '\n'
-        if debug_mode:
-            special_chars = special_chars + '\t'
-        print_message(f"{special_chars}Calling OpenAI for: '{sample_dir}'...")
-        time.sleep(1)
-
-        response = openai.ChatCompletion.create(engine=OPENAI_ENGINE,
-                                                messages=messages,
-                                                temperature=0
-                                                )
-                                                
-        if response:
-            completion = response['choices'][0]['message']['content']
+    cache_file_name = os.path.join(cache_path, get_completion_cache_key(messages) + CACHE_FILE_EXTENSION)
+
+    try:
+        completion = get_file_contents(cache_file_name)
+    except FileNotFoundError:
+        print_message(f"Completion cache miss: {cache_file_name}", PrintDisposition.DEBUG)
+        return None
+    except (OSError, UnicodeDecodeError) as error:
+        print_message(f"Failed to read cached completion: {error}", PrintDisposition.WARNING)
+        return None
+
+    # Touch the entry so that it's the most recently used when evicting.
+    try:
+        os.utime(cache_file_name)
+    except OSError:
+        pass
+
+    print_message(f"Completion cache hit: {cache_file_name}", PrintDisposition.DEBUG)
+    return completion
+
+def cache_completion(messages, completion):
+    if not cache_enabled or not completion:
+        return
+
+    cache_file_name = os.path.join(cache_path, get_completion_cache_key(messages) + CACHE_FILE_EXTENSION)
+    print_message(f"Caching completion: {cache_file_name}", PrintDisposition.DEBUG)
+
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+
+        # A concurrent reader never sees a partial entry.
+        write_file_atomically(cache_file_name, completion)
     except OSError as error:
-        print_message(f"Failed to generate new sample. {error}", PrintDisposition.ERROR)
+        print_message(f"Failed to cache completion: {error}", PrintDisposition.WARNING)
+        return
 
-    time.sleep(1)
+    evict_cached_completions()
 
-    if debug_mode: # Write the completion to a file.
-        curr_sample_temp_path = get_normalized_path(sample_dir, temp_path)
-        curr_sample_temp_path = os.path.join(curr_sample_temp_path, DEBUG_COMPLETION_FILE_NAME)
-        print_message(f"Completion file path: {curr_sample_temp_path}", PrintDisposition.DEBUG)
+def uncache_completion(messages):
+    if not cache_enabled:
+        return
 
-        try:
-            print_message(f"Creating directory path: {curr_sample_temp_path}", PrintDisposition.DEBUG)
-            os.makedirs(os.path.dirname(curr_sample_temp_path),exist_ok=True)
+    cache_file_name = os.path.join(cache_path, get_completion_cache_key(messages) + CACHE_FILE_EXTENSION)
+
+    try:
+        os.remove(cache_file_name)
+        print_message(f"Deleted cached completion: {cache_file_name}", PrintDisposition.DEBUG)
+    except FileNotFoundError:
+        pass
+    except OSError as error:
+        print_message(f"Failed to delete cached completion: {error}", PrintDisposition.WARNING)
+
+def uncache_sample_completions(sample_dir):
+    # Deletes the cached completions of a sample that failed validation so that the next run doesn't reuse them.
+    chunk_sources = get_sample_chunks(sample_dir) if chunking_enabled else None
+    sample_sources = [get_chunk_sample_source(chunk_source) for chunk_source in chunk_sources] if chunk_sources else [None]
 
-            print_message(f"Writing Azure OpenAI completion to: {curr_sample_temp_path}...", PrintDisposition.DEBUG)
-            write_file(curr_sample_temp_path, completion)
+    for sample_source in sample_sources:
+        uncache_completion(get_prompt_messages(sample_dir, sample_source))
+
+def evict_cached_completions():
+    # Delete the least recently used entries until the cache fits in MAX_CACHE_SIZE_BYTES.
+    with cache_lock:
+        try:
+            entries = [entry for entry in os.scandir(cache_path) 
+                       if entry.is_file() and entry.name.endswith(CACHE_FILE_EXTENSION)]
+            entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries]
         except OSError as error:
-            raise ValueError(f"Failed to create temp directory. {error}") from error
-    
+            print_message(f"Failed to scan completion cache: {error}", PrintDisposition.WARNING)
+            return
+
+        cache_size = sum(size for (_, size, _) in entries)
+
+        for (_, size, path) in sorted(entries):
+            if cache_size <= MAX_CACHE_SIZE_BYTES:
+                break
+
+            print_message(f"Evicting cached completion: {path}", PrintDisposition.DEBUG)
+            try:
+                os.remove(path)
+                cache_size -= size
+            except OSError as error:
+                print_message(f"Failed to evict cached completion: {error}", PrintDisposition.WARNING)
+
+def get_token_encoding():
+    # tiktoken is optional. Without it, token counts are estimated from the text length.
+    # The first use of an encoding downloads it, so it's also unavailable when offline.
+    global token_encoding
+
+    with token_encoding_lock:
+        if token_encoding is None:
+            try:
+                import tiktoken
+            except ImportError:
+                token_encoding = False
+                print_message("tiktoken isn't installed. Estimating token counts.", PrintDisposition.DEBUG)
+                return token_encoding
+
+            try:
+                token_encoding = tiktoken.get_encoding(OPENAI_TOKEN_ENCODING)
+                print_message(f"Counting tokens with tiktoken ({OPENAI_TOKEN_ENCODING}).", PrintDisposition.DEBUG)
+            except Exception as error:
+                token_encoding = False
+                print_message(f"Failed to load the tiktoken encoding ({OPENAI_TOKEN_ENCODING}). Estimating token counts. {error}", PrintDisposition.WARNING)
+
+    return token_encoding
+
+def count_tokens(text):
+    # Count tokens locally with the model's tokenizer (or estimate them if tiktoken isn't available).
+    encoding = get_token_encoding()
+
+    if not encoding:
+        return (len(text) + CHARACTERS_PER_TOKEN - 1) // CHARACTERS_PER_TOKEN
+
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_prompt_tokens(messages):
+    # Count the tokens of the prompt as the chat completions API does, including the message overhead.
+    return sum(TOKENS_PER_MESSAGE + count_tokens(message["content"]) for message in messages) + TOKENS_PER_REPLY
+
+def get_terraform_features(source_code):
+    # Returns the resource types, data sources, and providers used by the Terraform source code.
+    features = set()
+
+    for (block_type, type_name) in re.findall(r'^\s*(resource|data)\s+"([\w-]+)"', source_code, re.MULTILINE):
+        features.add(type_name if block_type == 'resource' else f"data.{type_name}")
+
+        # Resource types are prefixed with their provider (e.g. azurerm_resource_group ==> azurerm).
+        features.add("provider." + type_name.split('_')[0])
+
+    for provider_name in re.findall(r'^\s*provider\s+"([\w-]+)"', source_code, re.MULTILINE):
+        features.add("provider." + provider_name)
+
+    return features
+
+def get_example_similarity(sample_features, example_features):
+    # Jaccard similarity of the sample's and the example's features.
+    union = sample_features | example_features
+    if not union:
+        return 0.0
+
+    return len(sample_features & example_features) / len(union)
+
+def select_prompt_examples(sample_source):
+    # Returns the indexes of the before/after examples to send with the sample:
+    # the most similar examples (at most max_examples) that fit within example_token_budget.
+    sample_features = get_terraform_features(sample_source)
+
+    ranked_examples = sorted(range(len(sample_inputs_source)), 
+                             key=lambda i: (-get_example_similarity(sample_features, sample_inputs_features[i]), 
+                                            sample_examples_token_counts[i], 
+                                            i))
+
+    selected_examples   = []
+    token_count         = 0
+
+    for i in ranked_examples:
+        if len(selected_examples) == max_examples:
+            break
+
+        # Always send at least one example so that the model knows the expected output format.
+        if selected_examples and token_count + sample_examples_token_counts[i] > example_token_budget:
+            continue
+
+        selected_examples.append(i)
+        token_count += sample_examples_token_counts[i]
+
+    # Keep the examples in the order of the prompt inputs file so that the
+    # prompt (and its cache key) is stable regardless of the ranking.
+    return sorted(selected_examples)
+
+def get_prompt_messages(sample_dir, sample_source = None, validation_feedback = None):
+    # When regenerating a sample that failed validation, validation_feedback lists its problems.
+    messages = []
+
+    if sample_source is None:
+        sample_source = get_sample_source(sample_dir)
+    record_source_size(sample_source)
+    sample_source = sample_source.text
+
+    selected_examples = select_prompt_examples(sample_source)
+    print_message(f"Examples selected for '{sample_dir}': {', '.join(sample_inputs_names[i] for i in selected_examples)}", PrintDisposition.DEBUG)
+
+    # for every selected item in sample_inputs_source...
+    for i in selected_examples:
+        messages.append({"role": "user", "content": sample_inputs_source[i]})
+        messages.append({"role": "assistant", "content": sample_outputs_source[i]})
+
+    if validation_feedback:
+        sample_source += "\n\n" + validation_feedback
+
+    messages.append({"role": "user", "content": sample_source})
+
+    return messages
+
+def get_packed_prompt_messages(sample_dirs):
+    # A single prompt for several samples. The examples are selected for the samples as a whole
+    # and each sample is delimited so that the completion can be split back into samples.
+    messages = []
+
+    sample_sources = [get_sample_source(sample_dir).text for sample_dir in sample_dirs]
+
+    selected_examples = select_prompt_examples(''.join(sample_sources))
+    print_message(f"Examples selected for {len(sample_dirs)} packed samples: {', '.join(sample_inputs_names[i] for i in selected_examples)}", PrintDisposition.DEBUG)
+
+    for i in selected_examples:
+        messages.append({"role": "user", "content": sample_inputs_source[i]})
+        messages.append({"role": "assistant", "content": sample_outputs_source[i]})
+
+    packed_source = PACKED_PROMPT_INSTRUCTIONS.format(len(sample_dirs)) + "\n"
+    for (i, sample_source) in enumerate(sample_sources):
+        packed_source += ("\n" + PACKED_SAMPLE_BEGIN_MARKER.format(i + 1) 
+                          + sample_source 
+                          + "\n" + PACKED_SAMPLE_END_MARKER.format(i + 1) + "\n")
+
+    messages.append({"role": "user", "content": packed_source})
+
+    return messages
+
+def split_packed_completion(completion):
+    # Returns the portion of a packed completion for each sample, keyed by the sample's index (from 0).
+    portions        = {}
+    current_sample  = None
+    current_lines   = []
+
+    for line in completion.split('\n'):
+        stripped_line = line.strip()
+
+        begin_marker = re.fullmatch(PACKED_SAMPLE_BEGIN_MARKER.format(r'(\d+)'), stripped_line)
+        if begin_marker:
+            current_sample  = int(begin_marker.group(1)) - 1
+            current_lines   = []
+        elif current_sample is not None and stripped_line == PACKED_SAMPLE_END_MARKER.format(current_sample + 1):
+            # A sample that appears more than once is ambiguous, so it isn't used.
+            portions[current_sample] = None if current_sample in portions else '\n'.join(current_lines)
+            current_sample = None
+        elif current_sample is not None:
+            current_lines.append(line)
+
+    return {index: portion for (index, portion) in portions.items() if portion is not None}
+
+class CompletionFileParser:
+    # Splits a completion into files in a single pass over its lines. Each file
+    # is delimited by a '###file_name###' line and a 'file_name:end' line. The
+    # completion can be fed all at once or incrementally as it's streamed.
+
+    def __init__(self):
+        self.pending_text   = []
+        self.line_number    = 0
+        self.current_file   = None
+        self.current_line   = 0
+        self.current_lines  = []
+        self.file_names     = set()
+
+    def feed(self, text):
+        # Returns the (file_name, contents) pairs completed by the text.
+        completed_files = []
+
+        # The last line may be incomplete, so hold it back until more text arrives.
+        if '\n' not in text:
+            self.pending_text.append(text)
+            return completed_files
+
+        self.pending_text.append(text)
+        lines = ''.join(self.pending_text).split('\n')
+        self.pending_text = [lines.pop()]
+
+        for line in lines:
+            self.process_line(line, completed_files)
+
+        return completed_files
+
+    def close(self):
+        # Returns any remaining (file_name, contents) pairs once the completion has ended.
+        completed_files = []
+
+        pending_line = ''.join(self.pending_text)
+        self.pending_text = []
+        if pending_line:
+            self.process_line(pending_line, completed_files)
+
+        if self.current_file is not None:
+            raise ValueError(f"Failed to find the end of file '{self.current_file}' (begins on line {self.current_line}).")
+
+        return completed_files
+
+    def process_line(self, line, completed_files):
+        self.line_number += 1
+
+        stripped_line = line.strip()
+
+        # Check for the beginning of a file.
+        begin_marker = None
+        if stripped_line.startswith('###'):
+            begin_marker = re.fullmatch(r'###(.+)###', stripped_line)
+
+        if begin_marker:
+            file_name = begin_marker.group(1).strip()
+
+            if self.current_file is not None:
+                raise ValueError(f"Line {self.line_number}: Found the beginning of file '{file_name}' "
+                                 f"before the end of file '{self.current_file}' (begins on line {self.current_line}).")
+
+            if file_name in self.file_names:
+                raise ValueError(f"Line {self.line_number}: Found a duplicate file name: '{file_name}'.")
+
+            # File names are joined to the sample output path, so they can't contain a path.
+            if file_name in ('.', '..') or '/' in file_name or '\\' in file_name:
+                raise ValueError(f"Line {self.line_number}: Found an invalid file name: '{file_name}'.")
+
+            self.file_names.add(file_name)
+            self.current_file   = file_name
+            self.current_line   = self.line_number
+            self.current_lines  = []
+        elif self.current_file is None:
+            # Ignore any text outside of the file markers.
+            pass
+        elif line.rstrip().endswith(self.current_file + ':end'):
+            # Keep anything preceding the end marker on the same line.
+            self.current_lines.append(line.rstrip()[:-len(self.current_file + ':end')])
+            completed_files.append((self.current_file, '\n'.join(self.current_lines).strip()))
+            self.current_file = None
+        else:
+            self.current_lines.append(line)
+
+def parse_completion_files(completion):
+    # Returns the (file_name, contents) pairs in the completion.
+    parser = CompletionFileParser()
+    return parser.feed(completion) + parser.close()
+
+def get_streamed_completion(sample_dir, messages, streamed_files, endpoint):
+    # Stream the completion, writing each file as soon as its end marker arrives.
+    # The name of each written file is appended to streamed_files.
+    sample_output_path = get_normalized_path(sample_dir, output_path)
+    os.makedirs(sample_output_path, exist_ok = True)
+
+    parser          = CompletionFileParser()
+    completion      = []
+    token_count     = 0
+
+    response = openai.ChatCompletion.create(messages=messages,
+                                            temperature=0,
+                                            stream=True,
+                                            **endpoint.get_request_settings()
+                                            )
+
+    for chunk in response:
+        # Azure OpenAI sends chunks without choices (such as content filter results).
+        if not chunk['choices']:
+            continue
+
+        text = chunk['choices'][0]['delta'].get('content')
+        if not text:
+            continue
+
+        completion.append(text)
+
+        # Each streamed chunk carries a single token.
+        token_count += 1
+        if 0 == token_count % STREAM_PROGRESS_INTERVAL:
+            print_message(f"Received {token_count} tokens for: '{sample_dir}'...")
+
+        for (file_name, contents) in parser.feed(text):
+            print_message(f"Received file '{file_name}' for: '{sample_dir}' ({token_count} tokens so far)")
+            write_sample_file(sample_output_path, file_name, contents)
+            streamed_files.append(file_name)
+
+    for (file_name, contents) in parser.close():
+        write_sample_file(sample_output_path, file_name, contents)
+        streamed_files.append(file_name)
+
+    print_message(f"Received {token_count} tokens for: '{sample_dir}'.", PrintDisposition.DEBUG)
+
+    # Streamed responses don't report usage, so count the prompt tokens locally.
+    record_token_usage(count_prompt_tokens(messages), token_count, endpoint)
+
+    return ''.join(completion)
+
+def is_retryable_error(error):
+    # Throttling, timeouts, connection failures and server errors are transient.
+    if isinstance(error, (openai.error.RateLimitError, 
+                          openai.error.ServiceUnavailableError, 
+                          openai.error.Timeout, 
+                          openai.error.APIConnectionError, 
+                          openai.error.TryAgain)):
+        return True
+
+    return isinstance(error, openai.error.APIError) and (error.http_status is None or error.http_status >= 500)
+
+def is_endpoint_error(error):
+    # Failures of the endpoint rather than the request: outages, timeouts, and
+    # missing deployments or credentials. Throttling isn't a failure.
+    if isinstance(error, openai.error.RateLimitError):
+        return False
+
+    if isinstance(error, (openai.error.AuthenticationError, openai.error.PermissionError)):
+        return True
+
+    if isinstance(error, openai.error.InvalidRequestError) and error.http_status == 404:
+        return True
+
+    return is_retryable_error(error)
+
+def is_context_length_error(error):
+    return isinstance(error, openai.error.InvalidRequestError) and getattr(error, 'code', None) == 'context_length_exceeded'
+
+def get_retry_after(error):
+    # Returns the number of seconds that the service asked us to wait (or None).
+    headers = {name.lower(): value for (name, value) in (getattr(error, 'headers', None) or {}).items()}
+
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+
+        if 'retry-after' in headers:
+            retry_after = headers['retry-after']
+            if retry_after.strip().isdigit():
+                return float(retry_after)
+
+            # Retry-After can also be an HTTP date.
+            return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+
+    return None
+
+def get_backoff_delay(attempt):
+    # Exponential backoff with full jitter.
+    return random.uniform(0, min(MAX_BACKOFF_SECONDS, INITIAL_BACKOFF_SECONDS * 2 ** (attempt - 1)))
+
+def get_estimated_completion_tokens(messages):
+    # The completion is roughly the size of the migrated sample.
+    return count_tokens(messages[-1]["content"])
+
+def get_estimated_request_tokens(messages):
+    return count_prompt_tokens(messages) + get_estimated_completion_tokens(messages)
+
+def call_azure_openai(sample_dir, messages, streamed_files = None):
+    # Call Azure OpenAI within the rate limits, retrying transient failures.
+    # Each attempt is routed to an endpoint, so a retry can go to another one.
+    prompt_tokens       = count_prompt_tokens(messages)
+    completion_tokens   = get_estimated_completion_tokens(messages)
+    estimated_tokens    = prompt_tokens + completion_tokens
+    min_context_window  = 0
+
+    for attempt in range(1, MAX_REQUEST_ATTEMPTS + 1):
+        with timed_stage("rate_wait"):
+            endpoint = endpoint_router.select(prompt_tokens, completion_tokens, min_context_window)
+            entry = endpoint.rate_controller.acquire(estimated_tokens)
+
+        print_message(f"Sending the request for '{sample_dir}' to endpoint '{endpoint.name}'.", PrintDisposition.DEBUG)
+
+        try:
+            actual_tokens = None
+
+            with timed_stage("network"):
+                if streaming_enabled and streamed_files is not None:
+                    # Start over if a previous attempt failed partway through the stream.
+                    del streamed_files[:]
+                    completion = get_streamed_completion(sample_dir, messages, streamed_files, endpoint)
+                else:
+                    completion = ''
+                    response = openai.ChatCompletion.create(messages=messages,
+                                                            temperature=0,
+                                                            **endpoint.get_request_settings()
+                                                            )
+                                                            
+                    if response:
+                        completion = response['choices'][0]['message']['content']
+
+                        usage = response.get('usage', {})
+                        actual_tokens = usage.get('total_tokens')
+                        record_token_usage(usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0), endpoint)
+        except openai.error.OpenAIError as error:
+            throttled = isinstance(error, openai.error.RateLimitError)
+            retry_after = get_retry_after(error)
+            endpoint.rate_controller.release(entry, succeeded=False, throttled=throttled, retry_after=retry_after)
+
+            unhealthy = is_endpoint_error(error)
+            endpoint_router.record_failure(endpoint, unhealthy)
+
+            # A request that's too long for the model (the token count was underestimated)
+            # is sent to a model with a larger context window.
+            if is_context_length_error(error) and endpoint.context_window < endpoint_router.max_context_window:
+                min_context_window = endpoint.context_window + 1
+                retryable = True
+            else:
+                retryable = is_retryable_error(error) or (unhealthy and endpoint_router.has_alternative(endpoint, estimated_tokens, min_context_window))
+
+            if not retryable or attempt == MAX_REQUEST_ATTEMPTS:
+                raise
+
+            # When the service sets Retry-After, the rate controller holds back every request to the endpoint
+            # until then. Another endpoint can take the request right away.
+            switch_endpoint = endpoint_router.has_alternative(endpoint, estimated_tokens, min_context_window)
+            delay = 0 if retry_after or switch_endpoint else get_backoff_delay(attempt)
+            record_retry()
+            print_message(f"Azure OpenAI request failed for: '{sample_dir}' ({error}). Retrying{f' in {delay:.1f} seconds' if delay else ''} (attempt {attempt + 1} of {MAX_REQUEST_ATTEMPTS})...", PrintDisposition.WARNING)
+            with timed_stage("rate_wait"):
+                time.sleep(delay)
+            continue
+        except Exception:
+            endpoint.rate_controller.release(entry, succeeded=False)
+            raise
+
+        endpoint.rate_controller.release(entry, succeeded=True, actual_tokens=actual_tokens)
+        endpoint_router.record_success(endpoint)
+        return completion
+
+def can_parse_completion(completion, parse_completion):
+    try:
+        return bool(parse_completion(completion))
+    except ValueError:
+        return False
+
+def request_completion(sample_dir, messages, streamed_files = None, prefetch = False, parse_completion = parse_completion_files):
+    # parse_completion splits the completion the way its caller will, which checks that it's complete before it's cached.
+    special_chars = '\n'
+    if debug_mode:
+        special_chars = special_chars + '\t'
+
+    # Prefetches run while the user is being prompted, so only report them when debugging.
+    disp = PrintDisposition.DEBUG if prefetch else PrintDisposition.STATUS
+
+    # Identical prompts produce identical completions (temperature is 0), so reuse a cached one if available.
+    completion = get_cached_completion(messages)
+
+    if completion and not can_parse_completion(completion, parse_completion):
+        print_message(f"Discarding cached completion that can't be parsed for: '{sample_dir}'", PrintDisposition.DEBUG)
+        uncache_completion(messages)
+        completion = None
+
+    if completion:
+        print_message(f"{special_chars}Using cached completion for: '{sample_dir}'...", disp)
+        record_cache_hit()
+    else:
+        print_message(f"{special_chars}Calling OpenAI for: '{sample_dir}'...", disp)
+
+        completion = call_azure_openai(sample_dir, messages, streamed_files)
+
+        # A truncated or malformed completion isn't cached so that the next run requests a new one.
+        if can_parse_completion(completion, parse_completion):
+            cache_completion(messages, completion)
+
     return completion
 
-def get_prompt_input_source():
+def prefetch_completions(prefetch_executor, sample_dirs, args):
+    # Start generating the completions for the specified samples in the background.
+    # Nothing is written for a sample until the user accepts it.
+    for sample_dir in sample_dirs:
+        with prefetch_lock:
+            if sample_dir in prefetched_completions:
+                continue
 
-    print_message()
-    print_message("Getting before and after sample directories from settings file...", PrintDisposition.DEBUG)
+        if args.resume and is_sample_unchanged(sample_dir):
+            continue
 
-    bundle_dir = Path(__file__).parent
-    print_message(f"Bundle_dir: {bundle_dir}", PrintDisposition.DEBUG)
+        # Samples that are migrated in chunks aren't prefetched.
+        if chunking_enabled and get_sample_chunks(sample_dir):
+            continue
+
+        messages = get_prompt_messages(sample_dir)
+
+        print_message(f"Prefetching completion for: '{sample_dir}'...", PrintDisposition.DEBUG)
+        future = prefetch_executor.submit(prefetch_completion, sample_dir, messages)
 
+        with prefetch_lock:
+            prefetched_completions[sample_dir] = (messages, future)
+
+def prefetch_completion(sample_dir, messages):
+    # Returns the completion and the metrics collected while prefetching it.
+    metrics = start_sample_metrics(sample_dir)
+    completion = request_completion(sample_dir, messages, prefetch=True)
+    return (completion, metrics)
+
+def take_prefetched_completion(sample_dir, messages):
+    # Returns the prefetched completion for the sample, or None if there isn't a usable one.
+    with prefetch_lock:
+        prefetched = prefetched_completions.pop(sample_dir, None)
+
+    if prefetched is None:
+        return None
+
+    (prefetched_messages, future) = prefetched
+
+    # The sample (or the examples selected for it) changed after the prefetch started.
+    if prefetched_messages != messages:
+        future.cancel()
+        return None
+
+    try:
+        print_message(f"Using prefetched completion for: '{sample_dir}'", PrintDisposition.DEBUG)
+        (completion, metrics) = future.result()
+        merge_sample_metrics(metrics)
+        return completion
+    except Exception as error:
+        print_message(f"Prefetch failed for: '{sample_dir}'. {error}", PrintDisposition.DEBUG)
+        return None
+
+def discard_prefetched_completion(sample_dir):
+    # The user skipped the sample. A completion that already arrived stays in the completion cache.
+    with prefetch_lock:
+        prefetched = prefetched_completions.pop(sample_dir, None)
+
+    if prefetched is not None:
+        print_message(f"Discarding prefetched completion for: '{sample_dir}'", PrintDisposition.DEBUG)
+        prefetched[1].cancel()
+
+def generate_new_sample(sample_dir, streamed_files = None, sample_source = None, chunk_index = None, validation_feedback = None):
+    # sample_source is the sample's source (read if it isn't given) or, when migrating a sample in chunks, the chunk's source.
+    print_message(f"\nGenerating new sample...", PrintDisposition.DEBUG, override_indent=True)
+
+    messages = None
+    completion = ''
+    artifact_file_name = DEBUG_ARTIFACT_FILE_NAME if chunk_index is None else DEBUG_CHUNK_ARTIFACT_FILE_NAME.format(chunk_index + 1)
+
+    try:
+        with timed_stage("source"):
+            messages = get_prompt_messages(sample_dir, sample_source, validation_feedback)
+
+        if debug_mode: # Write the prompt to the debug artifacts.
+            write_debug_artifact(sample_dir, messages, artifact_file_name=artifact_file_name)
+
+        # Use the completion prefetched while the user was confirming the sample (if any).
+        prefetched_completion = take_prefetched_completion(sample_dir, messages) if chunk_index is None else None
+
+        if prefetched_completion is not None:
+            completion = prefetched_completion
+        else:
+            completion = request_completion(sample_dir, messages, streamed_files)
+    except OSError as error:
+        print_message(f"Failed to generate new sample. {error}", PrintDisposition.ERROR)
+
+    if debug_mode and messages is not None: # Add the completion to the debug artifacts.
+        write_debug_artifact(sample_dir, messages, completion, artifact_file_name)
+
+    return completion
+
+def get_chunk_token_budget():
+    # A chunk's prompt (the examples and the chunk) and completion (about the size of the chunk) must fit in the context window.
+    chunk_token_budget = (endpoint_router.max_context_window - example_token_budget - CHUNK_TOKEN_MARGIN) // 2
+
+    if chunk_token_budget < CHUNK_MIN_TOKENS:
+        raise ValueError(f"The example token budget ({example_token_budget}) leaves only {chunk_token_budget} tokens for each chunk of the "
+                         f"{endpoint_router.max_context_window}-token context window (at least {CHUNK_MIN_TOKENS} are needed). Lower --example-token-budget.")
+
+    return chunk_token_budget
+
+def get_sample_chunks(sample_dir, sample_source = None):
+    # Returns the source of each chunk to migrate the sample in, or None if the sample fits in the context window.
+    if sample_source is None:
+        sample_source = get_sample_source(sample_dir)
+    messages = get_prompt_messages(sample_dir, sample_source)
+
+    if get_estimated_request_tokens(messages) <= endpoint_router.max_context_window:
+        return None
+
+    chunk_sources = split_sample_into_chunks(sample_source, get_chunk_token_budget())
+
+    return chunk_sources if len(chunk_sources) > 1 else None
+
+def get_chunk_sample_source(chunk_source):
+    return SampleSource(chunk_source, [], [], len(chunk_source.encode("utf-8")))
+
+def generate_chunk_completion(sample_dir, chunk_source, chunk_index, validation_feedback = None):
+    # Returns the chunk's completion and the metrics collected while generating it.
+    metrics = start_sample_metrics(sample_dir)
+    sample_source = get_chunk_sample_source(chunk_source)
+    completion = generate_new_sample(sample_dir, sample_source=sample_source, chunk_index=chunk_index, validation_feedback=validation_feedback)
+    return (completion, metrics)
+
+def generate_chunked_sample(sample_dir, chunk_sources, validation_feedback = None):
+    # Migrate the chunks concurrently (within the rate limits and --jobs) and return their completions in order.
+    print_message(f"Migrating '{sample_dir}' in {len(chunk_sources)} chunks...")
+
+    with ThreadPoolExecutor(max_workers=min(len(chunk_sources), concurrent_jobs)) as executor:
+        futures = [executor.submit(generate_chunk_completion, sample_dir, chunk_source, i, validation_feedback) for (i, chunk_source) in enumerate(chunk_sources)]
+
+        completions = []
+        for future in futures:
+            (completion, metrics) = future.result()
+            merge_sample_metrics(metrics)
+            completions.append(completion)
+
+    return completions
+
+def get_prompt_input_dirs(bundle_dir):
+    # Returns the (before, after, before_dir, after_dir) tuples listed in the prompt inputs file.
     prompt_input_file_name = os.path.join(bundle_dir, PROMPT_INPUT_FILE_NAME)
 
     try:
@@ -179,86 +1425,613 @@ def get_prompt_input_source():
     if 1 > len(inputs):
         raise ValueError('At least one input/output pair must be specified in the inputs file.')
 
+    prompt_input_dirs = []
+
     # For each line in the file (representing a sample directory)...
     for (before, after) in inputs.items():
-        before_dir = os.path.join(bundle_dir, before)
-        if file_exists(before_dir):
-            sample_inputs_source.append(get_terraform_source_code(before_dir, include_file_names=False))
-        else:
+        # The inputs file uses Windows path separators, so split on either separator.
+        before_dir = os.path.join(bundle_dir, *re.split(r'[\\/]', before))
+        if not file_exists(before_dir):
             raise ValueError(f"[{prompt_input_file_name}] 'Before' directory not found: {before_dir}")
 
-        after_dir = os.path.join(bundle_dir, after)        
-        if file_exists(after_dir):
-            sample_outputs_source.append(get_terraform_source_code(after_dir, include_file_names=True))
-        else:
+        after_dir = os.path.join(bundle_dir, *re.split(r'[\\/]', after))
+        if not file_exists(after_dir):
             raise ValueError(f"[{prompt_input_file_name}] 'After' directory not found: {after_dir}")
 
-def list_to_string(input_list):
+        prompt_input_dirs.append((before, after, before_dir, after_dir))
+
+    return prompt_input_dirs
 
-    # Initialize an empty string.
-    return_string = ""
+def get_source_hash(source_code):
+    return hashlib.sha256(source_code.encode("utf-8")).hexdigest()
 
-    # Traverse elements of list...
-    for list_element in input_list:
+def build_prompt_bundle():
+    # Compile the prompt inputs file and the before/after directories that it
+    # references into a single file that can be loaded with one read.
+    print_message("\nBuilding prompt inputs bundle...", PrintDisposition.DEBUG, override_indent=True)
 
-        # Add element to string.
-        return_string += list_element
+    bundle_dir = Path(__file__).parent
+    prompt_bundle_file_name = os.path.join(bundle_dir, PROMPT_BUNDLE_FILE_NAME)
 
-    # Return string.
-    return return_string
+    examples = []
+    for (before, after, before_dir, after_dir) in get_prompt_input_dirs(bundle_dir):
+        input_source    = get_terraform_source_code(before_dir, include_file_names=False)
+        output_source   = get_terraform_source_code(after_dir, include_file_names=True)
 
-def get_file_contents(file):
-    file_contents = ""
+        examples.append({"before": before,
+                         "after": after,
+                         "input": input_source,
+                         "input_hash": get_source_hash(input_source),
+                         "output": output_source,
+                         "output_hash": get_source_hash(output_source)})
+
+    bundle = {"version": PROMPT_BUNDLE_VERSION,
+              "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+              "examples": examples}
+
+    try:
+        with open(prompt_bundle_file_name, "w", encoding="utf-8") as f:
+            f.write(json.dumps(bundle, indent=4))
+    except OSError as error:
+        raise ValueError(f"Failed to write prompt inputs bundle ({prompt_bundle_file_name}). {error}") from error
+
+    print_message(f"Prompt inputs bundle ({len(examples)} examples) written to: {prompt_bundle_file_name}", PrintDisposition.SUCCESS)
+
+def is_prompt_bundle_stale(bundle_dir, prompt_bundle_file_name):
+    # The bundle is stale if the prompt inputs file or any file in the
+    # directories that it references is newer than the bundle.
+    # (The frozen binary only ships the bundle, so there is nothing to compare.)
+    if not file_exists(os.path.join(bundle_dir, PROMPT_INPUT_FILE_NAME)):
+        return False
+
+    bundle_time = os.path.getmtime(prompt_bundle_file_name)
+
+    if os.path.getmtime(os.path.join(bundle_dir, PROMPT_INPUT_FILE_NAME)) > bundle_time:
+        return True
+
+    for (_, _, before_dir, after_dir) in get_prompt_input_dirs(bundle_dir):
+        for dir in (before_dir, after_dir):
+            for entry in os.scandir(dir):
+                if entry.is_file() and entry.stat().st_mtime > bundle_time:
+                    return True
+
+    return False
 
+def load_prompt_bundle(bundle_dir):
+    # Returns the examples in the prompt inputs bundle, or None if the live
+    # prompt inputs should be used instead.
+    prompt_bundle_file_name = os.path.join(bundle_dir, PROMPT_BUNDLE_FILE_NAME)
+
+    if not file_exists(prompt_bundle_file_name):
+        print_message(f"Prompt inputs bundle not found: {prompt_bundle_file_name}", PrintDisposition.DEBUG)
+        return None
+
+    try:
+        if is_prompt_bundle_stale(bundle_dir, prompt_bundle_file_name):
+            print_message("Prompt inputs have changed since the bundle was built. Using the prompt inputs directories. (Run with --build-prompt-bundle to rebuild it.)", PrintDisposition.WARNING)
+            return None
+
+        print_message(f"Loading prompt inputs bundle: {prompt_bundle_file_name}", PrintDisposition.DEBUG)
+        with open(prompt_bundle_file_name, encoding="utf-8") as f:
+            bundle = json.load(f)
+    except (OSError, ValueError) as error:
+        print_message(f"Ignoring unreadable prompt inputs bundle ({prompt_bundle_file_name}). {error}", PrintDisposition.WARNING)
+        return None
+
+    if bundle.get("version") != PROMPT_BUNDLE_VERSION:
+        print_message(f"Ignoring prompt inputs bundle with unsupported version: {bundle.get('version')}", PrintDisposition.WARNING)
+        return None
+
+    for example in bundle["examples"]:
+        if (get_source_hash(example["input"]) != example["input_hash"]
+        or get_source_hash(example["output"]) != example["output_hash"]):
+            raise ValueError(f"[{prompt_bundle_file_name}] Content hash mismatch for example: {example['before']}")
+
+    return bundle["examples"]
+
+def add_prompt_example(before, input_source, output_source):
+    sample_inputs_source.append(input_source)
+    sample_outputs_source.append(output_source)
+    sample_inputs_names.append(before)
+
+    # Index the example by the Terraform resource types and providers that it uses.
+    sample_inputs_features.append(get_terraform_features(input_source))
+
+    sample_examples_token_counts.append(count_tokens(input_source) + count_tokens(output_source))
+    print_message(f"Example '{before}': {sample_examples_token_counts[-1]} tokens, features: {sorted(sample_inputs_features[-1])}", PrintDisposition.DEBUG)
+
+def get_prompt_input_source():
+
+    print_message()
+    print_message("Getting before and after sample directories from settings file...", PrintDisposition.DEBUG)
+
+    bundle_dir = Path(__file__).parent
+    print_message(f"Bundle_dir: {bundle_dir}", PrintDisposition.DEBUG)
+
+    # Use the precompiled bundle if it's up to date.
+    examples = load_prompt_bundle(bundle_dir)
+
+    if examples is not None:
+        for example in examples:
+            add_prompt_example(example["before"], example["input"], example["output"])
+        return
+
+    for (before, after, before_dir, after_dir) in get_prompt_input_dirs(bundle_dir):
+        add_prompt_example(before,
+                           get_terraform_source_code(before_dir, include_file_names=False),
+                           get_terraform_source_code(after_dir, include_file_names=True))
+
+def get_file_contents(file):
     with open(file, encoding="utf-8") as f:
-        file_contents = f.readlines()
+        return f.read()
 
-    file_contents = list_to_string(file_contents)
-    return file_contents
+class SampleSource:
+    # The source code assembled from a directory's relevant files, with its size.
 
-def get_terraform_source_code(dir, include_file_names):
+    def __init__(self, text, files, skipped_files, byte_count):
+        self.text           = text
+        self.files          = files # (file_name, contents) pairs
+        self.skipped_files  = skipped_files # (file_name, reason) pairs
+        self.byte_count     = byte_count
+        self.token_count    = None
+
+    def get_token_count(self):
+        if self.token_count is None:
+            self.token_count = count_tokens(self.text)
+        return self.token_count
+
+def is_source_file(file_name, include_globs):
+    return any(fnmatch.fnmatch(file_name.lower(), glob.lower()) for glob in include_globs)
+
+def read_source_file(file_path):
+    # Returns the file's text (with the newlines that reading it in text mode gives), or None if it's binary.
+    with open(file_path, "rb") as f:
+        data = f.read()
+
+    if b'\0' in data[:BINARY_CHECK_BYTES]:
+        return None
+
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+def assemble_source_code(dir, include_file_names, include_globs = DEFAULT_SOURCE_GLOBS, max_file_bytes = DEFAULT_MAX_SOURCE_FILE_BYTES):
+    # Reads the directory's relevant files (skipping binary and oversized files) and joins them once.
     print_message(f"Getting Terraform source code for: {dir}", PrintDisposition.DEBUG)
 
-    current_sample_source_code = ""
-
-    # For every file in the source directory...
-    for file_name in os.listdir(dir):
-
-        if os.path.isfile(os.path.join(dir, file_name)):
-
-            # DO NOT process TestRecord.md file...
-            if file_name != TEST_RECORD_FILE_NAME and file_name != '':
-                
-                # Append source code for the current directory/file
-                if include_file_names:
-                    current_file_source_code = ("###" 
-                    + file_name 
-                    + "###" 
-                    + "\n" 
-                    + get_file_contents(os.path.join(dir, file_name))
-                    + "\n" 
-                    + file_name 
-                    + ":end\n")
+    parts           = []
+    files           = []
+    skipped_files   = []
+    byte_count      = 0
+
+    # Sort the files so that the source (and the prompt and hashes built from it) doesn't depend on the file system's order.
+    with os.scandir(dir) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+
+    for entry in entries:
+        # DO NOT process TestRecord.md file...
+        if not entry.is_file() or entry.name == TEST_RECORD_FILE_NAME or not is_source_file(entry.name, include_globs):
+            continue
+
+        file_size = entry.stat().st_size
+        if file_size > max_file_bytes:
+            skipped_files.append((entry.name, f"larger than {max_file_bytes} bytes"))
+            continue
+
+        contents = read_source_file(entry.path)
+        if contents is None:
+            skipped_files.append((entry.name, "binary"))
+            continue
+
+        if include_file_names:
+            parts += ["###", entry.name, "###\n", contents, "\n", entry.name, ":end\n"]
+        else:
+            parts += ["\n", contents]
+
+        files.append((entry.name, contents))
+        byte_count += file_size
+
+    for (file_name, reason) in skipped_files:
+        print_message(f"Skipped '{os.path.join(dir, file_name)}' ({reason}).", PrintDisposition.DEBUG)
+
+    return SampleSource(''.join(parts), files, skipped_files, byte_count)
+
+def get_terraform_source_code(dir, include_file_names):
+    # The prompt examples always use the default filters (as does the prompt bundle).
+    return assemble_source_code(dir, include_file_names).text
+
+def get_sample_source(sample_dir):
+    # Sample source uses the filters from the command-line args.
+    return assemble_source_code(sample_dir, False, source_include_globs, max_source_file_bytes)
+
+def scan_hcl_line(line, depth, in_block_comment):
+    # Returns the nesting depth after the line, whether a block comment is still open, the
+    # marker of a heredoc that the line starts (or None), and whether the line has any code.
+    heredoc_marker  = None
+    has_code        = False
+    position        = 0
+
+    if in_block_comment:
+        comment_end = line.find('*/')
+        if comment_end < 0:
+            return (depth, True, None, False)
+        position = comment_end + 2
+        in_block_comment = False
+
+    while True:
+        token = HCL_TOKEN_PATTERN.search(line, position)
+        if not token:
+            break
+
+        text = token.group()
+        position = token.end()
+
+        if text == '#' or text == '//':
+            break
+
+        if text == '/*':
+            comment_end = line.find('*/', position)
+            if comment_end < 0:
+                in_block_comment = True
+                break
+            position = comment_end + 2
+            continue
+
+        has_code = True
+
+        if text.startswith('<<') and len(text) > 2:
+            heredoc_marker = text.lstrip('<-')
+        elif text in ('{', '[', '('):
+            depth += 1
+        elif text in ('}', ']', ')'):
+            depth = max(0, depth - 1)
+
+    return (depth, in_block_comment, heredoc_marker, has_code)
+
+def get_hcl_block_header(text):
+    # Returns the type and labels of the block (such as 'resource', ['azurerm_resource_group', 'rg']),
+    # or (None, []) if the text isn't a block (such as a top-level attribute).
+    for line in re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL).split('\n'):
+        stripped_line = line.strip()
+        if not stripped_line or stripped_line.startswith(('#', '//')):
+            continue
+
+        header = re.match(r'([A-Za-z_][\w-]*)((?:\s+(?:"[^"]*"|[A-Za-z_][\w-]*))*)\s*\{', stripped_line)
+        if not header:
+            break
+
+        return (header.group(1), [quoted or bare for (quoted, bare) in re.findall(r'"([^"]*)"|([A-Za-z_][\w-]*)', header.group(2))])
+
+    return (None, [])
+
+def split_hcl_blocks(source_code):
+    # Splits HCL source code into its top-level blocks (and top-level attributes). Returns
+    # (block_type, labels, text) tuples. Comments preceding a block belong to the block.
+    segments            = []
+    current_lines       = []
+    has_code            = False
+    depth               = 0
+    in_block_comment    = False
+    heredoc_marker      = None
+
+    for line in source_code.split('\n'):
+        current_lines.append(line)
+
+        if heredoc_marker is not None:
+            if line.strip() == heredoc_marker:
+                heredoc_marker = None
+        else:
+            (depth, in_block_comment, heredoc_marker, line_has_code) = scan_hcl_line(line, depth, in_block_comment)
+            has_code = has_code or line_has_code
+
+        if has_code and 0 == depth and heredoc_marker is None and not in_block_comment:
+            text = '\n'.join(current_lines)
+            segments.append(get_hcl_block_header(text) + (text,))
+            current_lines   = []
+            has_code        = False
+
+    # Keep any trailing comments with the last block.
+    text = '\n'.join(current_lines)
+    if text.strip():
+        if segments:
+            (block_type, labels, last_text) = segments.pop()
+            segments.append((block_type, labels, last_text + '\n' + text))
+        else:
+            segments.append((None, [], text))
+
+    return segments
+
+def get_hcl_block_keys(block_type, labels, text):
+    # Returns the names that other blocks use to refer to the block.
+    if block_type == 'resource' and len(labels) == 2:
+        return [f"{labels[0]}.{labels[1]}"]
+    if block_type == 'data' and len(labels) == 2:
+        return [f"data.{labels[0]}.{labels[1]}"]
+    if block_type == 'module' and labels:
+        return [f"module.{labels[0]}"]
+    if block_type == 'variable' and labels:
+        return [f"var.{labels[0]}"]
+    if block_type == 'locals':
+        return ["local." + name for name in re.findall(r'^\s*([\w-]+)\s*=', text, re.MULTILINE)]
+
+    return []
+
+def get_hcl_references(text):
+    # Returns the names of the blocks that the text might refer to (such as 'var.location').
+    references = set(re.findall(r'\b(data\.[\w-]+\.[\w-]+)', text))
+
+    for (prefix, name) in re.findall(r'\b([A-Za-z_][\w-]*)\.([A-Za-z_][\w-]*)', text):
+        references.add(f"{prefix}.{name}")
+
+    return references
+
+def split_sample_into_chunks(sample_source, max_tokens):
+    # Splits the sample's Terraform files along top-level blocks into chunks of about max_tokens.
+    # Blocks that refer to each other stay in the same chunk, the terraform and provider blocks
+    # are sent with every chunk, and the variables and locals are sent with the chunks that use
+    # them. Other files (such as README.md and .tfvars files) are sent with the first chunk.
+    whole_files = []
+    blocks      = []
+
+    for (file_name, contents) in sample_source.files:
+        if file_name.lower().endswith('.tf'):
+            blocks += split_hcl_blocks(contents)
+        else:
+            whole_files.append(contents)
+
+    block_indexes = {}
+    for (i, (block_type, labels, text)) in enumerate(blocks):
+        for key in get_hcl_block_keys(block_type, labels, text):
+            block_indexes[key] = i
+
+    references = [{block_indexes[key] for key in get_hcl_references(text) if key in block_indexes} - {i} 
+                  for (i, (_, _, text)) in enumerate(blocks)]
+    token_counts = [count_tokens(text) for (_, _, text) in blocks]
+
+    context_blocks      = [i for (i, block) in enumerate(blocks) if block[0] in CHUNK_CONTEXT_BLOCK_TYPES]
+    dependency_blocks   = {i for (i, block) in enumerate(blocks) if block[0] in CHUNK_DEPENDENCY_BLOCK_TYPES}
+    primary_blocks      = [i for (i, block) in enumerate(blocks) if block[0] not in CHUNK_CONTEXT_BLOCK_TYPES + CHUNK_DEPENDENCY_BLOCK_TYPES]
+
+    # Group the primary blocks (resources, data sources, modules, outputs...) that refer to each other.
+    groups = {i: [i] for i in primary_blocks}
+    group_of = {i: i for i in primary_blocks}
+    for i in primary_blocks:
+        for j in references[i]:
+            if j in group_of and group_of[i] != group_of[j]:
+                (kept, merged) = sorted((group_of[i], group_of[j]))
+                for k in groups.pop(merged):
+                    group_of[k] = kept
+                    groups[kept].append(k)
+
+    budget = max_tokens - sum(token_counts[i] for i in context_blocks) - sum(count_tokens(contents) for contents in whole_files)
+
+    if budget < CHUNK_MIN_TOKENS:
+        raise ValueError(f"The sample's terraform and provider blocks and its other files (such as README.md) leave only {budget} tokens "
+                         f"for the other blocks of each chunk (at least {CHUNK_MIN_TOKENS} are needed).")
+
+    # A group that doesn't fit in a chunk by itself is split into its blocks.
+    units = []
+    for group_id in sorted(groups):
+        group = sorted(groups[group_id])
+        if sum(token_counts[i] for i in group) > budget:
+            units += [[i] for i in group]
+        else:
+            units.append(group)
+
+    chunks          = [[]]
+    chunk_tokens    = 0
+    for unit in units:
+        unit_tokens = sum(token_counts[i] for i in unit)
+        if chunks[-1] and chunk_tokens + unit_tokens > budget:
+            chunks.append([])
+            chunk_tokens = 0
+        chunks[-1] += unit
+        chunk_tokens += unit_tokens
+
+    # Add the variables and locals that each chunk uses (and that they use in turn).
+    chunk_blocks = []
+    used_dependencies = set()
+    for chunk in chunks:
+        dependencies = set()
+        pending = [j for i in chunk for j in references[i] if j in dependency_blocks]
+        while pending:
+            j = pending.pop()
+            if j not in dependencies:
+                dependencies.add(j)
+                pending += [k for k in references[j] if k in dependency_blocks]
+
+        used_dependencies |= dependencies
+        chunk_blocks.append(set(chunk) | dependencies | set(context_blocks))
+
+    # Variables and locals that nothing uses are still part of the sample.
+    chunk_blocks[0] |= dependency_blocks - used_dependencies
+
+    chunk_sources = []
+    for (n, block_set) in enumerate(chunk_blocks):
+        parts = (whole_files if 0 == n else []) + [blocks[i][2].strip() for i in sorted(block_set)]
+        chunk_sources.append('\n' + '\n\n'.join(parts) + '\n')
+
+    return chunk_sources
+
+def stitch_chunk_files(chunk_files):
+    # Merges the files migrated from each chunk. Terraform files are merged block by block, keeping
+    # the first of any block that several chunks return (such as the variables and providers that
+    # they share). Other files are taken from the first chunk that returns them.
+    file_names      = []
+    file_parts      = {}
+    seen_blocks     = set()
+
+    for files in chunk_files:
+        for (file_name, contents) in files:
+            if file_name not in file_parts:
+                file_names.append(file_name)
+                file_parts[file_name] = []
+            elif not file_name.lower().endswith('.tf'):
+                continue
+
+            if not file_name.lower().endswith('.tf'):
+                file_parts[file_name].append(contents)
+                continue
+
+            for (block_type, labels, text) in split_hcl_blocks(contents):
+                block_key = (block_type, tuple(labels)) if block_type else text.strip()
+                if block_key in seen_blocks:
+                    continue
+
+                seen_blocks.add(block_key)
+                file_parts[file_name].append(text.strip())
+
+    return [(file_name, '\n\n'.join(file_parts[file_name])) for file_name in file_names]
+
+def get_hcl_structure_errors(source_code):
+    # Returns the structural errors in HCL source code: unbalanced brackets, unterminated strings,
+    # heredocs and comments, and top-level text that is neither a block nor an attribute (such as
+    # prose or a Markdown fence that the model left in the file).
+    errors              = []
+    open_brackets       = [] # (bracket, line number)
+    in_block_comment    = False
+    heredoc_marker      = None
+    heredoc_line_number = 0
+    comment_line_number = 0
+
+    for (line_number, line) in enumerate(source_code.split('\n'), 1):
+        if heredoc_marker is not None:
+            if line.strip() == heredoc_marker:
+                heredoc_marker = None
+            continue
+
+        position = 0
+        if in_block_comment:
+            comment_end = line.find('*/')
+            if comment_end < 0:
+                continue
+            position = comment_end + 2
+            in_block_comment = False
+
+        while True:
+            token = HCL_TOKEN_PATTERN.search(line, position)
+            if not token:
+                break
+
+            text = token.group()
+            position = token.end()
+
+            if text == '#' or text == '//':
+                break
+
+            if text == '/*':
+                comment_end = line.find('*/', position)
+                if comment_end < 0:
+                    in_block_comment = True
+                    comment_line_number = line_number
+                    break
+                position = comment_end + 2
+            elif text.startswith('"'):
+                if not re.fullmatch(r'"(?:\\.|[^"\\])*"', text):
+                    errors.append(f"Line {line_number}: unterminated string.")
+            elif text.startswith('<<') and len(text) > 2:
+                heredoc_marker = text.lstrip('<-')
+                heredoc_line_number = line_number
+            elif text in ('{', '[', '('):
+                open_brackets.append((text, line_number))
+            elif text in ('}', ']', ')'):
+                if not open_brackets:
+                    errors.append(f"Line {line_number}: unexpected '{text}'.")
                 else:
-                    current_file_source_code = ("\n" + get_file_contents(os.path.join(dir, file_name)))
+                    (bracket, bracket_line_number) = open_brackets.pop()
+                    if '{[('.index(bracket) != '}])'.index(text):
+                        errors.append(f"Line {line_number}: '{text}' doesn't match the '{bracket}' on line {bracket_line_number}.")
+
+    for (bracket, bracket_line_number) in open_brackets:
+        errors.append(f"Line {bracket_line_number}: '{bracket}' is never closed.")
+    if heredoc_marker is not None:
+        errors.append(f"Line {heredoc_line_number}: heredoc '{heredoc_marker}' is never closed.")
+    if in_block_comment:
+        errors.append(f"Line {comment_line_number}: comment is never closed.")
+
+    # The top-level statements can only be found in well-formed source code.
+    if errors:
+        return errors
+
+    line_number = 1
+    for (block_type, labels, text) in split_hcl_blocks(source_code):
+        if block_type is None:
+            # Blank out the comments, keeping their lines so that the line numbers stay right.
+            code = re.sub(r'/\*.*?\*/', lambda comment: '\n' * comment.group().count('\n'), text, flags=re.DOTALL)
+            for (i, line) in enumerate(code.split('\n')):
+                stripped_line = line.strip()
+                if not stripped_line or stripped_line.startswith(('#', '//')):
+                    continue
+                if not re.match(r'[A-Za-z_][\w-]*\s*=(?!=)', stripped_line):
+                    errors.append(f"Line {line_number + i}: expected a block or an attribute, found '{stripped_line[:40]}'.")
+                break
 
-                current_sample_source_code += current_file_source_code
+        line_number += text.count('\n') + 1
 
-    # Return the source code for the specified directory.
-    return current_sample_source_code
+    return errors
+
+def get_hcl_syntax_errors(source_code):
+    # Returns the syntax errors in HCL source code. The source is parsed with the hcl2 module
+    # (python-hcl2) if it's installed, otherwise only its structure is checked.
+    try:
+        import hcl2
+    except ImportError:
+        return get_hcl_structure_errors(source_code)
+
+    try:
+        hcl2.loads(source_code)
+    except Exception as error: # The parser raises a variety of (lark) exceptions.
+        return [' '.join(str(error).split('\n')[0].split()) or type(error).__name__]
+
+    return []
+
+def validate_sample_output(sample_output_path):
+    # Returns the problems with a migrated sample's files (none if it's valid). Runs in a
+    # worker process, so it only reads the files: nothing is downloaded or initialized.
+    problems = [f"{file_name} is missing." for file_name in EXPECTED_SAMPLE_FILES
+                if not os.path.isfile(os.path.join(sample_output_path, file_name))]
+
+    try:
+        entries = sorted(os.scandir(sample_output_path), key=lambda entry: entry.name)
+    except OSError as error:
+        return [f"Failed to read the sample. {error}"]
+
+    for entry in entries:
+        if not entry.name.endswith(VALIDATED_FILE_EXTENSIONS) or not entry.is_file():
+            continue
+
+        try:
+            with open(entry.path, encoding="utf-8") as f:
+                source_code = f.read()
+        except (OSError, UnicodeDecodeError) as error:
+            problems.append(f"{entry.name}: failed to read the file. {error}")
+            continue
+
+        problems += [f"{entry.name}: {error}" for error in get_hcl_syntax_errors(source_code)]
+
+    return problems
 
 def file_exists(path):
     return os.path.exists(path)
 
-def parse_args():
+def parse_args(argv = None):
     # Configure argParser for user-supplied arguments.
+    # argv is the arguments of a job submitted to a server (default: the command line).
 
     argParser = argparse.ArgumentParser()
 
     argParser.add_argument("-s", 
                            "--sample_directory", 
                            help="Name of input sample directory.", 
-                           required=True)
+                           required=False)
+
+    argParser.add_argument("-o", 
+                           "--output_directory", 
+                           help=f"Name of the directory that the new samples are written to (default: '{OUTPUT_DIRECTORY_NAME}' in the application directory).", 
+                           required=False)
 
     argParser.add_argument("-r", 
                            "--recursive", 
@@ -272,7 +2045,181 @@ def parse_args():
                            help=argparse.SUPPRESS, 
                            required=False)
 
-    return argParser.parse_args()
+    argParser.add_argument("--cache", 
+                           action=argparse.BooleanOptionalAction,
+                           default=True,
+                           help="Reuse cached Azure OpenAI completions for identical prompts (use --no-cache to always call Azure OpenAI).", 
+                           required=False)
+
+    argParser.add_argument("--resume", 
+                           "--changed-only",
+                           action=argparse.BooleanOptionalAction,
+                           help="Skips samples that were successfully migrated by a previous run and whose inputs haven't changed since.", 
+                           required=False)
+
+    argParser.add_argument("--stream", 
+                           action=argparse.BooleanOptionalAction,
+                           help="Streams the Azure OpenAI completion and writes each file as soon as it's complete.", 
+                           required=False)
+
+    argParser.add_argument("--chunk", 
+                           action=argparse.BooleanOptionalAction,
+                           help="Migrates samples that don't fit in the context window in chunks of Terraform blocks, and stitches the chunks back together. Chunks aren't streamed.", 
+                           required=False)
+
+    argParser.add_argument("--validate", 
+                           action=argparse.BooleanOptionalAction,
+                           default=True,
+                           help=f"Checks the migrated samples locally (the HCL syntax of their files and that {', '.join(EXPECTED_SAMPLE_FILES)} exist) and regenerates the samples that fail (default: enabled). "
+                                "Parsing every file is CPU-bound and can take longer than the migration itself when the completions are cached.", 
+                           required=False)
+
+    argParser.add_argument("--validation-retries", 
+                           type=int,
+                           default=DEFAULT_VALIDATION_RETRIES,
+                           metavar="N",
+                           help=f"Regenerates a sample that fails validation at most N times (default: {DEFAULT_VALIDATION_RETRIES}).", 
+                           required=False)
+
+    argParser.add_argument("--max-examples", 
+                           type=int,
+                           default=DEFAULT_MAX_EXAMPLES,
+                           help=f"Maximum number of the most similar before/after examples to send with each sample (default: {DEFAULT_MAX_EXAMPLES}).", 
+                           required=False)
+
+    argParser.add_argument("--example-token-budget", 
+                           type=int,
+                           default=DEFAULT_EXAMPLE_TOKEN_BUDGET,
+                           help=f"Maximum number of tokens of before/after examples to send with each sample (default: {DEFAULT_EXAMPLE_TOKEN_BUDGET}).", 
+                           required=False)
+
+    argParser.add_argument("-j", 
+                           "--jobs", 
+                           type=int,
+                           default=DEFAULT_JOBS,
+                           help=f"Number of samples to migrate concurrently (default: {DEFAULT_JOBS}).", 
+                           required=False)
+
+    argParser.add_argument("--requests-per-minute", 
+                           type=int,
+                           help="Requests-per-minute quota of the Azure OpenAI deployment. Requests are held back to stay within it.", 
+                           required=False)
+
+    argParser.add_argument("--tokens-per-minute", 
+                           type=int,
+                           help="Tokens-per-minute quota of the Azure OpenAI deployment. Requests are held back to stay within it.", 
+                           required=False)
+
+    argParser.add_argument("--prefetch", 
+                           type=int,
+                           default=0,
+                           metavar="K",
+                           help="When confirming each sample, generates the next K samples in the background while waiting for the response.", 
+                           required=False)
+
+    argParser.add_argument("--pack", 
+                           type=int,
+                           default=0,
+                           metavar="N",
+                           help=f"When processing all samples, migrates up to N small samples (up to {PACK_SAMPLE_MAX_TOKENS} tokens each) with a single Azure OpenAI request, so that the examples are sent once for all of them. Packed requests aren't streamed.", 
+                           required=False)
+
+    argParser.add_argument("--ignore", 
+                           action="append",
+                           metavar="GLOB",
+                           help=f"Skips subdirectories whose name or relative path matches GLOB (can be repeated). {', '.join(DEFAULT_IGNORE_GLOBS)} are always skipped.", 
+                           required=False)
+
+    argParser.add_argument("--include", 
+                           action="append",
+                           metavar="GLOB",
+                           help=f"Sends the files whose name matches GLOB as the sample source (can be repeated; default: {', '.join(DEFAULT_SOURCE_GLOBS)}).", 
+                           required=False)
+
+    argParser.add_argument("--max-file-size", 
+                           type=int,
+                           default=DEFAULT_MAX_SOURCE_FILE_BYTES,
+                           metavar="BYTES",
+                           help=f"Skips sample files larger than BYTES (default: {DEFAULT_MAX_SOURCE_FILE_BYTES}).", 
+                           required=False)
+
+    argParser.add_argument("--max-depth", 
+                           type=int,
+                           help="Maximum depth of subdirectories to process when processing recursively.", 
+                           required=False)
+
+    argParser.add_argument("-y", 
+                           "--yes", 
+                           action=argparse.BooleanOptionalAction,
+                           help="Migrates all samples without confirming the plan or each sample. Samples are migrated as they're found.", 
+                           required=False)
+
+    argParser.add_argument("--shard", 
+                           metavar="I/N",
+                           help="Migrates only shard I of N (1 to N) of the discovered samples, so that N machines can share a migration. The shards are balanced by estimated prompt size. "
+                                "Run every shard with the same sample tree, options and prompt inputs, each with its own OUTPUT_DIRECTORY, and combine them with --merge.", 
+                           required=False)
+
+    argParser.add_argument("--endpoints", 
+                           metavar="FILE",
+                           help="Routes the Azure OpenAI requests across the endpoints (deployments) listed in FILE, a JSON file. See README.md.", 
+                           required=False)
+
+    argParser.add_argument("--api-base", 
+                           default=OPENAI_API_BASE,
+                           help=argparse.SUPPRESS, 
+                           required=False)
+
+    argParser.add_argument("--plan-only", 
+                           action="store_true",
+                           help="Prints the migration plan and exits without calling Azure OpenAI.", 
+                           required=False)
+
+    argParser.add_argument("--show-prompt", 
+                           metavar="SAMPLE",
+                           help="Prints the prompt recorded for SAMPLE (in SAMPLE_DIRECTORY) by a --debug run and exits.", 
+                           required=False)
+
+    argParser.add_argument("--show-prompt-chunk", 
+                           type=int,
+                           metavar="N",
+                           help="With --show-prompt, prints the prompt of chunk N (from 1) of a sample that was migrated in chunks.", 
+                           required=False)
+
+    argParser.add_argument("--merge", 
+                           nargs="+",
+                           metavar="SHARD_OUTPUT_DIRECTORY",
+                           help="Combines the output directories of --shard runs (their samples, run manifests and run reports) into OUTPUT_DIRECTORY, reports missing and duplicate samples, and exits.", 
+                           required=False)
+
+    argParser.add_argument("--serve", 
+                           action="store_true",
+                           help="Runs a server that keeps the credentials, prompt inputs and connections warm and migrates the jobs submitted with --submit, one at a time. The server's --jobs, --endpoints and rate limits apply to every job.", 
+                           required=False)
+
+    argParser.add_argument("--port", 
+                           type=int,
+                           default=0,
+                           help="Port of the --serve server on 127.0.0.1 (default: any free port).", 
+                           required=False)
+
+    argParser.add_argument("--submit", 
+                           action="store_true",
+                           help="Submits the migration to the running --serve server and prints its progress.", 
+                           required=False)
+
+    argParser.add_argument("--build-prompt-bundle", 
+                           action="store_true",
+                           help="Compiles the prompt inputs into a single bundle file (build step) and exits.", 
+                           required=False)
+
+    args = argParser.parse_args(argv)
+
+    # The sample directory is required unless running a command that doesn't migrate samples.
+    if not args.sample_directory and not args.build_prompt_bundle and not args.serve and not args.merge:
+        argParser.error("the following arguments are required: -s/--sample_directory")
+
+    return args
 
 def get_normalized_path(sample_dir, output_path):
 
@@ -302,9 +2249,59 @@ def get_normalized_path(sample_dir, output_path):
 
     return output_dir
 
+def write_sample_file(sample_output_path, file_name, contents):
+    # Writes the file only if its contents changed, so that unchanged files keep their
+    # timestamps. Returns 'added', 'changed' or 'unchanged'.
+    curr_qfn = os.path.join(sample_output_path, file_name)
+
+    # Match the newlines that writing the file in text mode would produce.
+    data = contents.replace('\n', os.linesep).encode("utf-8")
+
+    try:
+        with timed_stage("write"):
+            try:
+                file_stat = os.stat(curr_qfn)
+            except FileNotFoundError:
+                file_stat = None
+
+            if file_stat is not None and file_stat.st_size == len(data):
+                with open(curr_qfn, "rb") as f:
+                    if f.read() == data:
+                        print_message("Unchanged file: " + curr_qfn, PrintDisposition.DEBUG)
+                        record_file_outcome(file_name, 'unchanged')
+                        return 'unchanged'
+
+            print_message("Writing file: " + curr_qfn, PrintDisposition.DEBUG)
+
+            write_file_atomically(curr_qfn, data, stat.S_IMODE(file_stat.st_mode) if file_stat is not None else new_file_mode)
+    except OSError as error:
+        raise ValueError(f"Failed to write file. {error}") from error
+
+    outcome = 'added' if file_stat is None else 'changed'
+    record_file_outcome(file_name, outcome)
+    return outcome
+
+def remove_stale_sample_files(sample_dir, file_names):
+    # Remove the files of a previous run that the new sample no longer has. Subdirectories
+    # (such as the output of nested samples) are left alone.
+    sample_output_path = get_normalized_path(sample_dir, output_path)
+
+    try:
+        with timed_stage("write"):
+            for entry in os.scandir(sample_output_path):
+                if entry.name not in file_names and entry.is_file(follow_symlinks=False):
+                    print_message("Removing file: " + entry.path, PrintDisposition.DEBUG)
+                    os.remove(entry.path)
+                    record_file_outcome(entry.name, 'removed')
+    except OSError as error:
+        raise ValueError(f"Failed to remove file. {error}") from error
+
 def write_new_sample(sample_dir, file_contents):
     # Write the completion string to the appropriate files
     # based on the file markers within the completion.
+    # file_contents can also be the list of completions of a
+    # chunked sample, which are stitched into one set of files.
+    # Returns the names of the files.
 
     # Get the output path for the sample.
     sample_output_path = get_normalized_path(sample_dir, output_path)
@@ -314,39 +2311,79 @@ def write_new_sample(sample_dir, file_contents):
     print_message(f"Creating directory for sample output: {sample_output_path}", PrintDisposition.DEBUG)
     os.makedirs(sample_output_path, exist_ok = True)
 
-    if file_contents:
-        file_names = re.findall(r'###(.*)###', file_contents)
-
-        if file_names:
-            for i in range(len(file_names)):
-                current_file = file_names[i]
-
-                beg_m = re.search('###'+ current_file + '###', file_contents)
-                if beg_m:
-                    end_m = re.search(current_file + ':end', file_contents)
-                    if end_m:
-                        sub = file_contents[(beg_m.span())[1]:(end_m.span())[0]]
-                        sub = sub.strip()
-
-                        curr_qfn = os.path.join(sample_output_path, current_file)
-                        print_message("Writing file: " + curr_qfn, PrintDisposition.DEBUG)
-
-                        try:
-                            # Write the file.
-                            with open(curr_qfn, "w") as f:
-                                print_message("", PrintDisposition.DEBUG)
-                                f.write(sub)
-                        except OSError as error:
-                            raise ValueError(f"Failed to write file. {error}") from error
-                    else:
-                        raise ValueError('Failed to find the end of the file name.')
-                else:
-                    raise ValueError('Failed to find the beginning of the file name.')
+    completions = file_contents if isinstance(file_contents, list) else [file_contents]
+
+    if completions and all(completions):
+        with timed_stage("parse"):
+            if 1 == len(completions):
+                sample_files = parse_completion_files(completions[0])
+            else:
+                sample_files = stitch_chunk_files([parse_completion_files(completion) for completion in completions])
+
+        if sample_files:
+            for (file_name, contents) in sample_files:
+                write_sample_file(sample_output_path, file_name, contents)
+
+            return [file_name for (file_name, _) in sample_files]
         else:
             raise ValueError('Failed to find any file names in the completion.')
     else:
         raise ValueError('Failed to get a valid completion from OpenAI.')
 
+def load_endpoints(args):
+    # Returns the endpoints listed in the endpoints file or, without one, the default endpoint.
+    # The --requests-per-minute and --tokens-per-minute quotas apply to each endpoint that doesn't set its own.
+    max_concurrency = args.jobs + args.prefetch
+
+    if not args.endpoints:
+        return [Endpoint("default", args.api_base, OPENAI_ENGINE, OPENAI_VERSION, OPENAI_CONTEXT_WINDOW_TOKENS, 
+                         PROMPT_COST_PER_1K_TOKENS, COMPLETION_COST_PER_1K_TOKENS, 1,
+                         RateController(max_concurrency, args.requests_per_minute, args.tokens_per_minute))]
+
+    print_message(f"Loading endpoints file: {args.endpoints}", PrintDisposition.DEBUG)
+
+    try:
+        with open(args.endpoints, encoding="utf-8") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as error:
+        raise ValueError(f"Failed to read endpoints file ({args.endpoints}). {error}") from error
+
+    endpoints = []
+    for (i, settings) in enumerate(config.get("endpoints", []) if isinstance(config, dict) else []):
+        if not isinstance(settings, dict) or not settings.get("api_base") or not settings.get("engine"):
+            raise ValueError(f"Endpoint {i + 1} in the endpoints file ({args.endpoints}) must have an api_base and an engine.")
+
+        name = str(settings.get("name", settings["engine"]))
+
+        try:
+            endpoint = Endpoint(name,
+                                settings["api_base"],
+                                settings["engine"],
+                                settings.get("api_version", OPENAI_VERSION),
+                                int(settings.get("context_window", OPENAI_CONTEXT_WINDOW_TOKENS)),
+                                float(settings.get("prompt_cost_per_1k_tokens", PROMPT_COST_PER_1K_TOKENS)),
+                                float(settings.get("completion_cost_per_1k_tokens", COMPLETION_COST_PER_1K_TOKENS)),
+                                float(settings.get("weight", 1)),
+                                RateController(int(settings.get("max_concurrency", max_concurrency)), 
+                                               int(settings["requests_per_minute"]) if "requests_per_minute" in settings else args.requests_per_minute, 
+                                               int(settings["tokens_per_minute"]) if "tokens_per_minute" in settings else args.tokens_per_minute),
+                                settings.get("api_key_variable"))
+        except (TypeError, ValueError) as error:
+            raise ValueError(f"Invalid setting for endpoint '{name}' in the endpoints file ({args.endpoints}). {error}") from error
+
+        if endpoint.weight <= 0 or endpoint.context_window < 1 or endpoint.rate_controller.max_concurrency < 1:
+            raise ValueError(f"The weight, context window and maximum concurrency of endpoint '{name}' must be positive.")
+
+        if name in [other_endpoint.name for other_endpoint in endpoints]:
+            raise ValueError(f"Endpoint name '{name}' is used more than once in the endpoints file ({args.endpoints}).")
+
+        endpoints.append(endpoint)
+
+    if not endpoints:
+        raise ValueError(f"No endpoints found in the endpoints file ({args.endpoints}).")
+
+    return endpoints
+
 def get_application_path():
     # Get the application path.
     application_path = ''
@@ -358,25 +2395,76 @@ def get_application_path():
 
     return application_path
     
-def init_app(args):
+def init_debug_mode(args):
 
     # Set global debugging flag based on command-line arg.        
     if args.debug:
         global debug_mode
         debug_mode = True
 
-    print_message("\nInitializing application...", PrintDisposition.DEBUG, override_indent=True)
+def init_app(args):
+
+    init_debug_mode(args)
+
+    print_message("\nInitializing application...", PrintDisposition.DEBUG, override_indent=True)
+
+    if debug_mode:
+        print_message("Debugging enabled.", PrintDisposition.DEBUG)
+
+    # Sample files are written to a temp file (which only the owner can access) and renamed,
+    # so give new files the permissions that creating them directly would.
+    global new_file_mode
+    umask = os.umask(0)
+    os.umask(umask)
+    new_file_mode = 0o666 & ~umask
+
+    # Set the sample root path based on the command-line arg.
+    global sample_root_path
+    sample_root_path = os.path.abspath(args.sample_directory)
+    print_message(f"Sample root path: {sample_root_path}", PrintDisposition.DEBUG)
+
+    if not file_exists(sample_root_path):
+        raise ValueError(f"Sample directory not found: {sample_root_path}")
+
+    # Verify the number of concurrent jobs.
+    if args.jobs < 1:
+        raise ValueError(f"The number of jobs must be at least 1: {args.jobs}")
+    print_message(f"Jobs: {args.jobs}", PrintDisposition.DEBUG)
+
+    global concurrent_jobs
+    concurrent_jobs = args.jobs
+
+    # Verify the number of samples to prefetch.
+    if args.prefetch < 0:
+        raise ValueError(f"The number of samples to prefetch can't be negative: {args.prefetch}")
+
+    # Verify the number of samples to pack into a request.
+    if args.pack < 0:
+        raise ValueError(f"The number of samples to pack can't be negative: {args.pack}")
+
+    # Verify the number of times to regenerate samples that fail validation.
+    if args.validation_retries < 0:
+        raise ValueError(f"The number of validation retries can't be negative: {args.validation_retries}")
+
+    # Set the few-shot example limits based on the command-line args.
+    if args.max_examples < 1:
+        raise ValueError(f"The maximum number of examples must be at least 1: {args.max_examples}")
+
+    global max_examples
+    max_examples = args.max_examples
 
-    if debug_mode:
-        print_message("Debugging enabled.", PrintDisposition.DEBUG)
+    global example_token_budget
+    example_token_budget = args.example_token_budget
+    print_message(f"Examples: at most {max_examples} within {example_token_budget} tokens", PrintDisposition.DEBUG)
 
-    # Set the sample root path based on the command-line arg.
-    global sample_root_path
-    sample_root_path = os.path.abspath(args.sample_directory)
-    print_message(f"Sample root path: {sample_root_path}", PrintDisposition.DEBUG)
+    # Set the sample source filters based on the command-line args.
+    if args.max_file_size < 1:
+        raise ValueError(f"The maximum file size must be at least 1 byte: {args.max_file_size}")
 
-    if not file_exists(sample_root_path):
-        raise ValueError(f"Sample directory not found: {sample_root_path}")
+    global source_include_globs, max_source_file_bytes
+    source_include_globs = args.include or DEFAULT_SOURCE_GLOBS
+    max_source_file_bytes = args.max_file_size
+    print_message(f"Sample source: {', '.join(source_include_globs)} up to {max_source_file_bytes} bytes", PrintDisposition.DEBUG)
 
     # Get the application path.
     application_path = get_application_path()
@@ -385,18 +2473,12 @@ def init_app(args):
     if application_path == '':
         raise ValueError('Failed to get application path.')
 
-    # Set the output path based on the application path.
-    global output_path
-    output_path = os.path.join(application_path, OUTPUT_DIRECTORY_NAME)
-    print_message(f"Output path: {output_path}", PrintDisposition.DEBUG)
+    # Set (and create) the output path.
+    init_output_path(args, application_path)
 
-    # If output path doesn't exist, create it.
-    if not os.path.exists(output_path):
-        try:
-            print_message("Creating output path...", PrintDisposition.DEBUG)
-            os.mkdir(output_path)
-        except OSError as error:
-            raise ValueError(f"Failed to create output directory. {error}") from error
+    # Verify the shard.
+    if args.shard:
+        parse_shard(args.shard)
         
     # Set the temp path based on the application path.
     global temp_path
@@ -411,38 +2493,327 @@ def init_app(args):
         except OSError as error:
             raise ValueError(f"Failed to create temp directory. {error}") from error
 
-    # Get the directories (samples) to process.
-    get_directories_to_process(args)
+    # Set the completion cache path based on the application path.
+    global cache_path
+    cache_path = os.path.join(application_path, CACHE_DIRECTORY_NAME)
+    print_message(f"Cache path: {cache_path}", PrintDisposition.DEBUG)
+
+    # Set global caching flag based on command-line arg.
+    global cache_enabled
+    cache_enabled = args.cache
+    print_message(f"Completion cache {'enabled' if cache_enabled else 'disabled'}.", PrintDisposition.DEBUG)
+
+    # Set global streaming flag based on command-line arg.
+    global streaming_enabled
+    streaming_enabled = bool(args.stream)
+    if streaming_enabled:
+        print_message("Streaming enabled.", PrintDisposition.DEBUG)
+
+    # Set global chunking flag based on command-line arg.
+    global chunking_enabled
+    chunking_enabled = bool(args.chunk)
+    if chunking_enabled:
+        print_message("Chunking enabled.", PrintDisposition.DEBUG)
+
+    # Get the directories (samples) to process. If the plan isn't confirmed, the
+    # directories are discovered lazily as the samples are migrated, unless
+    # they're split into shards (which needs all of them).
+    if args.plan_only or not args.yes or args.shard:
+        get_directories_to_process(args)
 
     print_message("Application initialized.", PrintDisposition.DEBUG, override_indent=True)
     
-def get_directories_to_process(args):
+def init_output_path(args, application_path):
+    # Set the output path based on the command-line arg or, by default, the application path.
+    global output_path
+    if args.output_directory:
+        output_path = os.path.abspath(args.output_directory)
+    else:
+        output_path = os.path.join(application_path, OUTPUT_DIRECTORY_NAME)
+    print_message(f"Output path: {output_path}", PrintDisposition.DEBUG)
+
+    # If output path doesn't exist, create it.
+    if not os.path.exists(output_path):
+        try:
+            print_message("Creating output path...", PrintDisposition.DEBUG)
+            os.makedirs(output_path)
+        except OSError as error:
+            raise ValueError(f"Failed to create output directory. {error}") from error
+
+def init_endpoints(args):
+    # Create the endpoints (each with a rate controller shared by all of its requests, including prefetches).
+    global endpoint_router
+    endpoint_router = EndpointRouter(load_endpoints(args))
+    for endpoint in endpoint_router.endpoints:
+        print_message(f"Endpoint '{endpoint.name}': {endpoint.engine} ({endpoint.context_window} tokens) at {endpoint.api_base}, weight {endpoint.weight}, "
+                      f"{endpoint.rate_controller.requests_per_minute or 'unlimited'} requests/minute, {endpoint.rate_controller.tokens_per_minute or 'unlimited'} tokens/minute", 
+                      PrintDisposition.DEBUG)
+
+def reset_run_state():
+    # A server migrates one job after another in the same process, so clear what the previous job left behind.
+    global discovery_complete, discovery_time, shard_info
+
+    del directories_to_process[:]
+    discovery_complete  = False
+    discovery_time      = 0.0
+    shard_info          = None
+    sample_estimates.clear()
+
+    with run_metrics_lock:
+        del run_metrics[:]
+
+    endpoint_router.reset_usage()
+
+def is_terraform_file(entry):
+    return entry.is_file() and ".tf" == (os.path.splitext(entry.name)[1].lower())
+
+def is_ignored_directory(relative_dir, ignore_globs):
+    # A glob matches either the directory's name or its path relative to the sample root.
+    dir_name = os.path.basename(relative_dir)
+    return any(fnmatch.fnmatch(dir_name, glob) or fnmatch.fnmatch(relative_dir, glob) for glob in ignore_globs)
+
+def discover_sample_directories(root_path, recursive, ignore_globs, max_depth):
+    # Yields each directory that contains a Terraform file, scanning each
+    # directory only once. Directories are yielded as soon as they're found
+    # so that samples can be migrated before the scan finishes.
+    # Symlinked directories are followed, but a directory that was already
+    # reached by another path (such as a symlink cycle) isn't scanned again.
+    scan_time           = 0.0
+    scanned_count       = 0
+    found_count         = 0
+
+    # Each entry is (absolute_dir, relative_dir, depth, real_dir).
+    pending_dirs = [(root_path, '', 0, os.path.realpath(root_path))]
+    visited_dirs = {pending_dirs[0][3]}
+
+    start_time = time.perf_counter()
+
+    while pending_dirs:
+        (current_dir, relative_dir, depth, real_dir) = pending_dirs.pop()
+        scanned_count += 1
+
+        try:
+            with os.scandir(current_dir) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError as error:
+            print_message(f"Failed to scan directory: {error}", PrintDisposition.WARNING)
+            continue
+
+        if any(is_terraform_file(entry) for entry in entries):
+            found_count += 1
+
+            # Don't count the time spent by the caller (e.g. migrating the sample) as scan time.
+            scan_time += time.perf_counter() - start_time
+            yield current_dir
+            start_time = time.perf_counter()
+
+        if not recursive or (max_depth is not None and depth >= max_depth):
+            continue
+
+        # Only a symlink's real path needs resolving: the others are under their parent's.
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                relative_subdir = Path(relative_dir, entry.name).as_posix()
+                real_subdir = os.path.realpath(entry.path) if entry.is_symlink() else os.path.join(real_dir, entry.name)
+                if is_ignored_directory(relative_subdir, ignore_globs):
+                    print_message(f"Ignoring directory: {entry.path}", PrintDisposition.DEBUG)
+                elif real_subdir in visited_dirs:
+                    print_message(f"Skipping directory that was already found by another path: {entry.path}", PrintDisposition.DEBUG)
+                else:
+                    visited_dirs.add(real_subdir)
+                    subdirs.append((os.path.abspath(entry.path), relative_subdir, depth + 1, real_subdir))
+
+        # Push the subdirectories in reverse so that they're scanned in name order.
+        pending_dirs += reversed(subdirs)
+
+    scan_time += time.perf_counter() - start_time
+
+    global discovery_time
+    discovery_time += scan_time
 
+    print_message(f"Scanned {scanned_count} directories and found {found_count} samples in {scan_time:.3f} seconds.", PrintDisposition.DEBUG)
+
+def discover_directories_to_process(args):
+    # Yields each sample directory as it's found, adding it to directories_to_process.
     print_message("Getting directories to process...", PrintDisposition.DEBUG)
 
-    global directories_to_process
+    global discovery_complete
 
     # If the specified sample dir (root) exists...
-    if file_exists(sample_root_path):
+    if not file_exists(sample_root_path):
+        raise ValueError(f"Sample directory not found: {sample_root_path}")
+
+    for sample_dir in discover_sample_directories(sample_root_path, args.recursive, DEFAULT_IGNORE_GLOBS + (args.ignore or []), args.max_depth):
+        directories_to_process.append(sample_dir)
+        yield sample_dir
 
-        # Add the root to the list.
-        if len([1 for x in list(os.scandir(sample_root_path)) if x.is_file() and ".tf" == (os.path.splitext(x.name)[1].lower())]) > 0:
-            directories_to_process.append(sample_root_path)
+    discovery_complete = True
 
-        # If recursive flag is set...
-        if args.recursive:
+def get_directories_to_process(args):
+    # Discover all of the sample directories up front (such as for the plan).
+    for _ in discover_directories_to_process(args):
+        pass
 
-            # For every directory in the sample dir...
-            for root, dirs, files in os.walk(sample_root_path):
+def get_sample_total():
+    # The total is only known once discovery has finished.
+    return f"{len(directories_to_process)}" if discovery_complete else f"{len(directories_to_process)}+"
 
-                # For every directory in the sample dir...
-                for dir in dirs:
+def read_key():
+    import keyboard
+    return keyboard.read_key()
 
-                    # Add the directory to the list.
-                    if len([1 for x in list(os.scandir(os.path.join(root, dir))) if x.is_file() and ".tf" == (os.path.splitext(x.name)[1].lower())]) > 0:
-                        directories_to_process.append(os.path.abspath(os.path.join(root, dir)))
-    else:
-        raise ValueError(f"Sample directory not found: {sample_root_path}")
+def estimate_sample(sample_dir):
+    # Count the sample's prompt tokens (the selected examples and the sample source) and estimate its completion tokens.
+    try:
+        sample_source = get_sample_source(sample_dir)
+        messages = get_prompt_messages(sample_dir, sample_source)
+    except (OSError, UnicodeDecodeError) as error:
+        print_message(f"Failed to estimate sample '{sample_dir}'. {error}", PrintDisposition.WARNING)
+        return {"sample": sample_dir, "source_bytes": 0, "prompt_tokens": 0, "completion_tokens": 0, "exceeds_context_window": False, "skipped_files": []}
+
+    prompt_tokens       = count_prompt_tokens(messages)
+    completion_tokens   = sample_source.get_token_count() # The completion is roughly the size of the migrated sample.
+
+    return {"sample": sample_dir, 
+            "source_bytes": sample_source.byte_count,
+            "prompt_tokens": prompt_tokens, 
+            "completion_tokens": completion_tokens, 
+            "exceeds_context_window": prompt_tokens + completion_tokens > endpoint_router.max_context_window,
+            "skipped_files": [os.path.join(sample_dir, file_name) + f" ({reason})" for (file_name, reason) in sample_source.skipped_files]}
+
+def estimate_samples(sample_dirs):
+    # Reading and tokenizing the samples is independent, so estimate them in parallel.
+    # Samples that were already estimated (such as to split them into shards) aren't estimated again.
+    start_time = time.time()
+    new_sample_dirs = [sample_dir for sample_dir in sample_dirs if sample_dir not in sample_estimates]
+
+    with ThreadPoolExecutor() as executor:
+        for estimate in executor.map(estimate_sample, new_sample_dirs):
+            sample_estimates[estimate["sample"]] = estimate
+
+    print_message(f"Estimated {len(new_sample_dirs)} sample(s) in {time.time() - start_time:.3f} seconds.", PrintDisposition.DEBUG)
+
+    return [sample_estimates[sample_dir] for sample_dir in sample_dirs]
+
+def get_estimated_wall_time(estimates, args):
+    # Each request takes the time to the first token plus the time to generate the completion,
+    # with args.jobs requests in flight, but no faster than the endpoints' quotas allow.
+    request_times = [ESTIMATED_REQUEST_SECONDS + estimate["completion_tokens"] / ESTIMATED_COMPLETION_TOKENS_PER_SECOND 
+                     for estimate in estimates]
+
+    wall_time = max(sum(request_times) / args.jobs, max(request_times))
+
+    # The endpoints' quotas add up, unless an endpoint has no quota.
+    rate_controllers = [endpoint.rate_controller for endpoint in endpoint_router.endpoints]
+
+    if all(rate_controller.requests_per_minute for rate_controller in rate_controllers):
+        requests_per_minute = sum(rate_controller.requests_per_minute for rate_controller in rate_controllers)
+        wall_time = max(wall_time, len(estimates) / requests_per_minute * 60)
+
+    if all(rate_controller.tokens_per_minute for rate_controller in rate_controllers):
+        tokens_per_minute = sum(rate_controller.tokens_per_minute for rate_controller in rate_controllers)
+        total_tokens = sum(estimate["prompt_tokens"] + estimate["completion_tokens"] for estimate in estimates)
+        wall_time = max(wall_time, total_tokens / tokens_per_minute * 60)
+
+    return wall_time
+
+def parse_shard(shard):
+    # Returns the shard's index (1 to N) and the number of shards (N).
+    match = SHARD_PATTERN.match(shard)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError(f"Invalid shard (expected I/N, with I from 1 to N): {shard}")
+
+    return (int(match.group(1)), int(match.group(2)))
+
+def get_shard_assignment(sample_tokens, shard_count):
+    # Assigns each sample (keyed by manifest key) to a shard (0 to shard_count - 1), the largest first,
+    # each to the shard with the fewest tokens so far (the lowest on a tie). The samples are ordered by
+    # size and key rather than discovery order, so every machine computes the same assignment.
+    shard_tokens = [0] * shard_count
+    assignment = {}
+
+    for (sample_key, tokens) in sorted(sample_tokens.items(), key=lambda item: (-item[1], item[0])):
+        shard = min(range(shard_count), key=lambda i: shard_tokens[i])
+        assignment[sample_key] = shard
+        shard_tokens[shard] += tokens
+
+    return (assignment, shard_tokens)
+
+def select_shard_samples(args):
+    # Keeps only the samples of this machine's shard, and records them in the output
+    # directory so that --merge can tell which samples are missing.
+    global shard_info
+
+    (shard_index, shard_count) = parse_shard(args.shard)
+
+    estimates = estimate_samples(directories_to_process)
+    sample_keys = [get_sample_manifest_key(sample_dir) for sample_dir in directories_to_process]
+    (assignment, shard_tokens) = get_shard_assignment({sample_key: estimate["prompt_tokens"] for (sample_key, estimate) in zip(sample_keys, estimates)}, shard_count)
+
+    directories_to_process[:] = [sample_dir for (sample_dir, sample_key) in zip(directories_to_process, sample_keys) if assignment[sample_key] == shard_index - 1]
+
+    # The shards agree on the assignment only if they discovered and estimated the same samples.
+    shard_info = {"index": shard_index,
+                  "count": shard_count,
+                  "sample_total": len(sample_keys),
+                  "assignment_hash": hashlib.sha256(json.dumps(sorted(assignment.items())).encode("utf-8")).hexdigest(),
+                  "prompt_tokens": shard_tokens[shard_index - 1],
+                  "samples": sorted(sample_key for sample_key in sample_keys if assignment[sample_key] == shard_index - 1)}
+
+    # --merge relies on the shard file, so the shard fails if it can't be written.
+    if not args.plan_only:
+        try:
+            write_dictionary_to_file(os.path.join(output_path, SHARD_FILE_NAME), shard_info)
+        except OSError as error:
+            raise ValueError(f"Failed to write the shard file. {error}") from error
+
+    print_message(f"Shard {shard_index} of {shard_count}: {len(directories_to_process)} of {len(sample_keys)} sample(s), "
+                  f"{shard_tokens[shard_index - 1]} of {sum(shard_tokens)} estimated prompt tokens", PrintDisposition.UI)
+
+def print_plan_estimates(args):
+    estimates = estimate_samples(directories_to_process)
+
+    prompt_tokens       = sum(estimate["prompt_tokens"] for estimate in estimates)
+    completion_tokens   = sum(estimate["completion_tokens"] for estimate in estimates)
+    largest_estimate    = max(estimates, key=lambda estimate: estimate["prompt_tokens"])
+    wall_time           = get_estimated_wall_time(estimates, args)
+
+    # Each sample is routed to the cheapest model whose context window fits it.
+    tier_endpoints      = [endpoint_router.get_tier_endpoint(estimate["prompt_tokens"], estimate["completion_tokens"]) for estimate in estimates]
+    estimated_cost      = sum(endpoint.get_cost(estimate["prompt_tokens"], estimate["completion_tokens"]) for (endpoint, estimate) in zip(tier_endpoints, estimates))
+    tier_engines        = [endpoint.engine for endpoint in tier_endpoints]
+
+    print_message("Estimated usage" + (" (token counts are estimated because tiktoken isn't available)" if not get_token_encoding() else "") + ":", PrintDisposition.UI)
+    print_message(f"\tSample source: {sum(estimate['source_bytes'] for estimate in estimates)} bytes", PrintDisposition.UI)
+    print_message(f"\tPrompt tokens: {prompt_tokens} (largest: {largest_estimate['prompt_tokens']} for '{largest_estimate['sample']}')", PrintDisposition.UI)
+    print_message(f"\tCompletion tokens (estimated): {completion_tokens}", PrintDisposition.UI)
+    print_message(f"\tEstimated cost: ${estimated_cost:.2f} (less for samples with cached completions)", PrintDisposition.UI)
+    if args.validate and args.validation_retries:
+        print_message(f"\tNot included: samples that fail validation are regenerated, with up to {args.validation_retries} more request(s) per sample "
+                      f"(up to ${estimated_cost * args.validation_retries:.2f} more). Use --no-validate or --validation-retries 0 to turn this off.", PrintDisposition.UI)
+    if 1 < len(endpoint_router.endpoints):
+        print_message("\tModels: " + ", ".join(f"{engine} {tier_engines.count(engine)} sample(s)" for engine in sorted(set(tier_engines))), PrintDisposition.UI)
+    print_message(f"\tEstimated wall time with {args.jobs} job(s): {wall_time / 60:.1f} minutes", PrintDisposition.UI)
+
+    oversized_estimates = [estimate for estimate in estimates if estimate["exceeds_context_window"]]
+
+    if oversized_estimates:
+        print_message()
+        print_message(f"{len(oversized_estimates)} sample(s) would exceed the {endpoint_router.max_context_window}-token context window of the largest model" 
+                      + (" and are migrated in chunks:" if args.chunk else " (use --chunk to migrate them in chunks):"), PrintDisposition.WARNING)
+        for estimate in oversized_estimates:
+            print_message(f"\t{estimate['sample']}: {estimate['prompt_tokens']} prompt + {estimate['completion_tokens']} completion tokens", PrintDisposition.WARNING)
+
+    skipped_files = [skipped_file for estimate in estimates for skipped_file in estimate["skipped_files"]]
+
+    if skipped_files:
+        print_message()
+        print_message(f"{len(skipped_files)} sample file(s) are skipped (max {MAX_SAMPLES_TO_PRINT} shown):", PrintDisposition.WARNING)
+        for skipped_file in skipped_files[:MAX_SAMPLES_TO_PRINT]:
+            print_message(f"\t{skipped_file}", PrintDisposition.WARNING)
+
+    print_message()
 
 def confirm_plan(args):
     print_message("\nPrinting and confirming the plan...", PrintDisposition.DEBUG, override_indent=True)
@@ -474,6 +2845,9 @@ def confirm_plan(args):
 
         print_message()
 
+        # Print the tokens, cost and time that the run is expected to take.
+        print_plan_estimates(args)
+
         relative_stub_root = os.path.basename(os.path.normpath(sample_root_path))
         print_message(f"The new sample(s) are written to: '{os.path.join(output_path, relative_stub_root)}...'", PrintDisposition.UI)
 
@@ -483,13 +2857,18 @@ def confirm_plan(args):
             print_message(f"The debug files are written to: '{os.path.join(temp_path, relative_stub_root)}...'", PrintDisposition.DEBUG)
             print_message()
 
+    # When only printing the plan, there's nothing to confirm.
+    if args.plan_only:
+        print_message("Printed the plan.", PrintDisposition.DEBUG, override_indent=True)
+        return
+
     print_message(f"Are you sure you want to continue processing the {len(directories_to_process)} samples?", PrintDisposition.UI)
     print_message("[Y] Yes [No] No (quits the application)", PrintDisposition.UI)
 
     while True:
         time.sleep(0.3)
 
-        user_response = keyboard.read_key().upper()
+        user_response = read_key().upper()
 
         global app_mode
         if user_response == "Y":
@@ -515,7 +2894,7 @@ def confirm_continuation_for_current_sample(index, total, sample_dir):
     while True:
         time.sleep(0.3)
 
-        user_response = keyboard.read_key().upper()
+        user_response = read_key().upper()
 
         global app_mode
         if user_response == "Y":
@@ -535,81 +2914,1215 @@ def confirm_continuation_for_current_sample(index, total, sample_dir):
 
     return process_current_sample
 
-def delete_previous_sample_dirs(sample_dir):
-    # If the sample output path exists, delete it.
-    sample_output_path = get_normalized_path(sample_dir, output_path)
-    if os.path.exists(sample_output_path):
-        print_message(f"Deleting sample output path: {sample_output_path}", PrintDisposition.DEBUG)
-        shutil.rmtree(sample_output_path, ignore_errors=True)
+def confirm_sample_regeneration(index, total, sample_dir):
+    # Returns the user's response: Y (regenerate the sample), A (regenerate all of them) or N (keep the sample as it is).
+    print_message("\nConfirming regeneration of current sample...", PrintDisposition.DEBUG, override_indent=True)
+
+    print_message()
+    print_message(f"Regenerate sample directory {index} of {total} that failed validation: {sample_dir}", PrintDisposition.UI)
+    print_message("This sends another request to Azure OpenAI. Are you sure you want to perform this action?", PrintDisposition.UI)
+    print_message("[Y] Yes, regenerate this sample [A] Yes to All, [N] No, keep this sample as it is, [Q] Quit the application.", PrintDisposition.UI)
+
+    while True:
+        time.sleep(0.3)
+
+        user_response = read_key().upper()
+
+        if user_response in ("Y", "A", "N"):
+            return user_response
+        elif user_response == "Q":
+            raise ValueError("User cancelled the application.")
+
+        time.sleep(0.3)
+
+def confirm_regenerations(failed_samples):
+    # Returns the failed samples that the user wants to regenerate.
+    confirmed_samples = []
 
-    # If the sample temp path exists, delete it.
+    for (i, sample_dir) in enumerate(failed_samples):
+        user_response = confirm_sample_regeneration(i+1, len(failed_samples), sample_dir)
+        if user_response == "A":
+            return confirmed_samples + failed_samples[i:]
+        elif user_response == "Y":
+            confirmed_samples.append(sample_dir)
+
+    return confirmed_samples
+
+def delete_previous_sample_temp_dir(sample_dir):
+    # The sample output path is kept: only the files that change are rewritten.
+    # Delete the sample's debug artifacts from a previous run. Subdirectories (such as the
+    # temp directories of nested samples, and the debug blobs) are left alone.
     sample_temp_path = get_normalized_path(sample_dir, temp_path)
-    if os.path.exists(sample_temp_path):
-        print_message(f"Deleting sample temp path: {sample_temp_path}", PrintDisposition.DEBUG)
-        shutil.rmtree(sample_temp_path, ignore_errors=True)
 
-def init_azure_openai():
-    openai.api_base     = OPENAI_API_BASE
-    openai.api_version  = OPENAI_VERSION
+    try:
+        with os.scandir(sample_temp_path) as entries:
+            artifact_file_names = [entry.path for entry in entries if entry.is_file(follow_symlinks=False) and is_debug_artifact_file(entry.name)]
+    except OSError:
+        return
 
+    for artifact_file_name in artifact_file_names:
+        print_message(f"Deleting previous debug artifact: {artifact_file_name}", PrintDisposition.DEBUG)
+        try:
+            os.remove(artifact_file_name)
+        except OSError:
+            pass
+
+def start_sample_metrics(sample_dir):
+    # Metrics are collected for the sample being processed by the current thread.
+    metrics_context.metrics = {"sample": sample_dir,
+                               "status": None,
+                               "cached": False,
+                               "packed": False,
+                               "chunks": 0,
+                               "source_bytes": 0,
+                               "source_tokens": 0,
+                               "retries": 0,
+                               "prompt_tokens": 0,
+                               "completion_tokens": 0,
+                               "estimated_cost": 0.0,
+                               "endpoints": [],
+                               "stages": {stage: 0.0 for stage in RUN_REPORT_STAGES},
+                               "files": {},
+                               "regenerations": 0,
+                               "validation": None,
+                               "validation_problems": [],
+                               "total_time": 0.0}
+    return metrics_context.metrics
+
+def get_sample_metrics():
+    return getattr(metrics_context, "metrics", None)
+
+@contextmanager
+def timed_stage(stage):
+    # Adds the time spent in the block to the stage's time for the current sample.
+    start_time = time.perf_counter()
     try:
-        credential = AzureCliCredential()
-
-        # If AzureCliCredential.get_token() fails, it prints its own error message.
-        # So, set color to RED just in case before the call.
-        print(Fore.RED)
-        token = credential.get_token("https://cognitiveservices.azure.com/.default")
-    except azure.identity.CredentialUnavailableError as error:
-        # Don't send any text in the exception as AzureCliCredential.get_token() 
-        # has already printed its own error message.
-        raise ValueError(f"") from error
-    except azure.core.exceptions.ClientAuthenticationError as error:
-        # Don't send any text in the exception as AzureCliCredential.get_token() 
-        # has already printed its own error message.
-        raise ValueError(f"") from error
-    
+        yield
+    finally:
+        metrics = get_sample_metrics()
+        if metrics is not None:
+            metrics["stages"][stage] += time.perf_counter() - start_time
+
+def record_token_usage(prompt_tokens, completion_tokens, endpoint):
+    # The cost depends on the model of the endpoint that the request was routed to.
+    endpoint_router.record_usage(endpoint, prompt_tokens, completion_tokens)
+
+    metrics = get_sample_metrics()
+    if metrics is not None:
+        metrics["prompt_tokens"] += prompt_tokens
+        metrics["completion_tokens"] += completion_tokens
+        metrics["estimated_cost"] += endpoint.get_cost(prompt_tokens, completion_tokens)
+        add_endpoint_names(metrics, [endpoint.name])
+
+def add_endpoint_names(metrics, endpoint_names):
+    # The names of the endpoints that the sample's requests were routed to, in order of first use.
+    for endpoint_name in endpoint_names:
+        if endpoint_name not in metrics["endpoints"]:
+            metrics["endpoints"].append(endpoint_name)
+
+def record_file_outcome(file_name, outcome):
+    # Only the first outcome counts, so that a file rewritten by a retried stream is still reported as added or changed.
+    metrics = get_sample_metrics()
+    if metrics is not None:
+        metrics["files"].setdefault(file_name, outcome)
+
+def get_file_outcome_counts(metrics):
+    outcomes = list(metrics["files"].values())
+    return {outcome: outcomes.count(outcome) for outcome in FILE_OUTCOMES}
+
+def record_source_size(sample_source):
+    metrics = get_sample_metrics()
+    if metrics is not None:
+        metrics["source_bytes"] = sample_source.byte_count
+        metrics["source_tokens"] = sample_source.get_token_count()
+
+def record_cache_hit():
+    metrics = get_sample_metrics()
+    if metrics is not None:
+        metrics["cached"] = True
+
+def record_retry():
+    metrics = get_sample_metrics()
+    if metrics is not None:
+        metrics["retries"] += 1
+
+def merge_sample_metrics(other_metrics):
+    # Add the metrics collected by another thread (such as a prefetch) to the current sample.
+    metrics = get_sample_metrics()
+    if metrics is None:
+        return
+
+    metrics["cached"] = metrics["cached"] or other_metrics["cached"]
+    for name in ("retries", "prompt_tokens", "completion_tokens", "estimated_cost"):
+        metrics[name] += other_metrics[name]
+    for stage in RUN_REPORT_STAGES:
+        metrics["stages"][stage] += other_metrics["stages"][stage]
+    add_endpoint_names(metrics, other_metrics["endpoints"])
+
+def split_packed_metrics(packed_metrics, count):
+    # Returns each packed sample's share of the metrics of the packed request.
+    shares = []
+
+    for i in range(count):
+        share = {"cached": packed_metrics["cached"], 
+                 "total_time": packed_metrics["total_time"], 
+                 "estimated_cost": packed_metrics["estimated_cost"] / count,
+                 "endpoints": packed_metrics["endpoints"], 
+                 "stages": {}}
+
+        # Counts are split evenly, with any remainder going to the first sample.
+        for name in ("retries", "prompt_tokens", "completion_tokens"):
+            share[name] = packed_metrics[name] // count + (packed_metrics[name] % count if 0 == i else 0)
+        for stage in RUN_REPORT_STAGES:
+            share["stages"][stage] = packed_metrics["stages"][stage] / count
+
+        shares.append(share)
+
+    return shares
+
+def finish_sample_metrics(status, total_time):
+    metrics = get_sample_metrics()
+    metrics_context.metrics = None
+
+    metrics["status"] = status.value
+    metrics["total_time"] = total_time
+
+    with run_metrics_lock:
+        run_metrics.append(metrics)
+
+def merge_regenerated_metrics():
+    # A regenerated sample's metrics are recorded separately, so add them to the metrics of the sample's first attempt.
+    with run_metrics_lock:
+        samples = {}
+
+        for metrics in run_metrics:
+            previous_metrics = samples.get(metrics["sample"])
+            if previous_metrics is None:
+                samples[metrics["sample"]] = metrics
+                continue
+
+            previous_metrics["status"] = metrics["status"]
+            previous_metrics["cached"] = previous_metrics["cached"] or metrics["cached"]
+            for name in ("retries", "prompt_tokens", "completion_tokens", "regenerations", "estimated_cost", "total_time"):
+                previous_metrics[name] += metrics[name]
+            for stage in RUN_REPORT_STAGES:
+                previous_metrics["stages"][stage] += metrics["stages"][stage]
+            add_endpoint_names(previous_metrics, metrics["endpoints"])
+
+            # A file added by the first attempt is still reported as added.
+            for (file_name, outcome) in metrics["files"].items():
+                previous_metrics["files"].setdefault(file_name, outcome)
+
+        run_metrics[:] = samples.values()
+
+def record_validation(sample_problems):
+    # Record the outcome of validating the samples (keyed by sample directory).
+    with run_metrics_lock:
+        for metrics in run_metrics:
+            if metrics["sample"] in sample_problems:
+                metrics["validation_problems"] = sample_problems[metrics["sample"]]
+                metrics["validation"] = "failed" if metrics["validation_problems"] else "passed"
+
+def get_run_totals(samples):
+    return {"samples": len(samples),
+            "migrated": len([metrics for metrics in samples if metrics["status"] == SampleStatus.MIGRATED.value]),
+            "failed": len([metrics for metrics in samples if metrics["status"] == SampleStatus.FAILED.value]),
+            "cached": len([metrics for metrics in samples if metrics["cached"]]),
+            "packed": len([metrics for metrics in samples if metrics["packed"]]),
+            "retries": sum(metrics["retries"] for metrics in samples),
+            "regenerations": sum(metrics["regenerations"] for metrics in samples),
+            "validation": {outcome: len([metrics for metrics in samples if metrics["validation"] == outcome]) for outcome in ("passed", "failed")},
+            "prompt_tokens": sum(metrics["prompt_tokens"] for metrics in samples),
+            "completion_tokens": sum(metrics["completion_tokens"] for metrics in samples),
+            "estimated_cost": sum(metrics["estimated_cost"] for metrics in samples),
+            "stages": {stage: sum(metrics["stages"][stage] for metrics in samples) for stage in RUN_REPORT_STAGES},
+            "files": {outcome: sum(get_file_outcome_counts(metrics)[outcome] for metrics in samples) for outcome in FILE_OUTCOMES}}
+
+def write_run_report(args, start_time, wall_time):
+    # Print the run's timings, token usage and cost, and export them (JSON and CSV) to the output directory.
+    with run_metrics_lock:
+        samples = list(run_metrics)
+
+    report = {"started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(start_time)),
+              "wall_time": wall_time,
+              "discovery_time": discovery_time,
+              "jobs": args.jobs,
+              "engine": endpoint_router.get_engines(),
+              "endpoints": [dict(endpoint.usage, name=endpoint.name, engine=endpoint.engine) for endpoint in endpoint_router.endpoints],
+              "totals": get_run_totals(samples),
+              "samples": samples}
+    if shard_info:
+        report["shard"] = f"{shard_info['index']}/{shard_info['count']}"
+
+    print_run_report(report, args.validate)
+    export_run_report(report, os.path.join(output_path, RUN_REPORT_FILE_NAME_PREFIX + time.strftime("%Y%m%d-%H%M%S", time.localtime(start_time))))
+
+def print_run_report(report, show_validation):
+    totals = report["totals"]
+    wall_time = report["wall_time"]
+
+    print_message()
+    print_message("Run report:", PrintDisposition.UI)
+    print_message(f"\tWall time: {wall_time:.1f} seconds ({totals['samples'] / wall_time * 60 if wall_time else 0:.1f} samples/minute), discovery: {report['discovery_time']:.3f} seconds", PrintDisposition.UI)
+    print_message("\tStage time (summed over samples): " + ", ".join(f"{stage} {totals['stages'][stage]:.1f}s" for stage in RUN_REPORT_STAGES), PrintDisposition.UI)
+    print_message(f"\tTokens: {totals['prompt_tokens']} prompt + {totals['completion_tokens']} completion, cached samples: {totals['cached']}, packed samples: {totals['packed']}, retries: {totals['retries']}", PrintDisposition.UI)
+    print_message("\tFiles: " + ", ".join(f"{totals['files'][outcome]} {outcome}" for outcome in FILE_OUTCOMES), PrintDisposition.UI)
+    if show_validation:
+        print_message(f"\tValidation: {totals['validation']['passed']} passed, {totals['validation']['failed']} failed, regenerations: {totals['regenerations']}", PrintDisposition.UI)
+    if 1 < len(report["endpoints"]):
+        print_message("\tEndpoints: " + ", ".join(f"{endpoint['name']} {endpoint['requests']} requests ({endpoint['failures']} failed)" 
+                                                   for endpoint in report["endpoints"]), PrintDisposition.UI)
+    print_message(f"\tEstimated cost: ${totals['estimated_cost']:.2f}", PrintDisposition.UI)
+
+def export_run_report(report, report_file_name):
+    samples = report["samples"]
+
+    try:
+        write_dictionary_to_file(report_file_name + ".json", report)
+
+        with open(report_file_name + ".csv", "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["sample", "status", "cached", "packed", "chunks", "source_bytes", "source_tokens", "retries", "prompt_tokens", "completion_tokens", "estimated_cost"] 
+                            + RUN_REPORT_STAGES + ["total_time"] + ["files_" + outcome for outcome in FILE_OUTCOMES] + ["regenerations", "validation", "endpoints"])
+            for metrics in samples:
+                writer.writerow([metrics["sample"], metrics["status"], metrics["cached"], metrics["packed"], metrics["chunks"], 
+                                 metrics["source_bytes"], metrics["source_tokens"], metrics["retries"], 
+                                 metrics["prompt_tokens"], metrics["completion_tokens"], f"{metrics['estimated_cost']:.4f}"]
+                                + [f"{metrics['stages'][stage]:.3f}" for stage in RUN_REPORT_STAGES] + [f"{metrics['total_time']:.3f}"]
+                                + [get_file_outcome_counts(metrics)[outcome] for outcome in FILE_OUTCOMES]
+                                + [metrics["regenerations"], metrics["validation"] or '', ';'.join(metrics["endpoints"])])
+    except OSError as error:
+        print_message(f"Failed to write file: {error}", PrintDisposition.ERROR)
+
+    print_message(f"\tReport written to: {report_file_name}.json (and .csv)", PrintDisposition.UI)
+
+def get_run_manifest_path():
+    return os.path.join(output_path, RUN_MANIFEST_FILE_NAME)
+
+def load_run_manifest():
+    global run_manifest
+
+    run_manifest_path = get_run_manifest_path()
+    print_message(f"Loading run manifest: {run_manifest_path}", PrintDisposition.DEBUG)
+
+    run_manifest = {"version": RUN_MANIFEST_VERSION, "samples": {}}
+
+    try:
+        with open(run_manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as error:
+        print_message(f"Ignoring unreadable run manifest ({run_manifest_path}). {error}", PrintDisposition.WARNING)
+        return
+
+    if manifest.get("version") != RUN_MANIFEST_VERSION:
+        print_message(f"Ignoring run manifest with unsupported version: {manifest.get('version')}", PrintDisposition.WARNING)
+        return
+
+    run_manifest = manifest
+
+def save_run_manifest():
+    # Must be called without run_manifest_lock held. The manifest is serialized under the
+    # lock, but written without it, so that the workers aren't held up by the write.
+    global run_manifest_dirty
+
+    run_manifest_path = get_run_manifest_path()
+
+    with run_manifest_save_lock:
+        with run_manifest_lock:
+            manifest_source = json.dumps(run_manifest)
+            run_manifest_dirty = False
+
+        try:
+            write_file_atomically(run_manifest_path, manifest_source)
+        except OSError as error:
+            print_message(f"Failed to write run manifest: {error}", PrintDisposition.WARNING)
+
+def flush_run_manifest():
+    # Save the state changes that haven't been saved yet.
+    with run_manifest_lock:
+        dirty = run_manifest_dirty
+
+    if dirty:
+        save_run_manifest()
+
+def get_sample_manifest_key(sample_dir):
+    # Key samples by their path relative to the output directory so that the
+    # manifest doesn't depend on where the sample tree is checked out.
+    return Path(os.path.relpath(get_normalized_path(sample_dir, output_path), output_path)).as_posix()
+
+def get_sample_hashes(sample_dir, sample_source = None):
+    # Returns the hash of the sample's source and the hash of the few-shot examples selected for it.
+    if sample_source is None:
+        sample_source = get_sample_source(sample_dir)
+    sample_source = sample_source.text
+    input_hash = hashlib.sha256(sample_source.encode("utf-8")).hexdigest()
+
+    selected_examples = select_prompt_examples(sample_source)
+    few_shot_source = json.dumps({"engine": endpoint_router.get_engines(),
+                                  "version": OPENAI_VERSION,
+                                  "inputs": [sample_inputs_source[i] for i in selected_examples], 
+                                  "outputs": [sample_outputs_source[i] for i in selected_examples]})
+    few_shot_hash = hashlib.sha256(few_shot_source.encode("utf-8")).hexdigest()
+
+    return (input_hash, few_shot_hash)
+
+def update_sample_manifest(sample_dir, status, sample_hashes, error = None):
+    (input_hash, few_shot_hash) = sample_hashes
+
+    entry = {"status": status.value,
+             "input_hash": input_hash,
+             "few_shot_hash": few_shot_hash,
+             "updated": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+    if error:
+        entry["error"] = str(error)
+
+    # Rewriting the whole manifest for every state change would make large runs quadratic,
+    # so the changes are saved every RUN_MANIFEST_SAVE_SECONDS (and by flush_run_manifest()).
+    # An interrupted run loses at most that much, and migrates those samples again.
+    global run_manifest_dirty, run_manifest_save_time
+
+    with run_manifest_lock:
+        run_manifest["samples"][get_sample_manifest_key(sample_dir)] = entry
+        run_manifest_dirty = True
+
+        save_due = time.monotonic() - run_manifest_save_time >= RUN_MANIFEST_SAVE_SECONDS
+        if save_due:
+            run_manifest_save_time = time.monotonic()
+
+    if save_due:
+        save_run_manifest()
+
+def is_sample_unchanged(sample_dir):
+    # A sample is unchanged if it was successfully migrated from the same inputs with the same few-shot prompt.
+    with run_manifest_lock:
+        entry = run_manifest["samples"].get(get_sample_manifest_key(sample_dir))
+
+    if entry is None or entry.get("status") != SampleStatus.MIGRATED.value:
+        return False
+
+    (input_hash, few_shot_hash) = get_sample_hashes(sample_dir)
+
+    return entry.get("input_hash") == input_hash and entry.get("few_shot_hash") == few_shot_hash
+
+def migrate_sample(sample_dir, packed_completion = None, packed_metrics = None, validation_feedback = None):
+    # When the sample was packed with others, packed_completion is its portion of the
+    # packed completion and packed_metrics is its share of the packed request's metrics.
+    # When regenerating a sample that failed validation, validation_feedback lists its problems.
+    metrics = start_sample_metrics(sample_dir)
+    start_time = time.perf_counter()
+
+    if validation_feedback is not None:
+        metrics["regenerations"] = 1
+
+    # A packed sample's total time includes the time it waited for the packed request.
+    if packed_metrics is not None:
+        start_time -= packed_metrics["total_time"]
+
+    # Read the sample once for its hashes, chunks and prompt.
+    with timed_stage("source"):
+        sample_source = get_sample_source(sample_dir)
+
+    sample_hashes = get_sample_hashes(sample_dir, sample_source)
+
+    # Record that the sample has started so that an interrupted run migrates it again.
+    update_sample_manifest(sample_dir, SampleStatus.IN_PROGRESS, sample_hashes)
+
+    try:
+        # If the sample temp directory exists, delete it.
+        delete_previous_sample_temp_dir(sample_dir)
+
+        # Write the sample file(s) from its portion of the packed completion (if any).
+        if packed_completion is not None:
+            merge_sample_metrics(packed_metrics)
+
+            try:
+                file_names = write_new_sample(sample_dir, packed_completion)
+                metrics["packed"] = True
+            except ValueError as error:
+                print_message(f"Failed to use the packed completion for: '{sample_dir}'. {error} Migrating the sample individually...", PrintDisposition.WARNING)
+
+        # Migrate a sample that doesn't fit in the context window in chunks (if enabled).
+        chunk_sources = get_sample_chunks(sample_dir, sample_source) if chunking_enabled and not metrics["packed"] else None
+
+        if chunk_sources:
+            metrics["chunks"] = len(chunk_sources)
+            file_names = write_new_sample(sample_dir, generate_chunked_sample(sample_dir, chunk_sources, validation_feedback))
+        elif not metrics["packed"]:
+            # Generate the new sample and get the Azure OpenAI completion string.
+            # When streaming, the files are written as they arrive.
+            streamed_files = []
+            completion = generate_new_sample(sample_dir, streamed_files, sample_source, validation_feedback=validation_feedback)
+
+            # Write the sample file(s), unless they were already written while streaming.
+            if streamed_files:
+                file_names = list(streamed_files)
+            else:
+                file_names = write_new_sample(sample_dir, completion)
+
+        # Remove the files that the sample no longer has.
+        remove_stale_sample_files(sample_dir, file_names)
+    except Exception as error:
+        update_sample_manifest(sample_dir, SampleStatus.FAILED, sample_hashes, error)
+        finish_sample_metrics(SampleStatus.FAILED, time.perf_counter() - start_time)
+        raise
+
+    update_sample_manifest(sample_dir, SampleStatus.MIGRATED, sample_hashes)
+    finish_sample_metrics(SampleStatus.MIGRATED, time.perf_counter() - start_time)
+
+def migrate_packed_samples(packed_samples):
+    # Migrates the (sample_dir, future) pairs with a single Azure OpenAI request and
+    # resolves each sample's future. Samples whose portion of the completion is missing
+    # or can't be parsed are migrated individually.
+    sample_dirs     = [sample_dir for (sample_dir, _) in packed_samples]
+    completion      = None
+    portions        = {}
+    packed_metrics  = start_sample_metrics(None)
+    start_time      = time.perf_counter()
+
+    if 1 < len(sample_dirs):
+        try:
+            with timed_stage("source"):
+                messages = get_packed_prompt_messages(sample_dirs)
+
+            completion = request_completion(f"{len(sample_dirs)} packed samples", messages, parse_completion=split_packed_completion)
+
+            with timed_stage("parse"):
+                portions = split_packed_completion(completion)
+        except Exception as error:
+            print_message(f"Failed to migrate {len(sample_dirs)} packed samples. {error} Migrating the samples individually...", PrintDisposition.WARNING)
+
+    metrics_context.metrics = None
+    packed_metrics["total_time"] = time.perf_counter() - start_time
+    metrics_shares = split_packed_metrics(packed_metrics, len(sample_dirs))
+
+    for (i, (sample_dir, future)) in enumerate(packed_samples):
+        if completion is not None and i not in portions:
+            print_message(f"Failed to find the packed completion for: '{sample_dir}'. Migrating the sample individually...", PrintDisposition.WARNING)
+
+        try:
+            migrate_sample(sample_dir, portions.get(i), metrics_shares[i])
+            future.set_result(None)
+        except Exception as error:
+            future.set_exception(error)
+
+def submit_packed_samples(executor, packed_samples, task_futures):
+    if packed_samples:
+        print_message(f"Packing {len(packed_samples)} sample(s) into a single request...", PrintDisposition.DEBUG)
+        task_futures.append(executor.submit(migrate_packed_samples, list(packed_samples)))
+        del packed_samples[:]
+
+def get_sample_source_tokens(sample_dir):
+    # The plan already counted the tokens of each sample's source (the estimated completion size).
+    if sample_dir in sample_estimates:
+        return sample_estimates[sample_dir]["completion_tokens"]
+
+    # A sample that can't be read isn't packed, so that it fails on its own.
+    try:
+        return get_sample_source(sample_dir).get_token_count()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+def get_validation_problems(sample_dirs):
+    # Returns the problems with each migrated sample. Parsing is CPU-bound, so the samples
+    # are validated in worker processes rather than threads.
+    sample_output_paths = [get_normalized_path(sample_dir, output_path) for sample_dir in sample_dirs]
+    worker_count = min(len(sample_output_paths), os.cpu_count() or 1)
+
+    try:
+        with ProcessPoolExecutor(max_workers=worker_count) as executor:
+            return list(executor.map(validate_sample_output, sample_output_paths, 
+                                     chunksize=max(1, len(sample_output_paths) // (worker_count * 4))))
+    except (OSError, BrokenProcessPool, pickle.PicklingError) as error:
+        print_message(f"Failed to start the validation processes. {error} Validating the samples in this process...", PrintDisposition.WARNING)
+        return [validate_sample_output(sample_output_path) for sample_output_path in sample_output_paths]
+
+def get_validation_feedback(attempt, problems):
+    return VALIDATION_FEEDBACK.format(attempt) + "\n" + "\n".join(f"- {problem}" for problem in problems)
+
+def validate_samples(args, sample_dirs):
+    # Validates the migrated samples and regenerates only the ones that fail, up to
+    # args.validation_retries times. Returns the problems of each sample (keyed by
+    # sample directory), which are empty for the samples that passed.
+    sample_problems     = {}
+    samples_to_validate = list(sample_dirs)
+
+    for attempt in range(1, args.validation_retries + 2):
+        print_message(f"\nValidating {len(samples_to_validate)} migrated sample(s)...", PrintDisposition.DEBUG, override_indent=True)
+        sample_problems.update(zip(samples_to_validate, get_validation_problems(samples_to_validate)))
+
+        failed_samples = [sample_dir for sample_dir in samples_to_validate if sample_problems[sample_dir]]
+        for sample_dir in failed_samples:
+            print_message(f"Sample failed validation: {sample_dir}", PrintDisposition.WARNING)
+            for problem in sample_problems[sample_dir]:
+                print_message(f"\t{problem}", PrintDisposition.DEBUG)
+
+            uncache_sample_completions(sample_dir)
+
+        if not failed_samples or attempt > args.validation_retries:
+            break
+
+        # Regenerating sends more requests, so ask first unless the run was confirmed up front (--yes).
+        if not args.yes:
+            failed_samples = confirm_regenerations(failed_samples)
+            if not failed_samples:
+                break
+
+        # Regenerate the failed samples, telling the model what was wrong with them.
+        print_message(f"\nRegenerating {len(failed_samples)} sample(s) that failed validation (retry {attempt} of {args.validation_retries})...", 
+                      PrintDisposition.STATUS, override_indent=True)
+        samples_to_validate = []
+
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [(sample_dir, executor.submit(migrate_sample, sample_dir, validation_feedback=get_validation_feedback(attempt, sample_problems[sample_dir]))) 
+                       for sample_dir in failed_samples]
+
+            for (sample_dir, future) in futures:
+                try:
+                    future.result()
+                    samples_to_validate.append(sample_dir)
+                except Exception as error:
+                    print_message(f"Failed to regenerate sample: {sample_dir}. {error}", PrintDisposition.ERROR)
+                    sample_problems[sample_dir] = sample_problems[sample_dir] + [f"Failed to regenerate the sample. {error}"]
+
+        if not samples_to_validate:
+            break
+
+    # Samples that still fail are recorded as failed so that --resume migrates them again.
+    for (sample_dir, problems) in sample_problems.items():
+        if problems:
+            update_sample_manifest(sample_dir, SampleStatus.FAILED, get_sample_hashes(sample_dir), "Failed validation. " + " ".join(problems))
+
+    merge_regenerated_metrics()
+    record_validation(sample_problems)
+
+    return sample_problems
+
+def report_finished_samples(pending_samples, failed_samples, migrated_samples, wait_for_all = False):
+    # Report finished samples in the order they were submitted. A sample that
+    # finishes early is held back until every sample before it has been reported.
+    while pending_samples and (wait_for_all or pending_samples[0][2].done()):
+        index, sample_dir, future = pending_samples.popleft()
+
+        try:
+            future.result()
+            print_message(f"\nSample {index} of {get_sample_total()} successfully migrated: {sample_dir}", PrintDisposition.SUCCESS)
+            migrated_samples.append(sample_dir)
+        except Exception as error:
+            # Isolate the failure to the current sample so that the rest of the run continues.
+            print_message(f"\nFailed to migrate sample {index} of {get_sample_total()}: {sample_dir}. {error}", PrintDisposition.ERROR)
+            failed_samples.append((sample_dir, error))
+
+def migrate_samples(args):
+    print_message(f"\nMigrating samples ({args.jobs} concurrent job(s))...", PrintDisposition.DEBUG, override_indent=True)
+
+    migrated_samples    = []
+    failed_samples      = []
+    skipped_count       = 0
+    unchanged_count     = 0
+    sample_problems     = {}
+
+    load_run_manifest()
+
+    start_time = time.time()
+
+    # Each entry is (index, sample_dir, future), in submission order.
+    pending_samples = deque()
+
+    # The futures of the tasks submitted to the executor (a packed request migrates several samples).
+    task_futures = []
+
+    # The (sample_dir, future) pairs waiting to be packed into the next request.
+    packed_samples  = []
+    packed_tokens   = 0
+
+    executor = ThreadPoolExecutor(max_workers=args.jobs)
+    prefetch_executor = ThreadPoolExecutor(max_workers=max(args.prefetch, 1))
+    try:
+        # For each directory to process...
+        sample_dirs = discover_directories_to_process(args) if args.yes and not discovery_complete else list(directories_to_process)
+        for i, sample_dir in enumerate(sample_dirs):
+
+            # Wait for a free worker so that no more than args.jobs samples (or packed requests) are in flight.
+            # With a single job, this also keeps the original behavior of finishing
+            # the current sample before asking about the next one.
+            task_futures = [future for future in task_futures if not future.done()]
+            if len(task_futures) >= args.jobs:
+                wait(task_futures, return_when=FIRST_COMPLETED)
+            report_finished_samples(pending_samples, failed_samples, migrated_samples)
+
+            # If resuming, skip samples that were already migrated from the same inputs.
+            if args.resume and is_sample_unchanged(sample_dir):
+                print_message(f"Skipping unchanged sample {i+1} of {get_sample_total()}: {sample_dir}", PrintDisposition.DEBUG)
+                unchanged_count += 1
+                continue
+
+            # While the user is confirming the sample, prefetch it and the next ones.
+            if args.prefetch and app_mode == AppMode.CONFIRM_CONTINUE_AFTER_EACH_SAMPLE:
+                prefetch_completions(prefetch_executor, sample_dirs[i:i+args.prefetch], args)
+
+            if (app_mode == AppMode.PROCESS_ALL_SAMPLES_WITHOUT_INTERRUPTION
+            or confirm_continuation_for_current_sample(i+1, get_sample_total(), sample_dir)):
+                sample_tokens = get_sample_source_tokens(sample_dir) if args.pack else None
+
+                # When processing all samples, pack small samples into a single request.
+                if (args.pack and app_mode == AppMode.PROCESS_ALL_SAMPLES_WITHOUT_INTERRUPTION 
+                and sample_tokens is not None and sample_tokens <= PACK_SAMPLE_MAX_TOKENS):
+                    if packed_tokens + sample_tokens > PACK_MAX_TOKENS:
+                        submit_packed_samples(executor, packed_samples, task_futures)
+                        packed_tokens = 0
+
+                    future = Future()
+                    packed_samples.append((sample_dir, future))
+                    packed_tokens += sample_tokens
+
+                    if len(packed_samples) == args.pack:
+                        submit_packed_samples(executor, packed_samples, task_futures)
+                        packed_tokens = 0
+                else:
+                    future = executor.submit(migrate_sample, sample_dir)
+                    task_futures.append(future)
+
+                pending_samples.append((i+1, sample_dir, future))
+            else:
+                discard_prefetched_completion(sample_dir)
+                skipped_count += 1
+
+        # Wait for (and report) the remaining samples.
+        submit_packed_samples(executor, packed_samples, task_futures)
+        report_finished_samples(pending_samples, failed_samples, migrated_samples, wait_for_all=True)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+        # Discard any prefetches that weren't used (such as when the user quits).
+        with prefetch_lock:
+            prefetched_completions.clear()
+        prefetch_executor.shutdown(wait=True, cancel_futures=True)
+
+        # Save the sample states that haven't been saved yet (even if the run was interrupted).
+        flush_run_manifest()
+
+    # Check the migrated samples locally and regenerate the ones that fail.
+    if args.validate and migrated_samples:
+        try:
+            sample_problems = validate_samples(args, migrated_samples)
+        finally:
+            flush_run_manifest()
+
+    # Delete the debug blobs of the prompts and completions that were replaced.
+    if debug_mode:
+        collect_debug_blobs(start_time)
+
+    # Print the run summary.
+    print_message()
+    print_message(f"Migrated: {len(migrated_samples)}, Failed: {len(failed_samples)}, Skipped: {skipped_count}, Unchanged: {unchanged_count}", 
+                  PrintDisposition.ERROR if failed_samples else PrintDisposition.SUCCESS)
+    for (sample_dir, error) in failed_samples:
+        print_message(f"\t{sample_dir}: {error}", PrintDisposition.ERROR)
+
+    if sample_problems:
+        invalid_samples = [sample_dir for sample_dir in migrated_samples if sample_problems[sample_dir]]
+        print_message(f"Validation: {len(migrated_samples) - len(invalid_samples)} passed, {len(invalid_samples)} failed", 
+                      PrintDisposition.ERROR if invalid_samples else PrintDisposition.SUCCESS)
+        for sample_dir in invalid_samples:
+            print_message(f"\t{sample_dir}:", PrintDisposition.ERROR)
+            for problem in sample_problems[sample_dir]:
+                print_message(f"\t\t{problem}", PrintDisposition.ERROR)
+
+    # Print and export the timings, token usage and cost of the migrated samples.
+    if run_metrics:
+        write_run_report(args, start_time, time.time() - start_time)
+
+def load_shard_output(shard_output_path):
+    # Returns the shard file, run manifest and latest run report (if any) of a --shard run's output directory.
+    try:
+        with open(os.path.join(shard_output_path, SHARD_FILE_NAME), encoding="utf-8") as f:
+            shard = json.load(f)
+    except FileNotFoundError as error:
+        raise ValueError(f"Not the output directory of a --shard run (no {SHARD_FILE_NAME}): {shard_output_path}") from error
+    except (OSError, ValueError) as error:
+        raise ValueError(f"Failed to read the shard file of '{shard_output_path}'. {error}") from error
+
+    # A shard that hasn't migrated any samples has no manifest.
+    manifest = {"version": RUN_MANIFEST_VERSION, "samples": {}}
+    try:
+        with open(os.path.join(shard_output_path, RUN_MANIFEST_FILE_NAME), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as error:
+        raise ValueError(f"Failed to read the run manifest of '{shard_output_path}'. {error}") from error
+
+    if manifest.get("version") != RUN_MANIFEST_VERSION:
+        raise ValueError(f"Unsupported run manifest version in '{shard_output_path}': {manifest.get('version')}")
+
+    # The report file names start with their timestamps, so the last one is the latest.
+    report = None
+    report_file_names = sorted(file_name for file_name in os.listdir(shard_output_path) 
+                               if file_name.startswith(RUN_REPORT_FILE_NAME_PREFIX) and file_name.endswith(".json"))
+    if report_file_names:
+        try:
+            with open(os.path.join(shard_output_path, report_file_names[-1]), encoding="utf-8") as f:
+                report = json.load(f)
+        except (OSError, ValueError) as error:
+            print_message(f"Ignoring unreadable run report ({report_file_names[-1]}) of '{shard_output_path}'. {error}", PrintDisposition.WARNING)
+
+    return {"path": shard_output_path, "shard": shard, "manifest": manifest, "report": report}
+
+def copy_shard_output(shard_output_path):
+    # Copies the shard's samples (but not its shard file, manifest and run reports) to the output directory.
+    for (dir_path, dir_names, file_names) in os.walk(shard_output_path):
+        relative_dir = os.path.relpath(dir_path, shard_output_path)
+
+        for file_name in file_names:
+            if '.' == relative_dir and (file_name in (SHARD_FILE_NAME, RUN_MANIFEST_FILE_NAME) or file_name.startswith(RUN_REPORT_FILE_NAME_PREFIX)):
+                continue
+
+            try:
+                os.makedirs(os.path.join(output_path, relative_dir), exist_ok=True)
+                shutil.copy2(os.path.join(dir_path, file_name), os.path.join(output_path, relative_dir, file_name))
+            except OSError as error:
+                raise ValueError(f"Failed to copy the samples of '{shard_output_path}'. {error}") from error
+
+def merge_endpoint_usage(reports):
+    # Adds up the usage of the endpoints with the same name.
+    endpoints = {}
+
+    for report in reports:
+        for endpoint in report["endpoints"]:
+            merged_endpoint = endpoints.setdefault(endpoint["name"], {"name": endpoint["name"], "engine": endpoint["engine"]})
+            for (key, value) in endpoint.items():
+                if key not in ("name", "engine"):
+                    merged_endpoint[key] = merged_endpoint.get(key, 0) + value
+
+    return list(endpoints.values())
+
+def merge_shard_outputs(args):
+    # Combines the output directories of --shard runs into the output directory, and checks
+    # that each of the discovered samples was migrated (or failed) by exactly one shard.
+    global run_manifest
+
+    init_output_path(args, get_application_path())
+
+    shards = []
+    for shard_output_directory in args.merge:
+        shard_output_path = os.path.abspath(shard_output_directory)
+        if shard_output_path == output_path:
+            raise ValueError(f"The output directory can't be one of the shards being merged: {output_path}")
+        shards.append(load_shard_output(shard_output_path))
+
+    # The shards must have split the same samples in the same way.
+    shard_count = shards[0]["shard"]["count"]
+    sample_total = shards[0]["shard"]["sample_total"]
+    for shard in shards[1:]:
+        if shard["shard"]["count"] != shard_count or shard["shard"]["assignment_hash"] != shards[0]["shard"]["assignment_hash"]:
+            raise ValueError(f"'{shard['path']}' and '{shards[0]['path']}' didn't split the same samples into shards. "
+                             "Run every shard with the same sample tree, options and prompt inputs.")
+
+    shards.sort(key=lambda shard: shard["shard"]["index"])
+    shard_indexes = [shard["shard"]["index"] for shard in shards]
+    missing_shards = [index for index in range(1, shard_count + 1) if index not in shard_indexes]
+
+    print_message(f"\nMerging {len(shards)} of {shard_count} shard(s) into '{output_path}'...", PrintDisposition.STATUS, override_indent=True)
+
+    # A sample is done when a shard migrated it or failed to. If several shards did, the last one's output wins.
+    merged_samples  = {}
+    sample_shards   = {}
+    for shard in shards:
+        for (sample_key, entry) in shard["manifest"]["samples"].items():
+            if entry.get("status") in (SampleStatus.MIGRATED.value, SampleStatus.FAILED.value):
+                merged_samples[sample_key] = entry
+                sample_shards.setdefault(sample_key, []).append(shard["shard"]["index"])
+
+        copy_shard_output(shard["path"])
+
+    assigned_samples    = {sample_key for shard in shards for sample_key in shard["shard"]["samples"]}
+    missing_samples     = sorted(sample_key for sample_key in assigned_samples if sample_key not in merged_samples)
+    duplicate_samples   = sorted(sample_key for (sample_key, indexes) in sample_shards.items() if 1 < len(indexes))
+    unassigned_count    = sample_total - len(assigned_samples) # The samples of the missing shards.
+
+    run_manifest = {"version": RUN_MANIFEST_VERSION, "samples": merged_samples}
+    save_run_manifest()
+
+    # Print the merge summary.
+    migrated_count = len([entry for entry in merged_samples.values() if entry["status"] == SampleStatus.MIGRATED.value])
+    failed_samples = [(sample_key, entry.get("error", '')) for (sample_key, entry) in sorted(merged_samples.items()) if entry["status"] == SampleStatus.FAILED.value]
+
+    print_message()
+    print_message(f"Migrated: {migrated_count}, Failed: {len(failed_samples)}, Missing: {len(missing_samples) + unassigned_count}, Duplicate: {len(duplicate_samples)} (of {sample_total} sample(s))", 
+                  PrintDisposition.ERROR if failed_samples or missing_samples or missing_shards or duplicate_samples else PrintDisposition.SUCCESS)
+    for (sample_key, error) in failed_samples:
+        print_message(f"\t{sample_key}: {error}", PrintDisposition.ERROR)
+    if missing_shards:
+        print_message(f"\tMissing shard(s) {', '.join(f'{index}/{shard_count}' for index in missing_shards)}: {unassigned_count} sample(s)", PrintDisposition.ERROR)
+    for sample_key in missing_samples:
+        print_message(f"\t{sample_key}: missing (assigned to shard {next(shard['shard']['index'] for shard in shards if sample_key in shard['shard']['samples'])}/{shard_count})", PrintDisposition.ERROR)
+    for sample_key in duplicate_samples:
+        print_message(f"\t{sample_key}: duplicate (shards {', '.join(f'{index}/{shard_count}' for index in sample_shards[sample_key])})", PrintDisposition.ERROR)
+
+    # Combine the shards' latest run reports. The shards run side by side, so the wall time is the longest of them.
+    # Each report's engine is the comma-separated list of the models that its shard could use (see get_engines()).
+    reports = [shard["report"] for shard in shards if shard["report"]]
+    samples = [metrics for report in reports for metrics in report["samples"]]
+
+    report = {"started": min((report["started"] for report in reports), default=None),
+              "wall_time": max((report["wall_time"] for report in reports), default=0.0),
+              "discovery_time": max((report["discovery_time"] for report in reports), default=0.0),
+              "jobs": sum(report["jobs"] for report in reports),
+              "engine": ','.join(sorted({engine for report in reports for engine in report["engine"].split(',')})) if reports else None,
+              "endpoints": merge_endpoint_usage(reports),
+              "totals": get_run_totals(samples),
+              "samples": samples,
+              "shards": [{"shard": f"{shard['shard']['index']}/{shard_count}", "output_directory": shard["path"], "samples": len(shard["shard"]["samples"])} for shard in shards],
+              "missing_shards": missing_shards,
+              "missing_samples": missing_samples,
+              "duplicate_samples": duplicate_samples}
+
+    print_run_report(report, 0 < sum(report["totals"]["validation"].values()))
+    export_run_report(report, os.path.join(output_path, RUN_REPORT_FILE_NAME_PREFIX + time.strftime("%Y%m%d-%H%M%S")))
+
+def import_azure_openai_modules():
+    global openai, azure, requests, AzureCliCredential
+
+    import requests
+    import requests.adapters
+    import azure.core.exceptions
+    import azure.identity
+    import openai
+    import openai.error
+    from azure.identity import AzureCliCredential
+
+def init_azure_openai(args):
+    import_azure_openai_modules()
+
+    openai.api_base     = args.api_base
+    openai.api_version  = OPENAI_VERSION
     openai.api_type     = OPENAI_API_TYPE
-    openai.api_key      = token.token
+
+    # Send every request through a keep-alive connection pool per endpoint (sized for
+    # all concurrent requests) instead of a new connection per thread.
+    # openai 0.28 closes each thread's session once it's 180 seconds old (MAX_SESSION_LIFETIME_SECS),
+    # and this session is every thread's session, so closing it would drop the connections of the
+    # requests that other threads are sending. It's never closed instead: urllib3 already replaces
+    # the connections that the server closes, and the rest are closed when the process exits.
+    class SharedSession(requests.Session):
+        def close(self):
+            pass
+
+    session = SharedSession()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(endpoint_router.endpoints), pool_maxsize=max(1, args.jobs + args.prefetch))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    openai.requestssession = session
+
+    # An endpoint can have its own API key (named by its api_key_variable).
+    for endpoint in endpoint_router.endpoints:
+        if endpoint.api_key_variable:
+            api_key = os.environ.get(endpoint.api_key_variable)
+            if not api_key:
+                raise ValueError(f"The API key of endpoint '{endpoint.name}' isn't set: {endpoint.api_key_variable}")
+            endpoint.api_type       = OPENAI_API_TYPE_KEY
+            endpoint.token_provider = ApiKeyProvider(api_key)
+
+    shared_endpoints = [endpoint for endpoint in endpoint_router.endpoints if endpoint.token_provider is None]
+    if not shared_endpoints:
+        return
+
+    global token_provider
+
+    # Use the API key if one is set (such as for a local stand-in for Azure OpenAI).
+    api_key = os.environ.get(OPENAI_API_KEY_VARIABLE)
+    if api_key:
+        print_message(f"Using the API key from {OPENAI_API_KEY_VARIABLE}.", PrintDisposition.DEBUG)
+        openai.api_type = OPENAI_API_TYPE_KEY
+        openai.api_key  = api_key
+        token_provider  = ApiKeyProvider(api_key)
+    else:
+        # Get the access token from the token cache or, failing that, the Azure CLI.
+        token_provider = AccessTokenProvider(os.path.join(os.path.expanduser("~"), TOKEN_CACHE_DIRECTORY_NAME, TOKEN_CACHE_FILE_NAME))
+
+        if not token_provider.load_cached_token():
+            token_provider.refresh_token()
+
+        # Each request gets the current token from the token provider.
+        openai.api_key      = token_provider.get_token()
+
+    # The other endpoints share the API key or access token.
+    for endpoint in shared_endpoints:
+        endpoint.api_type       = openai.api_type
+        endpoint.token_provider = token_provider
+
+def get_serve_info_path():
+    return os.path.join(os.path.expanduser("~"), TOKEN_CACHE_DIRECTORY_NAME, SERVE_INFO_FILE_NAME)
+
+def write_serve_info(url, access_token):
+    # The file is readable and writable only by the current user, so only they can submit jobs.
+    serve_info_path = get_serve_info_path()
+
+    try:
+        os.makedirs(os.path.dirname(serve_info_path), mode=0o700, exist_ok=True)
+        write_file_atomically(serve_info_path, json.dumps({"url": url, "token": access_token, "pid": os.getpid()}))
+    except OSError as error:
+        raise ValueError(f"Failed to write the server info file. {error}") from error
+
+def remove_serve_info(url):
+    # Leave the file alone if another server has replaced it.
+    serve_info_path = get_serve_info_path()
+
+    try:
+        with open(serve_info_path, encoding="utf-8") as f:
+            if json.load(f).get("url") == url:
+                os.remove(serve_info_path)
+    except (OSError, ValueError) as error:
+        print_message(f"Failed to remove the server info file. {error}", PrintDisposition.DEBUG)
+
+def get_job_args(job, server_args):
+    # Parses a submitted job's command line. Its paths are relative to the client's working
+    # directory, and the server's settings apply to the resources that the jobs share.
+    if not isinstance(job, dict) or not isinstance(job.get("args"), list) or not isinstance(job.get("cwd"), str):
+        raise ValueError("Invalid job.")
+
+    try:
+        job_args = parse_args([str(arg) for arg in job["args"]])
+    except SystemExit as error:
+        raise ValueError("Invalid job arguments.") from error
+
+    if job_args.serve or job_args.submit or job_args.merge or job_args.plan_only or job_args.show_prompt or job_args.build_prompt_bundle:
+        raise ValueError("Only migrations can be submitted to a server.")
+
+    job_args.sample_directory = os.path.join(job["cwd"], job_args.sample_directory)
+    if job_args.output_directory:
+        job_args.output_directory = os.path.join(job["cwd"], job_args.output_directory)
+
+    job_args.yes        = True
+    job_args.prefetch   = 0
+    job_args.jobs       = server_args.jobs
+    job_args.debug      = server_args.debug
+
+    return job_args
+
+def run_job(job_args):
+    # Migrates a job's samples without asking for confirmation, reusing the server's warm state.
+    global app_mode
+
+    reset_run_state()
+    init_app(job_args)
+    if job_args.chunk:
+        get_chunk_token_budget()
+    if job_args.shard:
+        select_shard_samples(job_args)
+    app_mode = AppMode.PROCESS_ALL_SAMPLES_WITHOUT_INTERRUPTION
+    migrate_samples(job_args)
+
+def handle_job_request(handler, server_args, access_token, job_lock):
+    # Runs the submitted job and streams its messages back to the client as JSON lines.
+    global message_sink
+
+    if handler.path != SERVE_JOBS_PATH:
+        handler.send_error(404)
+        return
+
+    if not hmac.compare_digest(handler.headers.get("Authorization", ""), f"Bearer {access_token}"):
+        handler.send_error(403)
+        return
+
+    try:
+        job = json.loads(handler.rfile.read(int(handler.headers.get("Content-Length", 0))))
+    except ValueError:
+        handler.send_error(400)
+        return
+
+    handler.send_response(200)
+    handler.send_header("Content-Type", "application/x-ndjson")
+    handler.end_headers()
+
+    client_connected = True
+
+    def send_event(event):
+        # The job keeps running if the client goes away.
+        nonlocal client_connected
+        if client_connected:
+            try:
+                handler.wfile.write((json.dumps(event) + "\n").encode("utf-8"))
+                handler.wfile.flush()
+            except OSError:
+                client_connected = False
+
+    if not job_lock.acquire(blocking=False):
+        send_event({"text": "Waiting for the running job to finish...", "disposition": PrintDisposition.STATUS.name})
+        job_lock.acquire()
+
+    try:
+        print_message(f"Running job: {job.get('args') if isinstance(job, dict) else job}")
+        start_time = time.time()
+
+        message_sink = lambda text, disp: send_event({"text": text, "disposition": disp.name})
+        try:
+            run_job(get_job_args(job, server_args))
+        except Exception as error:
+            print_message(f"\nFailed to migrate sample(s). {error}", PrintDisposition.ERROR)
+        finally:
+            message_sink = None
+
+        print_message(f"Job finished in {time.time() - start_time:.1f} seconds.")
+    finally:
+        job_lock.release()
+
+    send_event({"done": True})
+
+def serve(args):
+    # Keeps everything that doesn't depend on the job warm: the prompt inputs, the tokenizer,
+    # and the endpoints with their credentials, rate controllers and connection pools.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    init_debug_mode(args)
+
+    if args.jobs < 1:
+        raise ValueError(f"The number of jobs must be at least 1: {args.jobs}")
+
+    init_endpoints(args)
+    get_prompt_input_source()
+    get_token_encoding()
+    init_azure_openai(args)
+
+    access_token = secrets.token_urlsafe(32)
+    job_lock = threading.Lock()
+
+    class JobRequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            handle_job_request(self, args, access_token, job_lock)
+
+        def log_message(self, format, *log_args):
+            print_message(format % log_args, PrintDisposition.DEBUG)
+
+    try:
+        server = ThreadingHTTPServer((SERVE_HOST, args.port), JobRequestHandler)
+    except OSError as error:
+        raise ValueError(f"Failed to start the server. {error}") from error
+
+    server.daemon_threads = True
+    url = f"http://{SERVE_HOST}:{server.server_port}"
+    write_serve_info(url, access_token)
+
+    print_message(f"\nServing migration jobs at {url}. Submit them with --submit. Press Ctrl+C to stop.", PrintDisposition.SUCCESS)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print_message("\nStopping the server...")
+    finally:
+        server.server_close()
+        remove_serve_info(url)
+
+def submit_job(args):
+    # A thin client: it sends the command line to the running server and prints the job's
+    # messages as they arrive, without loading the Azure OpenAI modules or the prompt inputs.
+    import urllib.request
+    import urllib.error
+
+    if args.serve or args.merge or args.plan_only or args.show_prompt or args.build_prompt_bundle:
+        raise ValueError("Only migrations can be submitted to a server.")
+
+    try:
+        with open(get_serve_info_path(), encoding="utf-8") as f:
+            serve_info = json.load(f)
+    except FileNotFoundError as error:
+        raise ValueError("No server is running. Start one with --serve.") from error
+    except (OSError, ValueError) as error:
+        raise ValueError(f"Failed to read the server info file. {error}") from error
+
+    job = {"args": [arg for arg in sys.argv[1:] if arg != "--submit"], "cwd": os.getcwd()}
+    request = urllib.request.Request(serve_info["url"] + SERVE_JOBS_PATH, 
+                                     data=json.dumps(job).encode("utf-8"),
+                                     headers={"Content-Type": "application/json", "Authorization": f"Bearer {serve_info['token']}"})
+
+    # The server is local, so don't send the job through a proxy.
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+    try:
+        with opener.open(request) as response:
+            for line in response:
+                event = json.loads(line)
+                if "text" in event:
+                    print_message(event["text"], PrintDisposition[event["disposition"]], override_indent=True)
+    except (urllib.error.URLError, OSError) as error:
+        raise ValueError(f"Failed to submit the job to the server at {serve_info['url']} (is it still running?). {error}") from error
 
 def main():
     try:
         # Get the command-line args (parameters).
         args = parse_args()
 
-        # Initialize Azure OpenAI.
-        init_azure_openai()
+        # Build the prompt inputs bundle (build step).
+        if args.build_prompt_bundle:
+            init_debug_mode(args)
+            build_prompt_bundle()
+            return
+
+        # Print a sample's prompt from the debug artifacts.
+        if args.show_prompt:
+            show_debug_prompt(args)
+            return
+
+        # Combine the output directories of the shards.
+        if args.merge:
+            init_debug_mode(args)
+            merge_shard_outputs(args)
+            return
+
+        # Submit the migration to the running server.
+        if args.submit:
+            init_debug_mode(args)
+            submit_job(args)
+            return
+
+        # Serve migration jobs until stopped.
+        if args.serve:
+            serve(args)
+            return
 
         # Initialize the application.
         init_app(args)
+        init_endpoints(args)
 
-        # Print the plan to the user so that they know what is going to happen.
-        confirm_plan(args)
+        # Check that the examples leave room for chunks.
+        if args.chunk:
+            get_chunk_token_budget()
 
         # Get the source code for the samples that are being used as the prompt 
         # to illustrate the "before and after" samples to Azure OpenAI.
+        # The plan uses them to estimate the size of each prompt.
         get_prompt_input_source()
 
-        # For each directory to process...
-        for i, sample_dir in enumerate(directories_to_process):
-
-            if (app_mode == AppMode.PROCESS_ALL_SAMPLES_WITHOUT_INTERRUPTION
-            or confirm_continuation_for_current_sample(i+1, len(directories_to_process), sample_dir)):
+        # Keep only the samples of this machine's shard.
+        if args.shard:
+            select_shard_samples(args)
 
-                # If the sample directories (output & temp) exists, delete them.
-                delete_previous_sample_dirs(sample_dir)
+        # Print the plan to the user so that they know what is going to happen.
+        if args.yes and not args.plan_only:
+            global app_mode
+            app_mode = AppMode.PROCESS_ALL_SAMPLES_WITHOUT_INTERRUPTION
+        else:
+            confirm_plan(args)
 
-                # Generate the new sample and get the Azure OpenAI completion string.
-                completion = generate_new_sample(sample_dir)
+        # Nothing past this point is needed to print the plan, and there's
+        # no need to sign in to Azure if there are no samples to migrate.
+        if args.plan_only or (discovery_complete and 0 == len(directories_to_process)):
+            return
 
-                # Write the sample file(s).
-                write_new_sample(sample_dir, completion)
+        # Initialize Azure OpenAI.
+        init_azure_openai(args)
 
-                # Print success message.
-                print_message(f"\nSample successfully migrated: {sample_dir}", PrintDisposition.SUCCESS)
+        # Migrate the samples.
+        migrate_samples(args)
 
     except ValueError as error:
         print_message(f"\nFailed to migrate sample(s). {error}", PrintDisposition.ERROR)
     except Exception as error:
         print_message(f"\nFailed to migrate sample(s). {error}", PrintDisposition.ERROR)
 
-main()
+if __name__ == "__main__":
+    # Lets the validation worker processes start when running as a PyInstaller binary.
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,16 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+APP_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "terraform-migrate-sample.py")
+
+@pytest.fixture(scope="session")
+def app():
+    # The app script's name isn't a valid module name, so load it from its path.
+    spec = importlib.util.spec_from_file_location("terraform_migrate_sample", APP_SCRIPT_PATH)
+    app = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = app
+    spec.loader.exec_module(app)
+    return app
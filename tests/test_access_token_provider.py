@@ -0,0 +1,54 @@
+import threading
+import time
+
+def get_token_provider(app, tmp_path, refresh_seconds = 0.1):
+    # Returns the provider and the list of its calls to the Azure CLI, which are replaced by a slow stand-in.
+    token_provider = app.AccessTokenProvider(str(tmp_path / "token.json"))
+    refreshes = []
+
+    def refresh_token():
+        refreshes.append(threading.current_thread().name)
+        time.sleep(refresh_seconds)
+        with token_provider.lock:
+            token_provider.token        = f"token{len(refreshes)}"
+            token_provider.expires_on   = time.time() + 3600
+
+    token_provider.refresh_token = refresh_token
+    return (token_provider, refreshes)
+
+def get_tokens_concurrently(token_provider, thread_count = 8):
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(token_provider.get_token())) for _ in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return tokens
+
+def test_concurrent_requests_without_a_token_refresh_it_once(app, tmp_path):
+    (token_provider, refreshes) = get_token_provider(app, tmp_path)
+
+    assert get_tokens_concurrently(token_provider) == ["token1"] * 8
+    assert len(refreshes) == 1
+
+def test_concurrent_requests_with_an_expired_token_refresh_it_once(app, tmp_path):
+    (token_provider, refreshes) = get_token_provider(app, tmp_path)
+    token_provider.token        = "expired"
+    token_provider.expires_on   = time.time() - 1
+
+    assert get_tokens_concurrently(token_provider) == ["token1"] * 8
+    assert len(refreshes) == 1
+
+def test_token_that_expires_soon_is_used_while_its_refreshed_in_the_background(app, tmp_path):
+    (token_provider, refreshes) = get_token_provider(app, tmp_path)
+    token_provider.token        = "current"
+    token_provider.expires_on   = time.time() + app.TOKEN_REFRESH_MARGIN_SECONDS / 2
+
+    assert get_tokens_concurrently(token_provider) == ["current"] * 8
+
+    deadline = time.time() + 5
+    while token_provider.get_token() == "current" and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert token_provider.get_token() == "token1"
+    assert len(refreshes) == 1
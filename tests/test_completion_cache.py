@@ -0,0 +1,58 @@
+import types
+
+import pytest
+
+MESSAGES = [{"role": "user", "content": "Migrate the sample."}]
+
+COMPLETE_COMPLETION = "###main.tf###\nresource \"a\" \"b\" {}\nmain.tf:end\n"
+
+TRUNCATED_COMPLETION = "###main.tf###\nresource \"a\" \"b\" {\n"
+
+@pytest.fixture
+def completion_cache(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "cache_enabled", True)
+    monkeypatch.setattr(app, "cache_path", str(tmp_path))
+    monkeypatch.setattr(app, "endpoint_router", types.SimpleNamespace(get_engines=lambda: "test-engine"))
+    return tmp_path
+
+def use_completions(app, monkeypatch, completions):
+    # Returns the list of the calls made to Azure OpenAI, each of which returns the next completion.
+    calls = []
+
+    def call_azure_openai(sample_dir, messages, streamed_files):
+        calls.append(sample_dir)
+        return completions[len(calls) - 1]
+
+    monkeypatch.setattr(app, "call_azure_openai", call_azure_openai)
+    return calls
+
+def test_complete_completion_is_served_from_cache(app, monkeypatch, completion_cache):
+    calls = use_completions(app, monkeypatch, [COMPLETE_COMPLETION])
+
+    assert app.request_completion("sample", MESSAGES) == COMPLETE_COMPLETION
+    assert app.request_completion("sample", MESSAGES) == COMPLETE_COMPLETION
+    assert len(calls) == 1
+
+def test_completion_missing_end_marker_is_not_cached(app, monkeypatch, completion_cache):
+    calls = use_completions(app, monkeypatch, [TRUNCATED_COMPLETION, COMPLETE_COMPLETION])
+
+    assert app.request_completion("sample", MESSAGES) == TRUNCATED_COMPLETION
+    assert not list(completion_cache.iterdir())
+
+    # The next run requests a new completion instead of reusing the truncated one.
+    assert app.request_completion("sample", MESSAGES) == COMPLETE_COMPLETION
+    assert len(calls) == 2
+
+def test_cached_completion_that_cant_be_parsed_is_discarded(app, monkeypatch, completion_cache):
+    calls = use_completions(app, monkeypatch, [COMPLETE_COMPLETION])
+    app.cache_completion(MESSAGES, TRUNCATED_COMPLETION)
+
+    assert app.request_completion("sample", MESSAGES) == COMPLETE_COMPLETION
+    assert len(calls) == 1
+
+def test_packed_completion_is_checked_with_its_parser(app, monkeypatch, completion_cache):
+    calls = use_completions(app, monkeypatch, ["no packed samples", "no packed samples"])
+
+    app.request_completion("packed", MESSAGES, parse_completion=app.split_packed_completion)
+    app.request_completion("packed", MESSAGES, parse_completion=app.split_packed_completion)
+    assert len(calls) == 2
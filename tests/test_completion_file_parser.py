@@ -0,0 +1,89 @@
+import pytest
+
+COMPLETION = (
+    "Here is the migrated sample:\n"
+    "###main.tf###\n"
+    "resource \"azurerm_resource_group\" \"rg\" {\n"
+    "  name = \"rg\"\n"
+    "}\n"
+    "main.tf:end\n"
+    "###outputs.tf###\n"
+    "output \"name\" {\n"
+    "  value = azurerm_resource_group.rg.name\n"
+    "}\n"
+    "outputs.tf:end\n"
+)
+
+EXPECTED_FILES = [
+    ("main.tf", "resource \"azurerm_resource_group\" \"rg\" {\n  name = \"rg\"\n}"),
+    ("outputs.tf", "output \"name\" {\n  value = azurerm_resource_group.rg.name\n}"),
+]
+
+def test_parses_files(app):
+    assert app.parse_completion_files(COMPLETION) == EXPECTED_FILES
+
+def test_nested_begin_marker_fails(app):
+    completion = "###main.tf###\nresource {}\n###outputs.tf###\noutput {}\noutputs.tf:end\n"
+
+    with pytest.raises(ValueError, match="before the end of file 'main.tf'"):
+        app.parse_completion_files(completion)
+
+def test_duplicate_file_name_fails(app):
+    completion = "###main.tf###\na\nmain.tf:end\n###main.tf###\nb\nmain.tf:end\n"
+
+    with pytest.raises(ValueError, match="duplicate file name: 'main.tf'"):
+        app.parse_completion_files(completion)
+
+def test_missing_end_marker_fails(app):
+    completion = "###main.tf###\na\nmain.tf:end\n###outputs.tf###\nb\n"
+
+    with pytest.raises(ValueError, match="end of file 'outputs.tf'"):
+        app.parse_completion_files(completion)
+
+@pytest.mark.parametrize("file_name", ["..", "../main.tf", "modules\\main.tf"])
+def test_file_name_with_path_fails(app, file_name):
+    with pytest.raises(ValueError, match="invalid file name"):
+        app.parse_completion_files(f"###{file_name}###\na\n{file_name}:end\n")
+
+def test_text_after_last_end_marker_is_ignored(app):
+    completion = COMPLETION + "These files follow the best practices.\n###"
+
+    assert app.parse_completion_files(completion) == EXPECTED_FILES
+
+def test_end_marker_without_trailing_newline(app):
+    assert app.parse_completion_files(COMPLETION.rstrip("\n")) == EXPECTED_FILES
+
+def test_text_before_end_marker_on_the_same_line_is_kept(app):
+    assert app.parse_completion_files("###main.tf###\na\nb main.tf:end") == [("main.tf", "a\nb")]
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 16, 64, len(COMPLETION)])
+def test_streamed_completion_split_at_any_boundary(app, chunk_size):
+    parser = app.CompletionFileParser()
+    files = []
+
+    for i in range(0, len(COMPLETION), chunk_size):
+        files += parser.feed(COMPLETION[i:i + chunk_size])
+
+    assert files + parser.close() == EXPECTED_FILES
+
+def test_streamed_files_are_returned_as_soon_as_they_end(app):
+    parser = app.CompletionFileParser()
+    end_of_first_file = COMPLETION.index("main.tf:end\n") + len("main.tf:end\n")
+
+    assert parser.feed(COMPLETION[:end_of_first_file]) == EXPECTED_FILES[:1]
+    assert parser.feed(COMPLETION[end_of_first_file:]) == EXPECTED_FILES[1:]
+    assert parser.close() == []
+
+def test_streamed_missing_end_marker_fails_on_close(app):
+    parser = app.CompletionFileParser()
+
+    assert parser.feed("###main.tf###\na\n") == []
+    with pytest.raises(ValueError, match="end of file 'main.tf'"):
+        parser.close()
+
+def test_streamed_completion_split_in_two_at_every_offset(app):
+    for offset in range(len(COMPLETION) + 1):
+        parser = app.CompletionFileParser()
+        files = parser.feed(COMPLETION[:offset]) + parser.feed(COMPLETION[offset:])
+
+        assert files + parser.close() == EXPECTED_FILES, offset
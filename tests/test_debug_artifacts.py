@@ -0,0 +1,27 @@
+import os
+
+def test_delete_previous_sample_temp_dir_keeps_nested_samples(app, monkeypatch, tmp_path):
+    sample_root = tmp_path / "samples"
+    temp_dir = tmp_path / "temp"
+    monkeypatch.setattr(app, "sample_root_path", str(sample_root))
+    monkeypatch.setattr(app, "temp_path", str(temp_dir))
+
+    sample_temp_dir = temp_dir / "samples" / "parent"
+    nested_temp_dir = sample_temp_dir / "child"
+    nested_temp_dir.mkdir(parents=True)
+    for file_name in ["debug.json", "debug.chunk1.json", "debug.chunk2.json", "notes.txt"]:
+        (sample_temp_dir / file_name).write_text("{}", encoding="utf-8")
+    (nested_temp_dir / "debug.json").write_text("{}", encoding="utf-8")
+
+    app.delete_previous_sample_temp_dir(str(sample_root / "parent"))
+
+    assert sorted(os.listdir(sample_temp_dir)) == ["child", "notes.txt"]
+    assert os.listdir(nested_temp_dir) == ["debug.json"]
+
+def test_delete_previous_sample_temp_dir_without_a_temp_dir(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "sample_root_path", str(tmp_path / "samples"))
+    monkeypatch.setattr(app, "temp_path", str(tmp_path / "temp"))
+
+    app.delete_previous_sample_temp_dir(str(tmp_path / "samples" / "sample"))
+
+    assert not os.path.exists(tmp_path / "temp")
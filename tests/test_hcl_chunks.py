@@ -0,0 +1,123 @@
+import pytest
+
+TRICKY_SOURCE = '''# The resource group.
+resource "azurerm_resource_group" "rg" {
+  name     = "rg-{not-a-block}"
+  location = "west}us"
+  tags = {
+    note = "a \\"quoted\\" { brace"
+  }
+}
+
+locals {
+  script = <<-EOT
+    if [ -z "$NAME" ]; then {
+      echo "}"
+    EOT
+}
+
+/* A block comment with a } brace
+   over two lines { */
+variable "name" {
+  default = "x" # A comment with a { brace
+}
+
+location = "westus" // A top-level attribute
+'''
+
+@pytest.fixture
+def estimated_tokens(app, monkeypatch):
+    # Estimate the token counts from the text length so that the chunks don't depend on tiktoken.
+    monkeypatch.setattr(app, "token_encoding", False)
+
+def get_sample_source(app, files):
+    text = ''.join(contents for (_, contents) in files)
+    return app.SampleSource(text, files, [], len(text.encode("utf-8")))
+
+def get_resource(name, padding = 0):
+    return f'resource "azurerm_storage_account" "{name}" {{\n  name = "{name}"\n  padding = "{"x" * padding}"\n}}'
+
+def test_split_hcl_blocks_ignores_brackets_in_strings_heredocs_and_comments(app):
+    blocks = app.split_hcl_blocks(TRICKY_SOURCE)
+
+    assert [(block_type, labels) for (block_type, labels, _) in blocks] == [
+        ("resource", ["azurerm_resource_group", "rg"]),
+        ("locals", []),
+        ("variable", ["name"]),
+        (None, []),
+    ]
+    assert blocks[0][2].startswith("# The resource group.")
+    assert "echo \"}\"\n    EOT\n}" in blocks[1][2]
+    assert blocks[2][2].strip().startswith("/* A block comment")
+    assert '\n'.join(text for (_, _, text) in blocks) == TRICKY_SOURCE.rstrip('\n')
+
+def test_hcl_structure_errors_of_well_formed_source(app):
+    assert app.get_hcl_structure_errors(TRICKY_SOURCE) == []
+
+@pytest.mark.parametrize(("source_code", "errors"), [
+    ('resource "a" "b" {\n  name = "x"\n', ["Line 1: '{' is never closed."]),
+    ('resource "a" "b" {\n}\n}\n', ["Line 3: unexpected '}'."]),
+    ('resource "a" "b" {\n  tags = [\n}\n', ["Line 3: '}' doesn't match the '[' on line 2.", "Line 1: '{' is never closed."]),
+    ('resource "a" "b" {\n  name = "x\n}\n', ["Line 2: unterminated string."]),
+    ('locals {\n  a = <<EOT\n  text\n}\n', ["Line 1: '{' is never closed.", "Line 2: heredoc 'EOT' is never closed."]),
+    ('/* comment\nresource "a" "b" {}\n', ["Line 1: comment is never closed."]),
+    ('resource "a" "b" {}\n\n```\n', ["Line 3: expected a block or an attribute, found '```'."]),
+    ('Here is the file:\nresource "a" "b" {}\n', ["Line 1: expected a block or an attribute, found 'Here is the file:'."]),
+])
+def test_hcl_structure_errors(app, source_code, errors):
+    assert app.get_hcl_structure_errors(source_code) == errors
+
+def test_split_sample_into_chunks_keeps_a_block_larger_than_a_chunk_whole(app, estimated_tokens):
+    large_resource = get_resource("large", padding=4 * 2 * app.CHUNK_MIN_TOKENS)
+    files = [("main.tf", '\n\n'.join([get_resource("first"), large_resource, get_resource("last")]))]
+
+    chunks = app.split_sample_into_chunks(get_sample_source(app, files), 2 * app.CHUNK_MIN_TOKENS)
+
+    assert [chunk.strip() for chunk in chunks] == [get_resource("first"), large_resource, get_resource("last")]
+
+def test_split_sample_into_chunks_sends_shared_blocks_with_the_chunks_that_use_them(app, estimated_tokens):
+    provider = 'provider "azurerm" {\n  features {}\n}'
+    variable = 'variable "location" {\n  default = "westus"\n}'
+    resources = [get_resource(f"sa{i}", padding=4 * app.CHUNK_MIN_TOKENS).replace('name = "', 'location = var.location\n  name = "') 
+                 for i in range(3)]
+    files = [("providers.tf", provider), ("variables.tf", variable), ("main.tf", '\n\n'.join(resources)), ("README.md", "# Sample\n")]
+
+    chunks = app.split_sample_into_chunks(get_sample_source(app, files), 2 * app.CHUNK_MIN_TOKENS)
+
+    assert len(chunks) == 3
+    assert all(provider in chunk and variable in chunk for chunk in chunks)
+    assert ["# Sample" in chunk for chunk in chunks] == [True, False, False]
+
+def test_split_sample_into_chunks_fails_without_room_for_blocks(app, estimated_tokens):
+    files = [("main.tf", get_resource("sa")), ("README.md", "x" * 4 * app.CHUNK_MIN_TOKENS)]
+
+    with pytest.raises(ValueError, match="leave only"):
+        app.split_sample_into_chunks(get_sample_source(app, files), app.CHUNK_MIN_TOKENS)
+
+def test_split_then_stitch_returns_the_original_blocks(app, estimated_tokens):
+    provider = 'provider "azurerm" {\n  features {}\n}'
+    resources = [get_resource(f"sa{i}", padding=app.CHUNK_MIN_TOKENS) for i in range(8)]
+    source_code = '\n\n'.join([provider] + resources + [TRICKY_SOURCE.strip()])
+
+    chunks = app.split_sample_into_chunks(get_sample_source(app, [("main.tf", source_code)]), 2 * app.CHUNK_MIN_TOKENS)
+    assert 1 < len(chunks)
+
+    # Each chunk comes back as the same file, so the provider block is returned by every chunk.
+    stitched_files = app.stitch_chunk_files([[("main.tf", chunk)] for chunk in chunks])
+    assert [file_name for (file_name, _) in stitched_files] == ["main.tf"]
+
+    original_blocks = sorted(text.strip() for (_, _, text) in app.split_hcl_blocks(source_code))
+    stitched_blocks = sorted(text.strip() for (_, _, text) in app.split_hcl_blocks(stitched_files[0][1]))
+    assert stitched_blocks == original_blocks
+
+def test_stitch_chunk_files_takes_other_files_from_the_first_chunk(app):
+    chunk_files = [
+        [("main.tf", get_resource("a")), ("README.md", "first")],
+        [("main.tf", get_resource("b")), ("README.md", "second"), ("outputs.tf", 'output "a" {\n  value = 1\n}')],
+    ]
+
+    assert app.stitch_chunk_files(chunk_files) == [
+        ("main.tf", get_resource("a") + "\n\n" + get_resource("b")),
+        ("README.md", "first"),
+        ("outputs.tf", 'output "a" {\n  value = 1\n}'),
+    ]
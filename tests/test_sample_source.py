@@ -0,0 +1,19 @@
+import contextlib
+
+def test_assemble_source_code_reads_the_files_in_name_order(app, monkeypatch, tmp_path):
+    for file_name in ["variables.tf", "main.tf", "outputs.tf", "README.md"]:
+        (tmp_path / file_name).write_text(f"# {file_name}\n", encoding="utf-8")
+
+    # Return the entries in the reverse of their name order, as a file system might.
+    scandir = app.os.scandir
+
+    @contextlib.contextmanager
+    def reversed_scandir(path):
+        with scandir(path) as entries:
+            yield iter(sorted(entries, key=lambda entry: entry.name, reverse=True))
+
+    monkeypatch.setattr(app.os, "scandir", reversed_scandir)
+    sample_source = app.assemble_source_code(str(tmp_path), False)
+
+    assert [file_name for (file_name, _) in sample_source.files] == ["README.md", "main.tf", "outputs.tf", "variables.tf"]
+    assert sample_source.text == "\n# README.md\n\n# main.tf\n\n# outputs.tf\n\n# variables.tf\n"
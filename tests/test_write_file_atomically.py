@@ -0,0 +1,47 @@
+import json
+import os
+import stat
+
+import pytest
+
+def test_writes_text_and_bytes(app, tmp_path):
+    file_name = str(tmp_path / "file.txt")
+
+    app.write_file_atomically(file_name, "text é\n")
+    assert (tmp_path / "file.txt").read_bytes() == "text é\n".encode("utf-8")
+
+    app.write_file_atomically(file_name, b"\x00bytes")
+    assert (tmp_path / "file.txt").read_bytes() == b"\x00bytes"
+    assert os.listdir(tmp_path) == ["file.txt"]
+
+def test_sets_the_mode(app, tmp_path):
+    file_name = str(tmp_path / "file.txt")
+
+    app.write_file_atomically(file_name, "text")
+    assert stat.S_IMODE(os.stat(file_name).st_mode) == 0o600
+
+    app.write_file_atomically(file_name, "text", 0o644)
+    assert stat.S_IMODE(os.stat(file_name).st_mode) == 0o644
+
+def test_failed_write_leaves_the_file_and_no_temp_file(app, monkeypatch, tmp_path):
+    (tmp_path / "file.txt").write_text("old", encoding="utf-8")
+
+    def failing_replace(source, destination):
+        raise OSError("replace failed")
+
+    monkeypatch.setattr(app.os, "replace", failing_replace)
+
+    with pytest.raises(OSError, match="replace failed"):
+        app.write_file_atomically(str(tmp_path / "file.txt"), "new")
+
+    assert os.listdir(tmp_path) == ["file.txt"]
+    assert (tmp_path / "file.txt").read_text(encoding="utf-8") == "old"
+
+def test_write_dictionary_to_file(app, tmp_path):
+    app.write_dictionary_to_file(str(tmp_path / "file.json"), {"index": 1})
+
+    assert json.loads((tmp_path / "file.json").read_text(encoding="utf-8")) == {"index": 1}
+
+def test_write_dictionary_to_file_raises_when_it_cant_write(app, tmp_path):
+    with pytest.raises(OSError):
+        app.write_dictionary_to_file(str(tmp_path / "missing" / "file.json"), {"index": 1})